@@ -0,0 +1,82 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Latency of dispatching remote operations to a subprocess.
+
+Dispatches a no-op operation a number of times, once running each one in
+its own interpreter (as it used to) and once on the pre-started dispatch
+workers, and prints the mean time per operation.
+
+    python benchmarks/dispatch_workers.py --operations 50
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from cloudify import amqp_client
+from cloudify import dispatch
+from cloudify import dispatch_workers
+
+MODES = ('one_shot', 'workers')
+
+if os.environ.get('CLOUDIFY_DISPATCH'):
+    # the no-op operation runs without a broker
+    amqp_client.create_client = lambda: None
+
+
+def noop():
+    pass
+
+
+def _dispatch(operations):
+    for i in range(operations):
+        dispatch.OperationHandler(cloudify_context={
+            'no_ctx_kwarg': True,
+            'task_id': str(i),
+            'task_name': 'dispatch_workers.noop',
+            'task_target': 'benchmark',
+            'type': 'operation',
+            'execution_env': {
+                'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+        }, args=[], kwargs={}).dispatch_to_subprocess()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--operations', type=int, default=50)
+    args = parser.parse_args()
+
+    command = [sys.executable, dispatch.__file__.replace('.pyc', '.py')]
+    print('{0:>10} {1:>12} {2:>22}'.format(
+        'mode', 'operations', 'mean per operation (s)'))
+    for mode in MODES:
+        pool = dispatch_workers.DispatchWorkerPool(
+            command, max_idle=0 if mode == 'one_shot' else 1)
+        dispatch.dispatch_workers_pool = pool
+        start = time.time()
+        try:
+            _dispatch(args.operations)
+        finally:
+            pool.close()
+        duration = time.time() - start
+        print('{0:>10} {1:>12} {2:>22.3f}'.format(
+            mode, args.operations, duration / args.operations))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Cost of preparing the kwargs of operation tasks.
+
+For every node instance, merges the operation inputs of its node (about
+100 KB: a rendered cloud-init payload and a large property map) with the
+operation kwargs and copies the result the way execute_task does, once
+with a deep copy (as it used to) and once with a copy-on-write dict. A
+third mode also reads and modifies a few values through the copy-on-write
+kwargs, the way an operation running locally would.
+
+Every measurement runs in a fresh process so that max RSS is comparable.
+
+    python benchmarks/operation_kwargs.py --instances 5000
+"""
+
+import argparse
+import copy
+import multiprocessing
+import resource
+import time
+
+from cloudify.workflows.copy_on_write import (CopyOnWriteDict,
+                                              copy_on_write_values)
+from cloudify.workflows.workflow_context import _WorkflowContextBase
+
+MODES = ('deepcopy', 'copy_on_write', 'copy_on_write_mutated')
+
+
+def _operation_inputs(size):
+    properties = dict(
+        ('property_{0}'.format(i), {'name': 'value_{0}'.format(i),
+                                    'ports': [i, i + 1],
+                                    'enabled': True})
+        for i in range(size // 200))
+    return {
+        'cloud_init': '#cloud-config\n' + 'x' * (size // 2),
+        'properties': properties,
+        'image': 'ubuntu',
+    }
+
+
+def _prepare(mode, inputs, instances):
+    all_kwargs = []
+    for i in range(instances):
+        kwargs = _WorkflowContextBase._merge_dicts(
+            merged_from={'instance': i}, merged_into=inputs)
+        if mode == 'deepcopy':
+            kwargs = copy.deepcopy(kwargs)
+        else:
+            kwargs = CopyOnWriteDict(kwargs)
+        if mode == 'copy_on_write_mutated':
+            operation_kwargs = copy_on_write_values(kwargs)
+            operation_kwargs['properties']['property_0']['enabled'] = False
+        kwargs['__cloudify_context'] = {'task_id': str(i)}
+        all_kwargs.append(kwargs)
+    return all_kwargs
+
+
+def _measure(mode, instances, input_size, results):
+    inputs = _operation_inputs(input_size)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    all_kwargs = _prepare(mode, inputs, instances)
+    duration = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((len(all_kwargs), duration,
+                 (rss_after - rss_before) / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--instances', type=int, default=5000)
+    parser.add_argument('--input-size', type=int, default=100 * 1024,
+                        help='approximate size of the operation inputs')
+    args = parser.parse_args()
+
+    print('{0:>22} {1:>10} {2:>10} {3:>12}'.format(
+        'mode', 'instances', 'time (s)', 'max rss (MB)'))
+    for mode in MODES:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_measure,
+            args=(mode, args.instances, args.input_size, results))
+        process.start()
+        instances, duration, rss = results.get()
+        process.join()
+        print('{0:>22} {1:>10} {2:>10.3f} {3:>12.1f}'.format(
+            mode, instances, duration, rss))
+
+
+if __name__ == '__main__':
+    main()
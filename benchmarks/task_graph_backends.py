@@ -0,0 +1,112 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Memory and throughput of the task graph backends.
+
+Builds an install-like graph (a chain of tasks per node instance, each
+instance depending on the previous one) of the requested sizes and then
+drains it the way TaskDependencyGraph.execute does: removing tasks without
+remaining dependencies and checking their dependents.
+
+Every measurement runs in a fresh process so that max RSS is comparable.
+
+    python benchmarks/task_graph_backends.py --sizes 10000 200000
+"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+import uuid
+
+from cloudify.workflows import graph_backends
+
+TASKS_PER_INSTANCE = 10
+
+
+class _Task(object):
+
+    __slots__ = ('id',)
+
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+
+
+def _build(graph, tasks):
+    previous_instance_tail = None
+    instance_head = None
+    for i, task in enumerate(tasks):
+        graph.add_node(task.id, task)
+        if i % TASKS_PER_INSTANCE == 0:
+            previous_instance_tail = instance_head
+            instance_head = task
+            if previous_instance_tail is not None:
+                graph.add_edge(task.id, previous_instance_tail.id)
+        else:
+            graph.add_edge(task.id, instance_head.id)
+            instance_head = task
+
+
+def _drain(graph):
+    ready = [task.id for task in graph.nodes_iter()
+             if graph.out_degree(task.id) == 0]
+    while ready:
+        task_id = ready.pop()
+        dependents = graph.predecessors(task_id)
+        graph.remove_node(task_id)
+        ready.extend(dependent for dependent in dependents
+                     if graph.out_degree(dependent) == 0)
+    assert len(graph) == 0
+
+
+def _measure(backend, size, results):
+    tasks = [_Task() for _ in range(size)]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    graph = graph_backends.create_graph(backend)
+    start = time.time()
+    _build(graph, tasks)
+    build_time = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    _drain(graph)
+    drain_time = time.time() - start
+    results.put((build_time, drain_time, (rss_after - rss_before) / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[10000, 50000, 100000, 200000])
+    parser.add_argument('--backends', nargs='+',
+                        default=sorted(graph_backends.GRAPH_BACKENDS))
+    args = parser.parse_args()
+
+    print('{0:>10} {1:>10} {2:>10} {3:>10} {4:>12}'.format(
+        'backend', 'tasks', 'build (s)', 'drain (s)', 'max rss (MB)'))
+    for size in args.sizes:
+        for backend in args.backends:
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_measure,
+                                              args=(backend, size, results))
+            process.start()
+            build_time, drain_time, rss = results.get()
+            process.join()
+            print('{0:>10} {1:>10} {2:>10.3f} {3:>10.3f} {4:>12.1f}'.format(
+                backend, size, build_time, drain_time, rss))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Memory used by the tasks of a TaskDependencyGraph.
+
+Builds an install-like graph: a subgraph per node instance holding a
+sequence of operation (remote) tasks interleaved with set_state and
+send_event like local tasks, and measures the max RSS growth.
+
+Every measurement runs in a fresh process so that max RSS is comparable.
+
+    python benchmarks/task_graph_memory.py --sizes 50000
+"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+import uuid
+
+from cloudify.workflows import tasks
+from cloudify.workflows import graph_backends
+from cloudify.workflows.tasks_graph import TaskDependencyGraph
+
+# per node instance: 5 operations, each preceded by a set_state task and a
+# send_event task
+OPERATIONS = ('create', 'configure', 'start', 'establish', 'monitor')
+TASKS_PER_INSTANCE = 3 * len(OPERATIONS)
+
+
+class _Logger(object):
+
+    def debug(self, *args, **kwargs):
+        pass
+
+    info = debug
+
+
+class _WorkflowContext(object):
+
+    logger = _Logger()
+
+
+def _set_state(state):
+    pass
+
+
+def _send_event(event):
+    pass
+
+
+def _build(ctx, size):
+    graph = TaskDependencyGraph(
+        ctx, graph_backend=graph_backends.GRAPH_BACKEND_COMPACT)
+    for i in range(size // TASKS_PER_INSTANCE):
+        instance_id = 'node_{0}'.format(i)
+        subgraph = graph.subgraph(instance_id)
+        sequence = subgraph.sequence()
+        for operation in OPERATIONS:
+            operation_name = 'cloudify.interfaces.lifecycle.{0}'.format(
+                operation)
+            task_id = str(uuid.uuid4())
+            cloudify_context = {
+                'task_id': task_id,
+                'task_name': 'plugin.tasks.{0}'.format(operation),
+                'node_id': instance_id,
+                'operation': {'name': operation_name,
+                              'retry_number': 0,
+                              'max_retries': -1}
+            }
+            sequence.add(
+                tasks.LocalWorkflowTask(_set_state, ctx,
+                                        info=operation,
+                                        kwargs={'state': operation}),
+                tasks.LocalWorkflowTask(_send_event, ctx,
+                                        info=operation,
+                                        kwargs={'event': operation}),
+                tasks.RemoteWorkflowTask(
+                    {'__cloudify_context': cloudify_context},
+                    cloudify_context, ctx, task_id=task_id))
+    return graph
+
+
+def _measure(size, results):
+    ctx = _WorkflowContext()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    graph = _build(ctx, size)
+    build_time = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    task_count = len(list(graph.tasks_iter()))
+    rss = (rss_after - rss_before) * 1024.0
+    results.put((task_count, build_time, rss / (1024 * 1024),
+                 rss / task_count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[10000, 50000])
+    args = parser.parse_args()
+
+    print('{0:>10} {1:>10} {2:>12} {3:>14}'.format(
+        'tasks', 'build (s)', 'max rss (MB)', 'bytes per task'))
+    for size in args.sizes:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure,
+                                          args=(size, results))
+        process.start()
+        task_count, build_time, rss, per_task = results.get()
+        process.join()
+        print('{0:>10} {1:>10.3f} {2:>12.1f} {3:>14.0f}'.format(
+            task_count, build_time, rss, per_task))
+
+
+if __name__ == '__main__':
+    main()
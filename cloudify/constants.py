@@ -67,3 +67,10 @@ AGENT_REST_CERT_PATH = 'AGENT_REST_CERT_PATH'
 BROKER_SSL_CERT_PATH = 'BROKER_SSL_CERT_PATH'
 
 BYPASS_MAINTENANCE = 'BYPASS_MAINTENANCE'
+
+DISPATCH_WORKERS_KEY = 'CLOUDIFY_DISPATCH_WORKERS'
+DISPATCH_WORKER_MAX_TASKS_KEY = 'CLOUDIFY_DISPATCH_WORKER_MAX_TASKS'
+DISPATCH_WORKER_MAX_MEMORY_GROWTH_KEY = \
+    'CLOUDIFY_DISPATCH_WORKER_MAX_MEMORY_GROWTH'
+
+CANCELLATION_CHANNEL_KEY = 'CLOUDIFY_CANCELLATION_CHANNEL'
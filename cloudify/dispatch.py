@@ -20,7 +20,6 @@ import json
 import logging
 import os
 import shutil
-import subprocess
 import sys
 import tempfile
 import threading
@@ -39,10 +38,13 @@ from cloudify import context
 from cloudify import utils
 from cloudify import amqp_client_utils
 from cloudify import constants
+from cloudify import dispatch_workers
 from cloudify.amqp_client_utils import AMQPWrappedThread
 from cloudify.manager import update_execution_status, get_rest_client
 from cloudify.workflows import workflow_context
 from cloudify.workflows import api
+from cloudify.workflows import cancellation
+from cloudify.workflows import copy_on_write
 
 CLOUDIFY_DISPATCH = 'CLOUDIFY_DISPATCH'
 
@@ -80,6 +82,10 @@ PLUGINS_DIR = os.path.join(VIRTUALENV, 'plugins')
 DISPATCH_LOGGER_FORMATTER = logging.Formatter(
     '%(asctime)s [%(levelname)s] %(message)s')
 
+# pre-started processes remote tasks are dispatched to
+dispatch_workers_pool = dispatch_workers.DispatchWorkerPool.from_environment(
+    [sys.executable, __file__])
+
 
 class TaskHandler(object):
 
@@ -122,15 +128,14 @@ class TaskHandler(object):
                     'kwargs': self.kwargs
                 }, f)
             env = self._build_subprocess_env()
-            command_args = [sys.executable, __file__, dispatch_dir]
-            try:
-                subprocess.check_call(command_args,
-                                      env=env,
-                                      bufsize=1,
-                                      close_fds=os.name != 'nt',
-                                      stdout=output,
-                                      stderr=output)
-            except subprocess.CalledProcessError:
+            # the task module is imported by the dispatch worker, once for
+            # all the tasks it runs
+            module_name = '.'.join(split[:-1])
+            returncode = dispatch_workers_pool.run(dispatch_dir,
+                                                   env=env,
+                                                   output=output,
+                                                   preload=module_name)
+            if returncode != 0:
                 # this means something really bad happened because we generally
                 # catch all exceptions in the subprocess and exit cleanly
                 # regardless.
@@ -355,8 +360,11 @@ class OperationHandler(TaskHandler):
             amqp_client_utils.init_amqp_client()
         else:
             # task is local (not through celery) so we need clone kwarg
-            # and an amqp client is not required
-            kwargs = copy.deepcopy(kwargs)
+            # (copied on write, as they may be large and are mostly only
+            # read) and an amqp client is not required. the task kwargs were
+            # unpacked with ** to get here, which left their nested values
+            # shared with the node operation inputs
+            kwargs = copy_on_write.copy_on_write_values(kwargs)
         if self.cloudify_context.get('has_intrinsic_functions') is True:
             kwargs = ctx._endpoint.evaluate_functions(payload=kwargs)
         if not self.cloudify_context.get('no_ctx_kwarg'):
@@ -408,47 +416,18 @@ class WorkflowHandler(TaskHandler):
                 return api.EXECUTION_CANCELLED_RESULT
 
             queue = Queue.Queue()
-            t = AMQPWrappedThread(target=self._remote_workflow_child_thread,
-                                  args=(queue,),
-                                  name='Workflow-Child')
-            t.start()
-
-            # while the child thread is executing the workflow, the parent
-            # thread is polling for 'cancel' requests while also waiting for
-            # messages from the child thread
-            result = None
-            while True:
-                # check if child thread sent a message
-                try:
-                    data = queue.get(timeout=5)
-                    if 'result' in data:
-                        # child thread has terminated
-                        result = data['result']
-                        break
-                    else:
-                        # error occurred in child thread
-                        error = data['error']
-                        raise exceptions.ProcessExecutionError(
-                            error['message'],
-                            error['type'],
-                            error['traceback'])
-                except Queue.Empty:
-                    pass
-                # check for 'cancel' requests
-                execution = rest.executions.get(self.ctx.execution_id,
-                                                _include=['status'])
-                if execution.status == Execution.FORCE_CANCELLING:
-                    result = api.EXECUTION_CANCELLED_RESULT
-                    break
-                elif execution.status == Execution.CANCELLING:
-                    # send a 'cancel' message to the child thread. It is up to
-                    # the workflow implementation to check for this message
-                    # and act accordingly (by stopping and raising an
-                    # api.ExecutionCancelled error, or by returning the
-                    # deprecated api.EXECUTION_CANCELLED_RESULT as result).
-                    # parent thread then goes back to polling for messages from
-                    # child thread or possibly 'force-cancelling' requests
-                    api.cancel_request = True
+            subscription = self._subscribe_to_cancel_requests(queue)
+            try:
+                t = AMQPWrappedThread(
+                    target=self._remote_workflow_child_thread,
+                    args=(queue,),
+                    name='Workflow-Child')
+                t.start()
+                result = self._wait_for_remote_workflow(
+                    rest, queue, subscribed=subscription is not None)
+            finally:
+                if subscription is not None:
+                    subscription.close()
 
             if result == api.EXECUTION_CANCELLED_RESULT:
                 self._workflow_cancelled()
@@ -466,6 +445,71 @@ class WorkflowHandler(TaskHandler):
         finally:
             amqp_client_utils.close_amqp_client()
 
+    def _subscribe_to_cancel_requests(self, queue):
+        """
+        Have cancel requests of the execution pushed to the queue of messages
+        of the parent thread.
+
+        :return: The subscription, None if there is no cancellation channel
+                 or subscribing failed
+        """
+        channel = cancellation.get_channel()
+        if channel is None:
+            return None
+
+        def on_cancel_request(status):
+            queue.put({'status': status})
+        try:
+            return channel.subscribe(self.ctx.execution_id, on_cancel_request)
+        except Exception as e:
+            self.ctx.logger.debug(
+                'Failed subscribing to cancel requests, reading the '
+                'execution status instead: {0}'.format(e))
+            return None
+
+    def _wait_for_remote_workflow(self, rest, queue, subscribed):
+        # while the child thread is executing the workflow, the parent
+        # thread is waiting for messages from the child thread and for
+        # 'cancel' requests, which are pushed to the same queue. The status
+        # of the execution is read as well whenever no message arrived for a
+        # while, in case a request was missed.
+        started = utils.monotonic()
+        # whether the channel proved to deliver the requests of the execution
+        pushed = False
+        while True:
+            timeout = cancellation.poll_interval(
+                utils.monotonic() - started, subscribed, pushed)
+            try:
+                data = queue.get(timeout=timeout)
+            except Queue.Empty:
+                status = rest.executions.get(self.ctx.execution_id,
+                                             _include=['status']).status
+            else:
+                if 'result' in data:
+                    # child thread has terminated
+                    return data['result']
+                elif 'error' in data:
+                    # error occurred in child thread
+                    error = data['error']
+                    raise exceptions.ProcessExecutionError(
+                        error['message'],
+                        error['type'],
+                        error['traceback'])
+                # pushed by the cancellation channel
+                status = data['status']
+                pushed = True
+            if status == Execution.FORCE_CANCELLING:
+                return api.EXECUTION_CANCELLED_RESULT
+            elif status == Execution.CANCELLING:
+                # send a 'cancel' message to the child thread. It is up to
+                # the workflow implementation to check for this message
+                # and act accordingly (by stopping and raising an
+                # api.ExecutionCancelled error, or by returning the
+                # deprecated api.EXECUTION_CANCELLED_RESULT as result).
+                # parent thread then goes back to waiting for messages from
+                # child thread or possibly 'force-cancelling' requests
+                api.set_cancel_request()
+
     def _remote_workflow_child_thread(self, queue):
         # the actual execution of the workflow will run in another thread.
         # this method is the entry point for that thread, and takes care of
@@ -509,9 +553,13 @@ class WorkflowHandler(TaskHandler):
                 tasks = list(self.ctx.internal.task_graph.tasks_iter())
                 for workflow_task in tasks:
                     workflow_task.async_result.get()
+            self.ctx.internal.handler.flush_node_states(raise_errors=True)
+            # the execution succeeded, it will not be resumed
+            self.ctx.internal.task_graph.remove_checkpoint()
             return result
         finally:
             self.ctx.internal.stop_local_tasks_processing()
+            self.ctx.internal.handler.close()
 
     def _workflow_started(self):
         self._update_execution_status(Execution.STARTED)
@@ -579,8 +627,7 @@ def dispatch(__cloudify_context, *args, **kwargs):
     return handler.handle_or_dispatch_to_subprocess_if_remote()
 
 
-def main():
-    dispatch_dir = sys.argv[1]
+def main(dispatch_dir):
     with open(os.path.join(dispatch_dir, 'input.json')) as f:
         dispatch_inputs = json.load(f)
     cloudify_context = dispatch_inputs['cloudify_context']
@@ -661,4 +708,7 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1] == dispatch_workers.WORKER_ARG:
+        dispatch_workers.serve(main)
+    else:
+        main(sys.argv[1])
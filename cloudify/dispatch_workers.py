@@ -0,0 +1,347 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Pre-started dispatch processes for remote tasks.
+
+Every remote task used to run in a new python interpreter, which imported
+cloudify, the REST client and the plugin modules before running the task,
+taking longer than most operations themselves. A dispatch worker is an
+interpreter started once (``dispatch.py --worker``) with the environment of
+the tasks it runs: tasks with another environment (e.g. of another plugin,
+whose virtualenv is in PATH and PYTHONPATH) run on other workers.
+
+Workers run one task at a time, each in a child process forked from the
+worker after importing the module of the task in the worker, so that tasks
+are as isolated from each other as they were in their own interpreter but
+do not pay for imports again. The dispatch directory protocol (input.json,
+output.json and output) is unchanged.
+
+Workers keep the modules they imported, so a worker is only reused while
+the directories in the PYTHONPATH of its tasks (e.g. the site-packages of a
+plugin) are unchanged: a reinstalled plugin runs on new workers. Workers are
+also replaced after running a number of tasks or once their memory grew by
+too much (see DispatchWorkerPool), and a task runs in its own interpreter as
+before whenever no worker could run it.
+
+Each idle worker is a python interpreter with the modules of its tasks
+loaded, so the workers are disabled by default: they are enabled by setting
+CLOUDIFY_DISPATCH_WORKERS to the maximum number of idle workers.
+"""
+
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import traceback
+
+from cloudify import constants
+
+logger = logging.getLogger(__name__)
+
+WORKER_ARG = '--worker'
+
+# maximum number of idle workers kept, 0 disables the workers
+DEFAULT_MAX_IDLE_WORKERS = 0
+# tasks run by a worker before it is replaced
+DEFAULT_MAX_TASKS = 100
+# MB the memory of a worker may grow by (by importing the modules of
+# tasks) before it is replaced
+DEFAULT_MAX_MEMORY_GROWTH = 100
+
+
+class DispatchWorkerError(Exception):
+    pass
+
+
+def _max_rss():
+    """:return: The maximum resident set size of this process in KB"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes
+        max_rss //= 1024
+    return max_rss
+
+
+def _code_version(env):
+    """
+    :return: The modification times of the directories in the PYTHONPATH of
+             the environment, which change when packages are installed in or
+             removed from them
+    """
+    version = []
+    for path in env.get('PYTHONPATH', '').split(os.pathsep):
+        try:
+            version.append(os.stat(path).st_mtime)
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def serve(run_task):
+    """
+    Worker process main loop: run the tasks whose dispatch directories are
+    read from stdin one at a time, each in a forked child process, and
+    write the exit code of the child to stdout.
+
+    :param run_task: Called with a dispatch directory in the child process
+    """
+    requests = sys.stdin
+    replies = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    # stray output of the worker must not be mistaken for replies
+    os.dup2(devnull, 1)
+
+    def reply(**message):
+        message['max_rss'] = _max_rss()
+        replies.write(json.dumps(message) + '\n')
+        replies.flush()
+    reply(ready=True)
+    for line in iter(requests.readline, ''):
+        request = json.loads(line)
+        module_name = request.get('preload')
+        if module_name:
+            try:
+                __import__(module_name)
+            except BaseException:
+                # the child process fails importing it as well and
+                # reports the error
+                pass
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                output = os.open(
+                    os.path.join(request['dispatch_dir'], 'output'),
+                    os.O_WRONLY | os.O_APPEND)
+                os.dup2(devnull, 0)
+                os.dup2(output, 1)
+                os.dup2(output, 2)
+                replies.close()
+                run_task(request['dispatch_dir'])
+                exit_code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+        _, status = os.waitpid(pid, 0)
+        reply(returncode=_exit_code(status))
+
+
+class DispatchWorker(object):
+    """
+    A running worker process
+
+    :param command: The command line of a one-shot dispatch process
+    :param env: The environment of the worker and of the tasks it runs
+    """
+
+    def __init__(self, command, env):
+        try:
+            self._process = subprocess.Popen(command + [WORKER_ARG],
+                                             env=env,
+                                             stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE,
+                                             close_fds=True)
+            ready = self._read_reply()
+        except (OSError, IOError, DispatchWorkerError) as e:
+            self.stop()
+            raise DispatchWorkerError(
+                'Failed starting a dispatch worker: {0}'.format(e))
+        self.tasks = 0
+        self.alive = True
+        self.initial_rss = self.rss = ready['max_rss']
+
+    def run(self, dispatch_dir, preload=None):
+        """
+        :return: The exit code of the process that ran the task
+        :raise DispatchWorkerError: If the worker did not get the task
+        """
+        request = json.dumps({'dispatch_dir': dispatch_dir,
+                              'preload': preload})
+        try:
+            self._process.stdin.write(request + '\n')
+            self._process.stdin.flush()
+        except (OSError, IOError) as e:
+            self.alive = False
+            raise DispatchWorkerError(
+                'Failed sending a task to a dispatch worker: {0}'.format(e))
+        self.tasks += 1
+        try:
+            reply = self._read_reply()
+        except (OSError, IOError, DispatchWorkerError):
+            # the task may have been run (partly), so it is not run again.
+            # reported the way a crashed one-shot process is
+            self.alive = False
+            return -1
+        self.rss = reply['max_rss']
+        return reply['returncode']
+
+    def stop(self):
+        process = getattr(self, '_process', None)
+        if process is None:
+            return
+        try:
+            # the worker exits when its stdin is closed
+            process.stdin.close()
+            process.wait()
+        except (OSError, IOError):
+            pass
+
+    def _read_reply(self):
+        line = self._process.stdout.readline()
+        if not line:
+            raise DispatchWorkerError('Dispatch worker exited')
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise DispatchWorkerError(
+                'Unexpected dispatch worker reply: {0}'.format(line))
+
+
+class DispatchWorkerPool(object):
+    """
+    Idle dispatch workers, by the environment of the tasks they run.
+
+    Tasks run on an idle worker with the same environment, or on a worker
+    started for them. Idle workers with the same environment whose
+    PYTHONPATH directories changed since they started are stopped instead
+    of being used. Workers are put back once the task is done, unless
+    they ran max_tasks tasks or their memory grew by more than
+    max_memory_growth MB. The least recently used idle workers are stopped
+    when there are more than max_idle.
+
+    :param command: The command line of a one-shot dispatch process
+    """
+
+    def __init__(self, command,
+                 max_idle=DEFAULT_MAX_IDLE_WORKERS,
+                 max_tasks=DEFAULT_MAX_TASKS,
+                 max_memory_growth=DEFAULT_MAX_MEMORY_GROWTH):
+        self.command = command
+        self.max_idle = max_idle
+        self.max_tasks = max_tasks
+        self.max_memory_growth = max_memory_growth
+        self._lock = threading.Lock()
+        # (key, worker), least recently used first
+        self._idle = []
+
+    @classmethod
+    def from_environment(cls, command):
+        """Pool configured by the DISPATCH_WORKER* environment variables"""
+        def setting(key, default):
+            return int(os.environ.get(key, default))
+        return cls(command,
+                   max_idle=setting(constants.DISPATCH_WORKERS_KEY,
+                                    DEFAULT_MAX_IDLE_WORKERS),
+                   max_tasks=setting(constants.DISPATCH_WORKER_MAX_TASKS_KEY,
+                                     DEFAULT_MAX_TASKS),
+                   max_memory_growth=setting(
+                       constants.DISPATCH_WORKER_MAX_MEMORY_GROWTH_KEY,
+                       DEFAULT_MAX_MEMORY_GROWTH))
+
+    @property
+    def enabled(self):
+        # workers fork a process per task
+        return self.max_idle > 0 and hasattr(os, 'fork')
+
+    def run(self, dispatch_dir, env, output, preload=None):
+        """
+        Run a task on a worker, or in its own process if no worker can run
+        it.
+
+        :param dispatch_dir: The dispatch directory of the task
+        :param env: The environment of the task
+        :param output: File the one-shot process output is written to
+        :param preload: Module imported by the worker before running the
+                        task
+        :return: The exit code of the process that ran the task
+        """
+        if self.enabled:
+            key = (tuple(sorted(env.items())), _code_version(env))
+            worker = None
+            try:
+                worker = self._acquire(key, env)
+                returncode = worker.run(dispatch_dir, preload)
+            except DispatchWorkerError as e:
+                if worker is not None:
+                    worker.stop()
+                logger.debug('Running the task in its own process: '
+                             '{0}'.format(e))
+            else:
+                self._release(key, worker)
+                return returncode
+        return subprocess.call(self.command + [dispatch_dir],
+                               env=env,
+                               bufsize=1,
+                               close_fds=os.name != 'nt',
+                               stdout=output,
+                               stderr=output)
+
+    def close(self):
+        """Stop all idle workers"""
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for _, worker in idle:
+            worker.stop()
+
+    def _acquire(self, key, env):
+        env_key, _ = key
+        worker = None
+        stale = []
+        with self._lock:
+            for i in range(len(self._idle) - 1, -1, -1):
+                idle_key, idle_worker = self._idle[i]
+                if idle_key == key:
+                    if worker is not None:
+                        continue
+                    worker = idle_worker
+                elif idle_key[0] == env_key:
+                    # the modules they imported may have been replaced
+                    stale.append(idle_worker)
+                else:
+                    continue
+                del self._idle[i]
+        for stale_worker in stale:
+            stale_worker.stop()
+        if worker is None:
+            worker = DispatchWorker(self.command, env)
+        return worker
+
+    def _release(self, key, worker):
+        memory_growth = (worker.rss - worker.initial_rss) / 1024.0
+        if (not worker.alive or
+                worker.tasks >= self.max_tasks or
+                memory_growth > self.max_memory_growth):
+            worker.stop()
+            return
+        with self._lock:
+            self._idle.append((key, worker))
+            evicted = self._idle[:-self.max_idle]
+            del self._idle[:-self.max_idle]
+        for _, evicted_worker in evicted:
+            evicted_worker.stop()
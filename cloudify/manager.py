@@ -22,6 +22,20 @@ import utils
 import constants
 from cloudify_rest_client import CloudifyClient
 from cloudify.exceptions import HttpException, NonRecoverableError
+from cloudify.ttl_cache import TTLCache
+
+# number of items requested at a time by list_paginated
+DEFAULT_PAGE_SIZE = 1000
+
+# seconds the provider context (including the bootstrap context) read from
+# the manager is cached in the process. It is only changed when the manager
+# is bootstrapped or the context is explicitly updated, see
+# invalidate_manager_context
+MANAGER_CONTEXT_TTL = 300
+
+# provider contexts by manager, shared by all operations and workflows
+# running in the process
+manager_context_cache = TTLCache(ttl=MANAGER_CONTEXT_TTL)
 
 
 class NodeInstance(object):
@@ -169,6 +183,29 @@ def get_rest_client():
     return rest_client
 
 
+def list_paginated(list_method, page_size=DEFAULT_PAGE_SIZE, **kwargs):
+    """
+    Iterate over all the items a rest client list method returns, requesting
+    them a page at a time so that they do not all have to be held in memory
+    at once.
+
+    :param list_method: A rest client list method, e.g.
+                        client.node_instances.list
+    :param page_size: Number of items requested at a time
+    :param kwargs: Passed to the list method (filters, _include)
+    """
+    offset = 0
+    while True:
+        page = list_method(_offset=offset, _size=page_size, **kwargs)
+        for item in page:
+            yield item
+        offset += len(page)
+        pagination = page.metadata.get('pagination') or {}
+        if (not page or pagination.get('total') is None or
+                offset >= int(pagination['total'])):
+            return
+
+
 def _save_resource(logger, resource, resource_path, target_path):
     if not target_path:
         target_path = os.path.join(utils.create_temp_folder(),
@@ -361,16 +398,31 @@ def update_execution_status(execution_id, status, error=None):
 
 def get_bootstrap_context():
     """Read the manager bootstrap context."""
-    client = get_rest_client()
-    context = client.manager.get_context()['context']
-    return context.get('cloudify', {})
+    return get_provider_context().get('cloudify', {})
 
 
 def get_provider_context():
-    """Read the manager provider context."""
-    client = get_rest_client()
-    context = client.manager.get_context()
-    return context['context']
+    """
+    Read the manager provider context, cached for MANAGER_CONTEXT_TTL
+    seconds.
+    """
+    def load():
+        client = get_rest_client()
+        return client.manager.get_context()['context']
+    return manager_context_cache.get(_manager_context_key(), load)
+
+
+def invalidate_manager_context():
+    """
+    Drop the cached provider and bootstrap contexts, so that they are read
+    from the manager again the next time they are used.
+    """
+    manager_context_cache.invalidate()
+
+
+def _manager_context_key():
+    return (os.environ.get(constants.REST_HOST_KEY),
+            os.environ.get(constants.REST_PORT_KEY))
 
 
 class DirtyTrackingDict(dict):
@@ -219,27 +219,38 @@ def scale(ctx, node_id, delta, scale_compute, **kwargs):
 
 
 def _filter_node_instances(ctx, node_ids, node_instance_ids, type_names):
+    # start from the most selective filter, then apply the others
+    if node_instance_ids:
+        candidates = [ctx.get_node_instance(instance_id)
+                      for instance_id in node_instance_ids]
+    elif node_ids:
+        candidates = [instance for node_id in node_ids
+                      for instance in ctx.get_node_instances_by_node(node_id)]
+    elif type_names:
+        candidates = [instance for type_name in type_names
+                      for instance in ctx.get_node_instances_by_type(
+                          type_name)]
+    else:
+        candidates = list(ctx.node_instances)
+    node_ids = set(node_ids or [])
+    type_names = set(type_names or [])
     filtered_node_instances = []
-    for node in ctx.nodes:
-        if node_ids and node.id not in node_ids:
+    seen = set()
+    for instance in candidates:
+        if instance is None or instance.id in seen:
             continue
-        if type_names and not next((type_name for type_name in type_names if
-                                    type_name in node.type_hierarchy), None):
+        seen.add(instance.id)
+        if node_ids and instance.node_id not in node_ids:
             continue
-
-        for instance in node.instances:
-            if node_instance_ids and instance.id not in node_instance_ids:
-                continue
-            filtered_node_instances.append(instance)
+        if type_names and not any(instance.node.is_derived_from(type_name)
+                                  for type_name in type_names):
+            continue
+        filtered_node_instances.append(instance)
     return filtered_node_instances
 
 
 def _get_all_host_instances(ctx):
-    node_instances = set()
-    for node_instance in ctx.node_instances:
-        if lifecycle.is_host_node(node_instance):
-            node_instances.add(node_instance)
-    return node_instances
+    return set(ctx.get_node_instances_by_type(constants.COMPUTE_NODE_TYPE))
 
 
 @workflow
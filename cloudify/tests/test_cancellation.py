@@ -0,0 +1,80 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import mock
+import testtools
+
+from cloudify.workflows import cancellation
+
+
+class PollIntervalTest(testtools.TestCase):
+
+    def test_not_subscribed(self):
+        for age in (0, 5, 3600):
+            self.assertEqual(cancellation.MAX_POLL_INTERVAL,
+                             cancellation.poll_interval(age,
+                                                        subscribed=False))
+
+    def test_grows_with_age(self):
+        intervals = [cancellation.poll_interval(age, subscribed=True)
+                     for age in (0, 5, 20, 40, 3600)]
+        self.assertEqual(cancellation.MIN_POLL_INTERVAL, intervals[0])
+        self.assertEqual(sorted(intervals), intervals)
+        self.assertEqual(cancellation.MAX_POLL_INTERVAL, intervals[-1])
+
+    def test_pushed(self):
+        self.assertEqual(cancellation.MIN_POLL_INTERVAL,
+                         cancellation.poll_interval(0, subscribed=True,
+                                                    pushed=True))
+        self.assertEqual(cancellation.MAX_PUSHED_POLL_INTERVAL,
+                         cancellation.poll_interval(3600, subscribed=True,
+                                                    pushed=True))
+
+
+class GetChannelTest(testtools.TestCase):
+
+    def setUp(self):
+        super(GetChannelTest, self).setUp()
+        cancellation.set_channel(None)
+        self.addCleanup(cancellation.set_channel, None)
+
+    def test_disabled_by_default(self):
+        with mock.patch.dict('os.environ', clear=True):
+            self.assertIsNone(cancellation.get_channel())
+
+    def test_enabled(self):
+        with mock.patch.dict('os.environ', {
+                'CLOUDIFY_CANCELLATION_CHANNEL': 'true'}):
+            self.assertIsInstance(cancellation.get_channel(),
+                                  cancellation.AMQPCancellationChannel)
+
+
+class LocalCancellationChannelTest(testtools.TestCase):
+
+    def test_publish(self):
+        channel = cancellation.LocalCancellationChannel()
+        callback = mock.Mock()
+        other_callback = mock.Mock()
+        subscription = channel.subscribe('execution_1', callback)
+        channel.subscribe('execution_2', other_callback)
+        channel.publish('execution_1', 'cancelling')
+        callback.assert_called_once_with('cancelling')
+        self.assertFalse(other_callback.called)
+
+        subscription.close()
+        subscription.close()
+        channel.publish('execution_1', 'force_cancelling')
+        self.assertEqual(1, callback.call_count)
+        self.assertEqual(['execution_2'], channel._subscribers.keys())
@@ -0,0 +1,138 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+import testtools
+
+from cloudify.workflows import api
+from cloudify.workflows import checkpoint
+from cloudify.workflows import tasks
+from cloudify.workflows.tasks_graph import TaskDependencyGraph
+from cloudify.tests.test_tasks_graph import _Task
+
+
+class CheckpointTest(testtools.TestCase):
+
+    def setUp(self):
+        super(CheckpointTest, self).setUp()
+        self.ctx = mock.Mock()
+        self.executions = []
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.path = os.path.join(tempdir, 'execution.checkpoint')
+        self.addCleanup(setattr, api, 'cancel_request', False)
+
+    def _graph(self, durations):
+        graph = TaskDependencyGraph(self.ctx, checkpoint_path=self.path)
+        sequence = graph.sequence()
+        for i, duration in enumerate(durations):
+            sequence.add(_Task(self.ctx, name='task{0}'.format(i),
+                               duration=duration,
+                               executions=self.executions))
+        return graph
+
+    def test_log(self):
+        graph = self._graph([0, 0, 0])
+        task_ids = [task.id for task in graph.tasks_iter()]
+        graph.execute()
+        graph_checkpoint = checkpoint.load(self.path)
+        self.assertEqual(sorted(task_ids), sorted(graph_checkpoint.tasks))
+        for record in graph_checkpoint.tasks.values():
+            self.assertEqual(tasks.TASK_SUCCEEDED, record['state'])
+            self.assertEqual(tasks.TASK_SUCCEEDED,
+                             graph_checkpoint.state(record['key']))
+        self.assertEqual(2, len(graph_checkpoint.dependencies))
+
+    def test_resume_skips_succeeded_tasks(self):
+        graph = self._graph([0, 0, None])
+        timer = threading.Timer(0.3, api.set_cancel_request)
+        timer.daemon = True
+        timer.start()
+        self.assertRaises(api.ExecutionCancelled, graph.execute)
+        self.assertEqual(['task0', 'task1'],
+                         [name for name, _ in self.executions])
+        api.cancel_request = False
+
+        del self.executions[:]
+        graph = self._graph([0, 0, 0])
+        graph.execute()
+        self.assertEqual(['task2'], [name for name, _ in self.executions])
+        # the resumed execution is appended to the log
+        graph_checkpoint = checkpoint.load(self.path)
+        self.assertEqual(6, len(graph_checkpoint.tasks))
+        keys = set(record['key']
+                   for record in graph_checkpoint.tasks.values())
+        self.assertEqual(3, len(keys))
+        for key in keys:
+            self.assertEqual(tasks.TASK_SUCCEEDED,
+                             graph_checkpoint.state(key))
+
+    def test_resume_runs_tasks_retried_by_success_handler(self):
+        graph = self._graph([0, 0])
+        first = next(task for task in graph.tasks_iter()
+                     if task.name == 'task0')
+
+        def on_success(task):
+            # e.g. waiting for a node instance to reach a state
+            result = tasks.HandlerResult.retry()
+            result.retried_task = _Task(self.ctx, name='task0',
+                                        duration=None,
+                                        executions=self.executions)
+            return result
+        first.on_success = on_success
+        timer = threading.Timer(0.3, api.set_cancel_request)
+        timer.daemon = True
+        timer.start()
+        self.assertRaises(api.ExecutionCancelled, graph.execute)
+        self.assertEqual(['task0'], [name for name, _ in self.executions])
+        api.cancel_request = False
+
+        del self.executions[:]
+        self._graph([0, 0]).execute()
+        self.assertEqual(['task0', 'task1'],
+                         [name for name, _ in self.executions])
+
+    def test_remove(self):
+        graph = self._graph([0])
+        graph.execute()
+        graph.remove_checkpoint()
+        self.assertFalse(os.path.exists(self.path))
+        graph.remove_checkpoint()
+
+    def test_load_ignores_partial_record(self):
+        graph = self._graph([0])
+        graph.execute()
+        with open(self.path, 'a') as f:
+            f.write('{"type": "state", "id"')
+        self.assertEqual(1, len(checkpoint.load(self.path).tasks))
+
+    def test_batched_sync(self):
+        log = checkpoint.CheckpointLog(self.path,
+                                       sync_interval=60,
+                                       sync_batch_size=3)
+        task = _Task(self.ctx)
+        with mock.patch('os.fsync') as fsync:
+            for _ in range(7):
+                log.state(task)
+            self.assertEqual(2, fsync.call_count)
+            log.close()
+            self.assertEqual(3, fsync.call_count)
+        with open(self.path) as f:
+            self.assertEqual(7, len(f.readlines()))
@@ -0,0 +1,148 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import copy
+import json
+import pickle
+from collections import OrderedDict
+
+import testtools
+import yaml
+
+from cloudify.workflows.copy_on_write import (CopyOnWriteDict,
+                                              CopyOnWriteList,
+                                              copy_on_write_values)
+
+
+def _inputs():
+    return {
+        'user_data': 'x' * 100,
+        'properties': {'ports': [80, 443], 'tags': {'env': 'test'}},
+        'servers': [{'name': 'a'}, {'name': 'b'}]
+    }
+
+
+class CopyOnWriteTest(testtools.TestCase):
+
+    def test_nested_values_shared_until_read(self):
+        inputs = _inputs()
+        kwargs = CopyOnWriteDict(inputs)
+        self.assertIs(inputs['properties'],
+                      dict.__getitem__(kwargs, 'properties'))
+        properties = kwargs['properties']
+        self.assertIsNot(inputs['properties'], properties)
+        # only the level that was read is copied
+        self.assertIs(inputs['properties']['tags'],
+                      dict.__getitem__(properties, 'tags'))
+        # and it is only copied once
+        self.assertIs(properties, kwargs['properties'])
+
+    def test_mutations_do_not_leak(self):
+        inputs = _inputs()
+        expected = copy.deepcopy(inputs)
+        kwargs = CopyOnWriteDict(inputs)
+        kwargs['properties']['ports'].append(8080)
+        kwargs['properties']['tags']['env'] = 'prod'
+        kwargs.get('servers')[0]['name'] = 'c'
+        for _, value in kwargs.iteritems():
+            if isinstance(value, dict):
+                value.clear()
+        kwargs['user_data'] = 'y'
+        kwargs.pop('servers')
+        self.assertEqual(expected, inputs)
+
+    def test_copies_of_copies_do_not_leak(self):
+        inputs = _inputs()
+        kwargs = CopyOnWriteDict(inputs)
+        kwargs['properties']['tags']['env'] = 'prod'
+        other = CopyOnWriteDict(kwargs)
+        other['properties']['tags']['env'] = 'dev'
+        kwargs.copy()['properties']['ports'].append(22)
+        self.assertEqual('prod', kwargs['properties']['tags']['env'])
+        self.assertEqual([80, 443], kwargs['properties']['ports'])
+        self.assertEqual('test', inputs['properties']['tags']['env'])
+
+    def test_views_do_not_leak(self):
+        inputs = _inputs()
+        kwargs = CopyOnWriteDict(inputs)
+        for _, value in kwargs.viewitems():
+            if isinstance(value, dict):
+                value['tags']['env'] = 'prod'
+        for value in kwargs.viewvalues():
+            if isinstance(value, list):
+                value[0]['name'] = 'c'
+        self.assertEqual(_inputs(), inputs)
+
+    def test_unpacked_values_do_not_leak(self):
+        inputs = _inputs()
+
+        def operation(properties, servers, **_):
+            properties['tags']['env'] = 'prod'
+            properties['ports'].append(8080)
+            servers[0]['name'] = 'c'
+            servers.append({'name': 'd'})
+
+        def local_task(**kwargs):
+            # as in local dispatch, the kwargs of the task were unpacked to
+            # get here and are wrapped before they are passed on
+            operation(**copy_on_write_values(kwargs))
+        local_task(**CopyOnWriteDict(inputs))
+        self.assertEqual(_inputs(), inputs)
+
+    def test_set_values_are_not_copied(self):
+        kwargs = CopyOnWriteDict(_inputs())
+        value = {'a': 1}
+        kwargs['new'] = value
+        kwargs.update(other=value)
+        self.assertIs(value, kwargs['new'])
+        self.assertIs(value, kwargs['other'])
+        self.assertIs(value, kwargs.setdefault('new', {}))
+
+    def test_other_mapping_types_are_shared(self):
+        ordered = OrderedDict(a=1)
+        kwargs = CopyOnWriteDict(ordered=ordered)
+        self.assertIs(ordered, kwargs['ordered'])
+
+    def test_plain_containers(self):
+        inputs = _inputs()
+        kwargs = CopyOnWriteDict(inputs)
+        kwargs['properties']['ports']
+        self.assertEqual(inputs, kwargs)
+        self.assertEqual(inputs, json.loads(json.dumps(kwargs)))
+        self.assertEqual(inputs, yaml.safe_load(yaml.safe_dump(kwargs)))
+        for materialized in (copy.deepcopy(kwargs),
+                             pickle.loads(pickle.dumps(kwargs)),
+                             pickle.loads(pickle.dumps(kwargs, 2))):
+            self.assertEqual(inputs, materialized)
+            self.assertIs(dict, type(materialized))
+            self.assertIs(dict, type(materialized['properties']))
+            self.assertIs(list, type(materialized['servers']))
+
+    def test_list_items(self):
+        servers = [{'name': 'a'}, ['b']]
+        copied = CopyOnWriteList(servers)
+        copied[0]['name'] = 'c'
+        copied[1].append('d')
+        copied.append('e')
+        self.assertEqual([{'name': 'a'}, ['b']], servers)
+
+    def test_copy_on_write_values(self):
+        inputs = _inputs()
+        kwargs = copy_on_write_values(CopyOnWriteDict(inputs))
+        self.assertIs(dict, type(kwargs))
+        self.assertIsInstance(kwargs['properties'], CopyOnWriteDict)
+        self.assertIsInstance(kwargs['servers'], CopyOnWriteList)
+        kwargs['properties']['ports'].append(8080)
+        self.assertEqual([80, 443], inputs['properties']['ports'])
@@ -0,0 +1,193 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import Queue
+import threading
+import time
+
+import mock
+import testtools
+
+from cloudify.state import current_workflow_ctx
+from cloudify.workflows import api
+from cloudify.workflows import events
+from cloudify.workflows import tasks
+from cloudify.workflows import workflow_context
+from cloudify.workflows.workflow_context import (_DeploymentsFanOut,
+                                                 _SharedLocalTasksProcessing)
+
+
+class _Thread(threading.Thread):
+    """Stands for an AMQPWrappedThread, without connecting to AMQP"""
+
+    def __init__(self, *args, **kwargs):
+        super(_Thread, self).__init__(*args, **kwargs)
+        self.daemon = True
+        self.started_amqp_client = Queue.Queue()
+        self.started_amqp_client.put(True)
+
+
+class _DeploymentContext(object):
+
+    def __init__(self, ctx, fan_out):
+        self.deployment_id = ctx['deployment_id']
+        self.fan_out = fan_out
+        self.entered = False
+        self.task_graph = mock.Mock()
+
+    def __enter__(self):
+        self.entered = True
+        self.fan_out.event_monitor.add_tasks_graph(self.task_graph)
+
+    def __exit__(self, *args):
+        self.fan_out.event_monitor.remove_tasks_graph(self.task_graph)
+        self.entered = False
+
+
+class DeploymentsFanOutTest(testtools.TestCase):
+
+    def setUp(self):
+        super(DeploymentsFanOutTest, self).setUp()
+        self.client = mock.Mock()
+        for patcher in (
+                mock.patch.object(workflow_context, 'get_rest_client',
+                                  return_value=self.client),
+                mock.patch.object(workflow_context, 'AMQPWrappedThread',
+                                  _Thread)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, api, 'cancel_request', False)
+        self.workflow_ctx = mock.Mock(local=False,
+                                      _local_task_thread_pool_size=1,
+                                      _ManagedCloudifyWorkflowContext=(
+                                          _DeploymentContext))
+        self.workflow_ctx._deployment_context.side_effect = \
+            lambda deployment_id, blueprint_id: {
+                'deployment_id': deployment_id, 'blueprint_id': blueprint_id}
+        self.monitor = events.Monitor(mock.Mock())
+        self.workflow_ctx.internal._event_monitor = self.monitor
+
+    def _run(self, func, deployments, concurrency=3, prefetch=2):
+        return _DeploymentsFanOut(self.workflow_ctx, func, deployments,
+                                  concurrency, prefetch).run()
+
+    def test_results_and_failures(self):
+        def func(dep_ctx):
+            self.assertTrue(dep_ctx.entered)
+            self.assertIs(dep_ctx, current_workflow_ctx.get_ctx())
+            self.assertIn(dep_ctx.task_graph,
+                          self.monitor._shared_tasks_graphs)
+            if dep_ctx.deployment_id == 'd3':
+                raise RuntimeError('failed')
+            return dep_ctx.deployment_id.upper()
+        deployments = [('d{0}'.format(i), 'b') for i in range(6)]
+        result = self._run(func, deployments)
+        self.assertEqual(dict((d, d.upper()) for d, _ in deployments
+                              if d != 'd3'), result.results)
+        self.assertEqual(['d3'], result.failures.keys())
+        self.assertIsInstance(result.failures['d3'], RuntimeError)
+        self.assertFalse(result.succeeded)
+        self.assertEqual([], self.monitor._shared_tasks_graphs)
+
+    def test_bounded_concurrency(self):
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def func(dep_ctx):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+        result = self._run(func, [('d{0}'.format(i), 'b') for i in range(12)],
+                           concurrency=3)
+        self.assertTrue(result.succeeded)
+        self.assertEqual(12, len(result.results))
+        self.assertTrue(1 < max_running[0] <= 3)
+
+    def test_blueprint_ids_loaded(self):
+        self.client.deployments.get.return_value = mock.Mock(
+            blueprint_id='b1')
+        self._run(lambda dep_ctx: None, [('d1', None)])
+        self.client.deployments.get.assert_called_once_with(
+            'd1', _include=['id', 'blueprint_id'])
+        self.workflow_ctx._deployment_context.assert_called_once_with(
+            'd1', 'b1')
+
+    def test_load_failure(self):
+        self.client.deployments.get.side_effect = RuntimeError('not found')
+        func = mock.Mock()
+        result = self._run(func, [('d1', None)])
+        self.assertFalse(func.called)
+        self.assertEqual(['d1'], result.failures.keys())
+
+    def test_cancelled(self):
+        def func(dep_ctx):
+            api.cancel_request = True
+        result = self._run(func, [('d{0}'.format(i), 'b') for i in range(5)],
+                           concurrency=1, prefetch=1)
+        self.assertEqual(['d0'], result.results.keys())
+        self.assertEqual(4, len(result.failures))
+        for error in result.failures.values():
+            self.assertIsInstance(error, api.ExecutionCancelled)
+
+
+class SharedLocalTasksTest(testtools.TestCase):
+
+    def test_tasks_run_in_their_context(self):
+        processing = _SharedLocalTasksProcessing(mock.Mock(local=True),
+                                                 thread_pool_size=2)
+        self.addCleanup(processing.stop)
+        processing.start()
+        contexts = {}
+        workflow_tasks = []
+        for name in ('ctx_1', 'ctx_2'):
+            dep_ctx = mock.Mock()
+            dep_ctx.internal.add_local_task = processing.add_task
+            dep_ctx.internal.run_local_task = processing.run
+
+            def local_task(name=name):
+                contexts[name] = current_workflow_ctx.get_ctx()
+                return name
+            task = tasks.LocalWorkflowTask(local_task, dep_ctx,
+                                           name=name)
+            with current_workflow_ctx.push(dep_ctx):
+                result = task.apply_async()
+            workflow_tasks.append((task, result, dep_ctx))
+        for task, result, dep_ctx in workflow_tasks:
+            task.wait_for_terminated(timeout=5)
+            self.assertEqual(tasks.TASK_SUCCEEDED, task.get_state())
+            self.assertEqual(task._name, result.get())
+            self.assertIs(dep_ctx, contexts[task._name])
+
+
+class SharedMonitorTest(testtools.TestCase):
+
+    def test_events_of_added_graphs(self):
+        graph = mock.Mock()
+        graph.get_task.return_value = None
+        other_graph = mock.Mock()
+        monitor = events.Monitor(graph)
+        monitor.add_tasks_graph(other_graph)
+        task = other_graph.get_task.return_value
+        monitor.task_failed({'uuid': 'task_1', 'exception': 'Error'})
+        other_graph.get_task.assert_called_once_with('task_1')
+        task.set_state.assert_called_once_with('failed')
+
+        monitor.remove_tasks_graph(other_graph)
+        monitor.task_failed({'uuid': 'task_1', 'exception': 'Error'})
+        self.assertEqual(1, task.set_state.call_count)
@@ -15,6 +15,7 @@
 
 import sys
 import os
+import Queue
 import tempfile
 import shutil
 import logging
@@ -24,10 +25,14 @@ import testtools
 
 from cloudify import amqp_client
 from cloudify import dispatch
+from cloudify import dispatch_workers
 from cloudify import exceptions
 from cloudify import utils
 from cloudify.celery import logging_server
+from cloudify.workflows import api
+from cloudify.workflows import cancellation
 from cloudify_rest_client.exceptions import InvalidExecutionUpdateStatus
+from cloudify_rest_client.executions import Execution
 
 
 class TestDispatchTaskHandler(testtools.TestCase):
@@ -308,6 +313,221 @@ def func8(message):
     raise RuntimeError(message)
 
 
+def func9():
+    return os.getpid(), os.getppid()
+
+
+class TestRemoteWorkflowCancellation(testtools.TestCase):
+
+    def setUp(self):
+        super(TestRemoteWorkflowCancellation, self).setUp()
+        self.channel = cancellation.LocalCancellationChannel()
+        cancellation.set_channel(self.channel)
+        self.addCleanup(cancellation.set_channel, None)
+        self.addCleanup(setattr, api, 'cancel_request', False)
+        self.handler = dispatch.WorkflowHandler(
+            cloudify_context={'task_name': 'test'}, args=(), kwargs={})
+        self.handler._ctx = Mock(execution_id='execution_1')
+        self.rest = Mock()
+        self.queue = Queue.Queue()
+
+    def _wait(self, subscribed=True):
+        return self.handler._wait_for_remote_workflow(
+            self.rest, self.queue, subscribed=subscribed)
+
+    def test_pushed_cancel_requests(self):
+        subscription = self.handler._subscribe_to_cancel_requests(self.queue)
+        self.addCleanup(subscription.close)
+        self.channel.publish('execution_1', Execution.CANCELLING)
+        self.channel.publish('execution_2', Execution.FORCE_CANCELLING)
+        self.queue.put({'result': 'the result'})
+        self.assertEqual('the result', self._wait())
+        self.assertTrue(api.has_cancel_request())
+
+        self.channel.publish('execution_1', Execution.FORCE_CANCELLING)
+        self.assertEqual(api.EXECUTION_CANCELLED_RESULT, self._wait())
+        self.assertFalse(self.rest.executions.get.called)
+
+    def test_subscription_closed(self):
+        subscription = self.handler._subscribe_to_cancel_requests(self.queue)
+        subscription.close()
+        self.channel.publish('execution_1', Execution.CANCELLING)
+        self.assertTrue(self.queue.empty())
+
+    def test_no_channel(self):
+        cancellation.set_channel(None)
+        with patch.dict('os.environ', clear=True):
+            self.assertIsNone(
+                self.handler._subscribe_to_cancel_requests(self.queue))
+
+    def test_subscription_failure(self):
+        channel = Mock()
+        channel.subscribe.side_effect = RuntimeError('no broker')
+        cancellation.set_channel(channel)
+        self.assertIsNone(
+            self.handler._subscribe_to_cancel_requests(self.queue))
+
+    @patch('cloudify.dispatch.cancellation.poll_interval', return_value=0.01)
+    def test_execution_status_polled(self, poll_interval):
+        self.rest.executions.get.side_effect = [
+            Mock(status=Execution.STARTED),
+            Mock(status=Execution.FORCE_CANCELLING)]
+        self.assertEqual(api.EXECUTION_CANCELLED_RESULT,
+                         self._wait(subscribed=False))
+        self.rest.executions.get.assert_called_with('execution_1',
+                                                    _include=['status'])
+        self.assertEqual((False, False), poll_interval.call_args[0][1:])
+
+    @patch('cloudify.dispatch.cancellation.poll_interval', return_value=0.01)
+    def test_polled_less_once_pushed(self, poll_interval):
+        subscription = self.handler._subscribe_to_cancel_requests(self.queue)
+        self.addCleanup(subscription.close)
+
+        def push_cancel_request(*_, **__):
+            self.channel.publish('execution_1', Execution.CANCELLING)
+            self.queue.put({'result': 'the result'})
+            return Mock(status=Execution.STARTED)
+        self.rest.executions.get.side_effect = push_cancel_request
+        self.assertEqual('the result', self._wait())
+        # subscribed, but not capped at the maximum interval of pushed
+        # requests until one was received
+        self.assertEqual([(True, False), (True, False), (True, True)],
+                         [c[0][1:] for c in poll_interval.call_args_list])
+
+    def test_child_thread_error(self):
+        self.queue.put({'error': {'message': 'failed',
+                                  'type': 'RuntimeError',
+                                  'traceback': 'traceback'}})
+        self.assertRaises(exceptions.ProcessExecutionError, self._wait)
+
+
+class TestWorkflowCheckpoint(testtools.TestCase):
+
+    def _handler(self, func):
+        handler = dispatch.WorkflowHandler(
+            cloudify_context={'task_name': 'test'}, args=(), kwargs={})
+        handler._func = func
+        handler._ctx = Mock()
+        handler._ctx.internal.graph_mode = True
+        return handler
+
+    def test_removed_on_success(self):
+        handler = self._handler(Mock(return_value='result'))
+        self.assertEqual('result', handler._execute_workflow_function())
+        remove_checkpoint = handler.ctx.internal.task_graph.remove_checkpoint
+        remove_checkpoint.assert_called_once_with()
+
+    def test_kept_on_failure(self):
+        handler = self._handler(Mock(side_effect=RuntimeError('failed')))
+        self.assertRaises(RuntimeError, handler._execute_workflow_function)
+        self.assertFalse(
+            handler.ctx.internal.task_graph.remove_checkpoint.called)
+
+
+class TestDispatchWorkers(testtools.TestCase):
+
+    def _pool(self, **kwargs):
+        kwargs.setdefault('max_idle', 2)
+        pool = dispatch_workers.DispatchWorkerPool(
+            [sys.executable, dispatch.__file__.replace('.pyc', '.py')],
+            **kwargs)
+        self.addCleanup(pool.close)
+        patcher = patch('cloudify.dispatch.dispatch_workers_pool', pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return pool
+
+    def _run(self, func, **execution_env):
+        paths = [os.path.dirname(__file__)]
+        if 'PYTHONPATH' in execution_env:
+            paths.append(execution_env['PYTHONPATH'])
+        execution_env['PYTHONPATH'] = os.pathsep.join(paths)
+        return dispatch.OperationHandler(cloudify_context={
+            'no_ctx_kwarg': True,
+            'task_id': 'test',
+            'task_name': 'test_dispatch.{0}'.format(func.__name__),
+            'task_target': 'stub',
+            'type': 'operation',
+            'execution_env': execution_env
+        }, args=[], kwargs={}).dispatch_to_subprocess()
+
+    def test_tasks_run_in_forked_workers(self):
+        self._pool()
+        processes = [self._run(func9) for _ in range(3)]
+        # each task runs in its own process, forked from the same worker
+        self.assertEqual(1, len(set(ppid for _, ppid in processes)))
+        self.assertEqual(3, len(set(pid for pid, _ in processes)))
+        self.assertNotEqual(os.getpid(), processes[0][1])
+
+    def test_workers_by_environment(self):
+        pool = self._pool()
+        _, ppid_1 = self._run(func9, VAR='1')
+        _, ppid_2 = self._run(func9, VAR='2')
+        self.assertNotEqual(ppid_1, ppid_2)
+        self.assertEqual(2, len(pool._idle))
+        self.assertEqual(ppid_1, self._run(func9, VAR='1')[1])
+
+    def test_max_idle(self):
+        pool = self._pool(max_idle=1)
+        self._run(func9, VAR='1')
+        self._run(func9, VAR='2')
+        self.assertEqual(1, len(pool._idle))
+
+    def test_recycled_after_max_tasks(self):
+        pool = self._pool(max_tasks=2)
+        ppids = [self._run(func9)[1] for _ in range(3)]
+        self.assertEqual(ppids[0], ppids[1])
+        self.assertNotEqual(ppids[1], ppids[2])
+        self.assertEqual(1, pool._idle[0][1].tasks)
+
+    def test_recycled_on_memory_growth(self):
+        pool = self._pool(max_memory_growth=1)
+        worker = Mock(alive=True, tasks=1, initial_rss=1024, rss=3072)
+        pool._release('key', worker)
+        worker.stop.assert_called_once_with()
+        self.assertEqual([], pool._idle)
+
+    def test_task_error(self):
+        self._pool()
+        _, ppid = self._run(func9)
+        self.assertRaises(exceptions.RecoverableError, self._run, func8)
+        self.assertEqual(ppid, self._run(func9)[1])
+
+    def test_one_shot_fallback(self):
+        pool = self._pool()
+        with patch('cloudify.dispatch_workers.DispatchWorker',
+                   side_effect=dispatch_workers.DispatchWorkerError('down')):
+            pid, ppid = self._run(func9)
+        self.assertEqual(os.getpid(), ppid)
+        self.assertEqual([], pool._idle)
+
+    def test_disabled(self):
+        self._pool(max_idle=0)
+        self.assertEqual(os.getpid(), self._run(func9)[1])
+
+    def test_disabled_by_default(self):
+        with patch.dict('os.environ', clear=True):
+            pool = dispatch_workers.DispatchWorkerPool.from_environment(
+                [sys.executable])
+        self.assertFalse(pool.enabled)
+
+    def test_replaced_when_pythonpath_changes(self):
+        pool = self._pool()
+        plugin_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, plugin_dir)
+        _, ppid = self._run(func9, PYTHONPATH=plugin_dir)
+        self.assertEqual(ppid, self._run(func9, PYTHONPATH=plugin_dir)[1])
+        stale = pool._idle[0][1]
+
+        # e.g. the plugin was reinstalled
+        mtime = os.stat(plugin_dir).st_mtime
+        os.utime(plugin_dir, (mtime + 10, mtime + 10))
+        self.assertNotEqual(ppid, self._run(func9, PYTHONPATH=plugin_dir)[1])
+        self.assertEqual(1, len(pool._idle))
+        self.assertIsNot(stale, pool._idle[0][1])
+        self.assertIsNotNone(stale._process.poll())
+
+
 class UserException(Exception):
     pass
 
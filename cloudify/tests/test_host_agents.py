@@ -0,0 +1,94 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import mock
+import testtools
+
+from cloudify.workflows.workflow_context import RemoteContextHandler
+
+
+class HostAgentsCacheTest(testtools.TestCase):
+
+    def setUp(self):
+        super(HostAgentsCacheTest, self).setUp()
+        self.client = mock.Mock()
+        patcher = mock.patch(
+            'cloudify.workflows.workflow_context.get_rest_client',
+            return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = RemoteContextHandler(mock.Mock())
+
+    def _host(self, host_id, cloudify_agent=None):
+        runtime_properties = {}
+        if cloudify_agent is not None:
+            runtime_properties['cloudify_agent'] = cloudify_agent
+        return mock.Mock(id=host_id, runtime_properties=runtime_properties)
+
+    def test_cached(self):
+        agent = {'queue': 'host_1_queue', 'name': 'host_1_agent'}
+        self.client.node_instances.get.return_value = self._host('host_1',
+                                                                 agent)
+        self.assertEqual(agent, self.handler._get_host_agent('host_1'))
+        self.assertEqual(agent, self.handler._get_host_agent('host_1'))
+        self.client.node_instances.get.assert_called_once_with(
+            'host_1', _include=['runtime_properties'])
+
+    def test_missing_agent_not_cached(self):
+        self.client.node_instances.get.return_value = self._host('host_1')
+        self.assertEqual({}, self.handler._get_host_agent('host_1'))
+        self.handler._get_host_agent('host_1')
+        self.assertEqual(2, self.client.node_instances.get.call_count)
+
+    def test_invalidated_by_agent_operations(self):
+        self.client.node_instances.get.return_value = self._host(
+            'host_1', {'queue': 'q', 'name': 'n'})
+        self.handler._get_host_agent('host_1')
+        for operation in ('cloudify.interfaces.lifecycle.create',
+                          'cloudify.interfaces.cloudify_agent.start'):
+            self.handler.remote_task_terminated(mock.Mock(cloudify_context={
+                'node_id': 'host_1', 'operation': {'name': operation}}))
+            self.handler._get_host_agent('host_1')
+        self.assertEqual(2, self.client.node_instances.get.call_count)
+
+    def test_preload(self):
+        self.client.node_instances.list.side_effect = [
+            [self._host('host_1', {'queue': 'q1', 'name': 'n1'}),
+             self._host('host_2')]]
+        with mock.patch('cloudify.workflows.workflow_context.list_paginated',
+                        side_effect=lambda list_method, **kwargs:
+                        list_method(**kwargs)):
+            self.handler.preload_host_agents(['host_1', 'host_2'])
+        self.client.node_instances.list.assert_called_once_with(
+            id=['host_1', 'host_2'], _include=['id', 'runtime_properties'])
+        self.assertEqual({'queue': 'q1', 'name': 'n1'},
+                         self.handler._get_host_agent('host_1'))
+        self.assertFalse(self.client.node_instances.get.called)
+
+    def test_preloaded_on_first_lookup(self):
+        self.handler.set_deployment_hosts(['host_1', 'host_2'])
+        self.assertFalse(self.client.node_instances.list.called)
+        self.client.node_instances.list.side_effect = [
+            [self._host('host_1', {'queue': 'q1', 'name': 'n1'}),
+             self._host('host_2', {'queue': 'q2', 'name': 'n2'})]]
+        with mock.patch('cloudify.workflows.workflow_context.list_paginated',
+                        side_effect=lambda list_method, **kwargs:
+                        list_method(**kwargs)):
+            self.assertEqual({'queue': 'q2', 'name': 'n2'},
+                             self.handler._get_host_agent('host_2'))
+            self.assertEqual({'queue': 'q1', 'name': 'n1'},
+                             self.handler._get_host_agent('host_1'))
+        self.assertEqual(1, self.client.node_instances.list.call_count)
+        self.assertFalse(self.client.node_instances.get.called)
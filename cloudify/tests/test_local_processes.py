@@ -0,0 +1,79 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import os
+import pickle
+
+import testtools
+
+from cloudify import exceptions
+from cloudify.workflows import local_processes
+
+
+class _Storage(object):
+
+    def __init__(self):
+        self.instances = {'i': {'state': 'started'}}
+
+    def get_node_instance(self, node_instance_id):
+        if node_instance_id not in self.instances:
+            raise RuntimeError('Instance {0} does not exist'
+                               .format(node_instance_id))
+        return self.instances[node_instance_id]
+
+
+def _get_state(__cloudify_context):
+    storage = __cloudify_context['storage']
+    return os.getpid(), storage.get_node_instance('i')['state']
+
+
+def _raise_error():
+    raise exceptions.RecoverableError('error', retry_after=3)
+
+
+class LocalTaskProcessPoolTest(testtools.TestCase):
+
+    def setUp(self):
+        super(LocalTaskProcessPoolTest, self).setUp()
+        self.storage = _Storage()
+        self.pool = local_processes.LocalTaskProcessPool(
+            1, storage=self.storage)
+        self.pool.start()
+        self.addCleanup(self.pool.close)
+
+    def test_storage_proxy(self):
+        pid, state = self.pool.run(
+            _get_state, {'__cloudify_context': {'storage': self.storage}})
+        self.assertNotEqual(os.getpid(), pid)
+        self.assertEqual('started', state)
+
+    def test_storage_proxy_error(self):
+        proxy = pickle.loads(pickle.dumps(
+            self.pool._storage_server.proxy()))
+        self.assertRaises(RuntimeError, proxy.get_node_instance, 'missing')
+        self.assertRaises(AttributeError, getattr, proxy, 'init')
+
+    def test_error(self):
+        e = self.assertRaises(exceptions.RecoverableError,
+                              self.pool.run, _raise_error, {})
+        self.assertEqual(3, e.retry_after)
+        # the worker traceback is kept as a cause
+        self.assertIn('_raise_error', e.causes[-1]['traceback'])
+
+    def test_closures_run_in_the_calling_process(self):
+        def closure():
+            return os.getpid()
+        self.assertIsNone(local_processes.task_reference(closure))
+        self.assertEqual(os.getpid(), self.pool.run(closure, {}))
@@ -682,6 +682,40 @@ class LocalWorkflowTest(BaseWorkflowTest):
         self._execute_workflow(runtime_properties, operation_methods=[
             op0, op1])
 
+    def test_operation_descriptors_compiled_once(self):
+        def the_workflow(ctx, **_):
+            graph = ctx.graph_mode()
+            instance = _instance(ctx, 'node')
+            first = instance.execute_operation('test.op0', kwargs={'a': 1})
+            second = instance.execute_operation('test.op0', kwargs={'a': 2})
+            graph.sequence().add(first, second)
+            graph.execute()
+            self.assertEqual(1, len(ctx._operation_descriptors))
+            self.assertNotEqual(first.cloudify_context['task_id'],
+                                second.cloudify_context['task_id'])
+            self.assertIsNot(first.cloudify_context['operation'],
+                             second.cloudify_context['operation'])
+
+        def op0(ctx, a, **_):
+            self.assertEqual('test.op0', ctx.operation.name)
+            self.assertEqual('p', ctx.plugin)
+            ctx.instance.runtime_properties.setdefault('a', []).append(a)
+
+        self._execute_workflow(the_workflow, operation_methods=[op0])
+
+    def test_workflow_node_instance_runtime_properties(self):
+        def runtime_properties(ctx, **_):
+            instance = _instance(ctx, 'node')
+            instance.execute_operation('test.op0').get()
+            # as if loaded without runtime properties, read on first access
+            instance._node_instance['runtime_properties'] = None
+            self.assertEqual({'key': 'value'}, instance.runtime_properties)
+
+        def op0(ctx, **_):
+            ctx.instance.runtime_properties['key'] = 'value'
+
+        self._execute_workflow(runtime_properties, operation_methods=[op0])
+
     def test_operation_related_properties(self):
         def the_workflow(ctx, **_):
             instance = _instance(ctx, 'node')
@@ -1412,6 +1446,31 @@ class LocalWorkflowEnvironmentTest(BaseWorkflowTest):
             execute_kwargs={'task_thread_pool_size': default_size + 1},
             use_existing_env=False)
 
+    def test_local_task_process_pool(self):
+        def op(ctx, **_):
+            ctx.instance.runtime_properties['pid'] = os.getpid()
+            if ctx.operation.retry_number == 0:
+                return ctx.operation.retry('retry', retry_after=0)
+
+        def flow(ctx, **_):
+            instance = _instance(ctx, 'node')
+            instance.execute_operation('test.op0').get()
+            instance.set_state('started').get()
+
+        self._execute_workflow(
+            flow,
+            operation_methods=[op],
+            execute_kwargs={'task_process_pool_size': 2,
+                            'task_retries': 1,
+                            'task_retry_interval': 0},
+            use_existing_env=False)
+        instance = self.env.storage.get_node_instance(
+            self.env.storage.get_node_instances(node_id='node')[0].id)
+        # the operation ran in a worker process and updated the storage of
+        # this process
+        self.assertNotEqual(os.getpid(), instance.runtime_properties['pid'])
+        self.assertEqual('started', instance.state)
+
     def test_no_operation_module(self):
         self._no_module_or_attribute_test(
             is_missing_module=True,
@@ -1514,6 +1573,63 @@ class LocalWorkflowEnvironmentTest(BaseWorkflowTest):
             create_blueprint_func=self._blueprint_3
         )
 
+    def test_node_instance_indexes(self):
+        def check_indexes(ctx, **_):
+            node_host = _instance(ctx, 'node_host')
+            node2 = _instance(ctx, 'node2')
+
+            self.assertEqual([node2], ctx.get_node_instances_by_node('node2'))
+            self.assertEqual([], ctx.get_node_instances_by_node('missing'))
+            self.assertEqual(set(ctx.node_instances),
+                             set(ctx.get_node_instances_by_type('type')))
+            self.assertEqual([], ctx.get_node_instances_by_type('missing'))
+            self.assertEqual([], ctx.get_node_instances_by_host('node_host'))
+            self.assertTrue(node2.node.is_derived_from('type'))
+            self.assertFalse(node2.node.is_derived_from('missing'))
+            relationship = next(node2.node.relationships)
+            self.assertTrue(relationship.is_derived_from(
+                'cloudify.relationships.contained_in'))
+
+            # the subgraphs of contained instances are computed once
+            subgraph = ctx.get_contained_subgraph(node_host)
+            self.assertIs(subgraph, ctx.get_contained_subgraph(node_host))
+            self.assertIs(ctx.get_contained_subgraph(node2),
+                          ctx.get_contained_subgraph(node2))
+            self.assertEqual(set(subgraph), node_host.get_contained_subgraph())
+
+        self._execute_workflow(
+            check_indexes,
+            create_blueprint_func=self._blueprint_3
+        )
+
+    def test_node_instance_host_index(self):
+        def check_host_index(ctx, **_):
+            node_host = _instance(ctx, 'node_host')
+            hosted = [_instance(ctx, name) for name in
+                      ('node_host', 'node', 'node2', 'node3', 'node4')]
+            outside_node = _instance(ctx, 'outside_node')
+
+            self.assertEqual(node_host.id,
+                             _instance(ctx, 'node4')._node_instance.host_id)
+            self.assertIsNone(outside_node._node_instance.host_id)
+            self.assertEqual(
+                set(hosted),
+                set(ctx.get_node_instances_by_host(node_host.id)))
+            self.assertEqual([],
+                             ctx.get_node_instances_by_host(outside_node.id))
+            self.assertEqual(set(hosted),
+                             ctx.get_contained_subgraph(node_host))
+            self.assertEqual(
+                set([_instance(ctx, 'node2'), _instance(ctx, 'node')]),
+                ctx.get_contained_subgraph(_instance(ctx, 'node2')))
+            self.assertEqual(set([outside_node]),
+                             ctx.get_contained_subgraph(outside_node))
+
+        self._execute_workflow(
+            check_host_index,
+            create_blueprint_func=self._blueprint_4
+        )
+
     def _no_module_or_attribute_test(self, is_missing_module, test_type):
         try:
             self._execute_workflow(
@@ -1663,6 +1779,16 @@ class LocalWorkflowEnvironmentTest(BaseWorkflowTest):
         }
         return blueprint
 
+    def _blueprint_4(self, *args):
+        # the nodes of blueprint 3, with node_host as their host
+        blueprint = self._blueprint_3(*args)
+        blueprint['node_types']['cloudify.nodes.Compute'] = {
+            'derived_from': 'type'
+        }
+        blueprint['node_templates']['node_host']['type'] = \
+            'cloudify.nodes.Compute'
+        return blueprint
+
 
 def _instance(ctx, node_name):
     return next(ctx.get_node(node_name).instances)
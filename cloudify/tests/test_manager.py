@@ -0,0 +1,102 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import mock
+import testtools
+from cloudify_rest_client.responses import ListResponse
+
+from cloudify import manager
+
+
+def _list_method(items):
+    def list_method(_offset, _size, **kwargs):
+        page = items[_offset:_offset + _size]
+        return ListResponse(page, {'pagination': {'offset': _offset,
+                                                  'size': _size,
+                                                  'total': len(items)}})
+    return mock.Mock(side_effect=list_method)
+
+
+class ListPaginatedTest(testtools.TestCase):
+
+    def test_pages(self):
+        items = range(25)
+        list_method = _list_method(items)
+        self.assertEqual(items, list(manager.list_paginated(
+            list_method, page_size=10, deployment_id='d', _include=['id'])))
+        self.assertEqual(
+            [mock.call(_offset=offset, _size=10, deployment_id='d',
+                       _include=['id'])
+             for offset in (0, 10, 20)],
+            list_method.call_args_list)
+
+    def test_exact_pages(self):
+        list_method = _list_method(range(20))
+        self.assertEqual(20, len(list(manager.list_paginated(
+            list_method, page_size=10))))
+        self.assertEqual(2, list_method.call_count)
+
+    def test_empty(self):
+        list_method = _list_method([])
+        self.assertEqual([], list(manager.list_paginated(list_method)))
+        self.assertEqual(1, list_method.call_count)
+
+    def test_without_pagination_metadata(self):
+        list_method = mock.Mock(
+            return_value=ListResponse([1, 2], {'pagination': {}}))
+        self.assertEqual([1, 2], list(manager.list_paginated(list_method)))
+        self.assertEqual(1, list_method.call_count)
+
+    def test_streamed(self):
+        list_method = _list_method(range(25))
+        items = manager.list_paginated(list_method, page_size=10)
+        next(items)
+        self.assertEqual(1, list_method.call_count)
+
+
+class ManagerContextCacheTest(testtools.TestCase):
+
+    def setUp(self):
+        super(ManagerContextCacheTest, self).setUp()
+        self.client = mock.Mock()
+        self.client.manager.get_context.return_value = {
+            'name': 'provider',
+            'context': {'cloudify': {'workflows': {'task_retries': 3}},
+                        'resources': {}}}
+        patcher = mock.patch('cloudify.manager.get_rest_client',
+                             return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        manager.invalidate_manager_context()
+        self.addCleanup(manager.invalidate_manager_context)
+
+    def test_shared(self):
+        stats = manager.manager_context_cache.stats()
+        self.assertEqual({'workflows': {'task_retries': 3}},
+                         manager.get_bootstrap_context())
+        self.assertIn('resources', manager.get_provider_context())
+        manager.get_bootstrap_context()['workflows']['task_retries'] = 0
+        self.assertEqual(3, manager.get_bootstrap_context()
+                         ['workflows']['task_retries'])
+        self.assertEqual(1, self.client.manager.get_context.call_count)
+        new_stats = manager.manager_context_cache.stats()
+        self.assertEqual(stats['misses'] + 1, new_stats['misses'])
+        self.assertEqual(stats['hits'] + 3, new_stats['hits'])
+
+    def test_invalidate(self):
+        manager.get_provider_context()
+        manager.invalidate_manager_context()
+        manager.get_provider_context()
+        self.assertEqual(2, self.client.manager.get_context.call_count)
@@ -0,0 +1,100 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import time
+
+import mock
+import testtools
+
+from cloudify import exceptions
+from cloudify.workflows import retry_policies
+from cloudify.workflows import tasks
+from cloudify.workflows.retry_policies import create_retry_policy
+from cloudify.tests.test_tasks_graph import _Task
+
+
+class _RetriedTask(_Task):
+
+    def _duplicate(self):
+        return _RetriedTask(self.workflow_context,
+                            retry_interval=self.retry_interval)
+
+
+class RetryPoliciesTest(testtools.TestCase):
+
+    def test_fixed(self):
+        policy = create_retry_policy(10)
+        self.assertIsInstance(policy, retry_policies.FixedRetryPolicy)
+        self.assertEqual([10, 10], [policy.delay(i) for i in (1, 5)])
+
+    def test_exponential(self):
+        policy = create_retry_policy({'type': 'exponential',
+                                      'interval': 2,
+                                      'factor': 3,
+                                      'max_interval': 50})
+        self.assertEqual([2, 6, 18, 50, 50],
+                         [policy.delay(i) for i in range(1, 6)])
+
+    def test_exponential_jitter(self):
+        policy = create_retry_policy({'type': 'exponential',
+                                      'interval': 2,
+                                      'jitter': True})
+        for _ in range(100):
+            self.assertTrue(0 <= policy.delay(3) <= 8)
+
+    def test_decorrelated_jitter(self):
+        policy = create_retry_policy({'type': 'decorrelated_jitter',
+                                      'interval': 1,
+                                      'max_interval': 20})
+        delay = None
+        delays = set()
+        for i in range(1, 50):
+            previous_delay = delay
+            delay = policy.delay(i, previous_delay)
+            self.assertGreaterEqual(delay, 1)
+            self.assertLessEqual(delay, min(20, 3 * (previous_delay or 1)))
+            delays.add(delay)
+        self.assertGreater(len(delays), 1)
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, create_retry_policy,
+                          {'type': 'unknown', 'interval': 1})
+        self.assertRaises(ValueError, create_retry_policy,
+                          {'type': 'fixed', 'interval': 1, 'factor': 2})
+
+    def test_duplicate_for_retry(self):
+        task = _RetriedTask(mock.Mock(),
+                            retry_interval={'type': 'exponential',
+                                            'interval': 10})
+        delays = []
+        for _ in range(3):
+            start = time.time()
+            task = task.duplicate_for_retry()
+            delays.append(task.retry_delay)
+            self.assertAlmostEqual(start + task.retry_delay,
+                                   task.execute_after, delta=1)
+        self.assertEqual([10, 20, 40], delays)
+        self.assertEqual(3, task.current_retries)
+
+    def test_retry_after_overrides_policy(self):
+        task = _RetriedTask(mock.Mock(), retry_interval=30)
+        task.set_state(tasks.TASK_FAILED)
+        task.async_result = mock.Mock()
+        task.async_result.result = exceptions.RecoverableError(
+            retry_after=5)
+        handler_result = task.handle_task_terminated()
+        self.assertEqual(5, handler_result.retry_after)
+        self.assertAlmostEqual(5, handler_result.retried_task.retry_delay,
+                               delta=1)
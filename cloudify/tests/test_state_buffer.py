@@ -0,0 +1,159 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import threading
+
+import mock
+import testtools
+from cloudify_rest_client.exceptions import CloudifyClientError
+
+from cloudify.workflows.state_buffer import NodeStateBuffer
+from cloudify.workflows.workflow_context import RemoteContextHandler
+
+
+class NodeStateBufferTest(testtools.TestCase):
+
+    def setUp(self):
+        super(NodeStateBufferTest, self).setUp()
+        self.written = []
+        self.buffer = NodeStateBuffer(
+            lambda *args: self.written.append(args), interval=0)
+
+    def test_coalesced(self):
+        for state in ('creating', 'created', 'configuring'):
+            self.buffer.set('node_1', state)
+        self.buffer.set('node_2', 'creating')
+        self.assertEqual('configuring', self.buffer.get('node_1'))
+        self.assertEqual([], self.written)
+        self.buffer.flush()
+        self.assertEqual([('node_1', 'configuring'), ('node_2', 'creating')],
+                         self.written)
+        self.assertIsNone(self.buffer.get('node_1'))
+        self.buffer.flush()
+        self.assertEqual(2, len(self.written))
+
+    def test_failed_write_retried(self):
+        write = mock.Mock(side_effect=[RuntimeError('down'), None, None])
+        state_buffer = NodeStateBuffer(write, interval=0)
+        state_buffer.set('node_1', 'creating')
+        state_buffer.set('node_2', 'creating')
+        self.assertRaises(RuntimeError, state_buffer.flush)
+        self.assertEqual('creating', state_buffer.get('node_1'))
+        self.assertIsNone(state_buffer.get('node_2'))
+        state_buffer.flush()
+        self.assertEqual(mock.call('node_1', 'creating'), write.call_args)
+
+    def test_failed_write_superseded(self):
+        state_buffer = NodeStateBuffer(None, interval=0)
+
+        def write(node_instance_id, state):
+            state_buffer.set(node_instance_id, 'created')
+            raise RuntimeError('down')
+        state_buffer._write = write
+        state_buffer.set('node_1', 'creating')
+        logger = state_buffer.logger = mock.Mock()
+        state_buffer.try_flush()
+        self.assertEqual(1, logger.warning.call_count)
+        self.assertEqual('created', state_buffer.get('node_1'))
+
+    def test_written_state_visible_until_written(self):
+        state_buffer = NodeStateBuffer(None, interval=0)
+        seen = []
+        state_buffer._write = lambda node_instance_id, state: seen.append(
+            state_buffer.get(node_instance_id))
+        state_buffer.set('node_1', 'creating')
+        state_buffer.flush()
+        self.assertEqual(['creating'], seen)
+        self.assertIsNone(state_buffer.get('node_1'))
+
+    def test_background_flush(self):
+        written = threading.Event()
+        state_buffer = NodeStateBuffer(lambda *_: written.set(),
+                                       interval=0.01)
+        self.addCleanup(state_buffer.close)
+        state_buffer.set('node_1', 'creating')
+        written.wait(5)
+        self.assertTrue(written.is_set())
+        state_buffer.close()
+        self.assertIsNone(state_buffer._thread)
+
+
+class RemoteNodeStatesTest(testtools.TestCase):
+
+    def setUp(self):
+        super(RemoteNodeStatesTest, self).setUp()
+        self.client = mock.Mock()
+        self.client.node_instances.update.side_effect = \
+            lambda node_instance_id, state, version: mock.Mock(
+                version=version + 1)
+        patcher = mock.patch(
+            'cloudify.workflows.workflow_context.get_rest_client',
+            return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = RemoteContextHandler(mock.Mock())
+        self.addCleanup(self.handler.close)
+        self.instance = mock.Mock(id='node_1')
+        self.instance._node_instance = {'version': 3}
+
+    def _set_state(self, state):
+        self.handler.get_set_state_task(self.instance, state)()
+
+    def test_written_behind(self):
+        self._set_state('creating')
+        self._set_state('created')
+        self.assertEqual(
+            'created', self.handler.get_get_state_task(self.instance)())
+        self.assertFalse(self.client.node_instances.update.called)
+        self.handler.flush_node_states()
+        self.handler.flush_node_states()
+        self.client.node_instances.update.assert_called_once_with(
+            'node_1', state='created', version=3)
+        self.assertFalse(self.client.node_instances.get.called)
+
+        # the version returned by the update is used for the next one
+        self._set_state('configuring')
+        self.handler.close()
+        self.assertEqual(
+            mock.call('node_1', state='configuring', version=4),
+            self.client.node_instances.update.call_args)
+
+    def test_version_read_after_operation(self):
+        client = self.client.node_instances
+        client.get.return_value = mock.Mock(version=9)
+        self._set_state('creating')
+        self.handler.flush_node_states(raise_errors=True)
+        # e.g. the operation updated the runtime properties of the instance
+        self.handler.remote_task_terminated(mock.Mock(
+            cloudify_context={'node_id': 'node_1',
+                              'operation': {'name': 'create'}}))
+        self._set_state('created')
+        self.handler.flush_node_states(raise_errors=True)
+        self.assertEqual(1, client.get.call_count)
+        self.assertEqual(2, client.update.call_count)
+        self.assertEqual(mock.call('node_1', state='created', version=9),
+                         client.update.call_args)
+
+    def test_version_conflict(self):
+        update = self.client.node_instances.update
+        update.side_effect = [
+            CloudifyClientError('conflict', status_code=409),
+            mock.Mock(version=8)]
+        self.client.node_instances.get.return_value = mock.Mock(version=7)
+        self._set_state('creating')
+        self.handler.flush_node_states(raise_errors=True)
+        self.assertEqual(mock.call('node_1', state='creating', version=7),
+                         update.call_args)
+        self.assertEqual(8, self.handler._node_versions['node_1'])
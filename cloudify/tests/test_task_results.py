@@ -0,0 +1,107 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import threading
+import time
+
+import mock
+import testtools
+
+from cloudify.workflows import api
+from cloudify.workflows import tasks
+from cloudify.tests.test_tasks_graph import _Task
+
+
+class WorkflowTaskResultTest(testtools.TestCase):
+
+    def setUp(self):
+        super(WorkflowTaskResultTest, self).setUp()
+        self.ctx = mock.Mock()
+        self.ctx.internal.graph_mode = True
+        self.addCleanup(setattr, api, 'cancel_request', False)
+
+    def _result(self, duration, value=None):
+        task = _Task(self.ctx, duration=duration)
+        result = tasks.LocalWorkflowTaskResult(task)
+        result._holder.result = value
+        task.apply_async()
+        return result
+
+    def test_wait(self):
+        result = self._result(0.2)
+        self.assertFalse(result.wait(timeout=0.05))
+        self.assertFalse(result.done())
+        start = time.time()
+        self.assertTrue(result.wait())
+        self.assertTrue(result.done())
+        self.assertLess(time.time() - start, 0.4)
+
+    def test_wait_wakes_up_on_cancel_request(self):
+        result = self._result(None)
+        timer = threading.Timer(0.1, api.set_cancel_request)
+        timer.daemon = True
+        timer.start()
+        start = time.time()
+        self.assertRaises(api.ExecutionCancelled, result.wait)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_add_done_callback(self):
+        result = self._result(0.05)
+        done = threading.Event()
+        results = []
+
+        def callback(r):
+            results.append(r)
+            done.set()
+        result.add_done_callback(callback)
+        done.wait(1)
+        self.assertEqual([result], results)
+        # already done results call back right away
+        result.add_done_callback(results.append)
+        self.assertEqual([result, result], results)
+
+    def test_done_callbacks_called_once(self):
+        for _ in range(50):
+            task = _Task(self.ctx, duration=None)
+            calls = []
+            callbacks = [calls.append for _ in range(20)]
+            start = threading.Event()
+
+            def add_callbacks():
+                start.wait()
+                for callback in callbacks:
+                    task.add_done_callback(callback)
+            thread = threading.Thread(target=add_callbacks)
+            thread.daemon = True
+            thread.start()
+            start.set()
+            task.set_state(tasks.TASK_SUCCEEDED)
+            thread.join(5)
+            # terminated again, e.g. by a late task event
+            task.set_state(tasks.TASK_FAILED)
+            self.assertEqual(len(callbacks), len(calls))
+
+    def test_wait_any(self):
+        slow = self._result(1)
+        fast = self._result(0.05)
+        start = time.time()
+        self.assertEqual([fast], tasks.wait_any([slow, fast]))
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual([], tasks.wait_any([self._result(None)],
+                                            timeout=0.05))
+
+    def test_gather(self):
+        results = [self._result(0.05 * i, value=i) for i in range(3)]
+        self.assertEqual([0, 1, 2], tasks.gather(results))
@@ -0,0 +1,530 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import threading
+import time
+
+import mock
+import testtools
+
+from cloudify import exceptions
+from cloudify.workflows import api
+from cloudify.workflows import tasks
+from cloudify.workflows import graph_backends
+from cloudify.workflows import tasks_graph
+from cloudify.workflows.tasks_graph import (ConcurrencyLimits,
+                                            TaskDependencyGraph)
+
+
+class _Task(tasks.WorkflowTask):
+    """A task that terminates from another thread after `duration` seconds"""
+
+    def __init__(self, workflow_context, name='task', duration=0,
+                 executions=None, cloudify_context=None, running=None,
+                 **kwargs):
+        super(_Task, self).__init__(workflow_context, **kwargs)
+        self._name = name
+        self._cloudify_context = cloudify_context
+        self.duration = duration
+        self.executions = executions if executions is not None else []
+        self.running = running if running is not None else []
+
+    def apply_async(self):
+        self.set_state(tasks.TASK_SENT)
+        self.async_result = tasks.StubAsyncResult()
+        self.running.append(self)
+
+        def terminate():
+            self.running.remove(self)
+            self.executions.append((self._name, time.time()))
+            self.set_state(tasks.TASK_SUCCEEDED)
+        if self.duration is None:
+            return self.async_result
+        timer = threading.Timer(self.duration, terminate)
+        timer.daemon = True
+        timer.start()
+        return self.async_result
+
+    def is_local(self):
+        return True
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def cloudify_context(self):
+        return self._cloudify_context
+
+
+class TaskDependencyGraphExecuteTest(testtools.TestCase):
+
+    graph_backend = graph_backends.GRAPH_BACKEND_COMPACT
+
+    def setUp(self):
+        super(TaskDependencyGraphExecuteTest, self).setUp()
+        self.ctx = mock.Mock()
+        self.graph = TaskDependencyGraph(self.ctx,
+                                         graph_backend=self.graph_backend)
+        self.executions = []
+        self.addCleanup(setattr, api, 'cancel_request', False)
+
+    def _task(self, name, **kwargs):
+        return _Task(self.ctx, name=name, executions=self.executions,
+                     **kwargs)
+
+    def test_execute_order(self):
+        sequence = self.graph.sequence()
+        for i in range(5):
+            sequence.add(self._task(str(i)))
+        self.graph.execute()
+        self.assertEqual([str(i) for i in range(5)],
+                         [name for name, _ in self.executions])
+
+    def test_execute_wakes_up_on_state_change(self):
+        sequence = self.graph.sequence()
+        for i in range(30):
+            sequence.add(self._task(str(i)))
+        start = time.time()
+        self.graph.execute()
+        self.assertEqual(30, len(self.executions))
+        # a fixed polling interval would cost at least 0.1s per task
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_execute_wakes_up_when_retry_is_due(self):
+        delay = 0.3
+        task = self._task('delayed')
+        task.execute_after = time.time() + delay
+        self.graph.add_task(task)
+        start = time.time()
+        self.graph.execute()
+        elapsed = self.executions[0][1] - start
+        self.assertGreaterEqual(elapsed, delay - 0.05)
+        self.assertLess(elapsed, delay + 0.5)
+
+    def test_execute_delayed_tasks_when_due(self):
+        size = 20
+        start = time.time()
+        due = {}
+        for i in reversed(range(size)):
+            task = self._task(str(i))
+            task.execute_after = start + 0.02 * (i + 1)
+            due[task.name] = task.execute_after
+            self.graph.add_task(task)
+        original = self.graph._task_has_dependencies
+        with mock.patch.object(self.graph, '_task_has_dependencies',
+                               side_effect=original) as has_dependencies:
+            self.graph.execute()
+        self.assertEqual([str(i) for i in range(size)],
+                         [name for name, _ in self.executions])
+        for name, executed_at in self.executions:
+            self.assertGreaterEqual(executed_at, due[name])
+            self.assertLess(executed_at, due[name] + 0.3)
+        # tasks that are not due yet are not checked again on every pass
+        self.assertLess(has_dependencies.call_count, 3 * size)
+
+    def test_execute_wakes_up_on_cancel_request(self):
+        self.graph.add_task(self._task('never_terminates', duration=None))
+        timer = threading.Timer(0.2, api.set_cancel_request)
+        timer.daemon = True
+        timer.start()
+        start = time.time()
+        self.assertRaises(api.ExecutionCancelled, self.graph.execute)
+        self.assertLess(time.time() - start, 0.9)
+
+    def test_execute_only_checks_affected_tasks(self):
+        size = 50
+        sequence = self.graph.sequence()
+        for i in range(size):
+            sequence.add(self._task(str(i)))
+        original = self.graph._task_has_dependencies
+        with mock.patch.object(self.graph, '_task_has_dependencies',
+                               side_effect=original) as has_dependencies:
+            self.graph.execute()
+        self.assertEqual(size, len(self.executions))
+        # scanning every pending task on every pass is quadratic
+        self.assertLess(has_dependencies.call_count, 3 * size)
+
+    def test_execute_subgraph_dependencies(self):
+        first = self.graph.subgraph('first')
+        second = self.graph.subgraph('second')
+        for subgraph in (first, second):
+            sequence = subgraph.sequence()
+            for i in range(3):
+                sequence.add(self._task('{0}{1}'.format(subgraph.name, i)))
+        self.graph.add_dependency(second, first)
+        self.graph.execute()
+        self.assertEqual(['first0', 'first1', 'first2',
+                          'second0', 'second1', 'second2'],
+                         [name for name, _ in self.executions])
+
+    def test_sequence_forkjoin_barrier(self):
+        sequence = self.graph.sequence()
+        first = [self._task('a{0}'.format(i), duration=0.01 * i)
+                 for i in range(5)]
+        second = [self._task('b{0}'.format(i)) for i in range(5)]
+        sequence.add(tasks_graph.forkjoin(*first),
+                     tasks_graph.forkjoin(*second))
+        # 5 + 5 dependencies through a barrier instead of 5 * 5
+        self.assertEqual(10, len(list(self.graph.graph.edges_iter())))
+        self.graph.execute()
+        names = [name for name, _ in self.executions]
+        self.assertEqual(10, len(names))
+        self.assertEqual(set(t.name for t in first), set(names[:5]))
+
+    def test_sequence_small_forkjoin_without_barrier(self):
+        sequence = self.graph.sequence()
+        sequence.add(tasks_graph.forkjoin(self._task('a0'),
+                                          self._task('a1')),
+                     tasks_graph.forkjoin(self._task('b0'),
+                                          self._task('b1')))
+        self.assertEqual(4, len(list(self.graph.graph.edges_iter())))
+        self.assertEqual(4, len(list(self.graph.tasks_iter())))
+
+
+class ConcurrencyLimitsTest(testtools.TestCase):
+
+    def setUp(self):
+        super(ConcurrencyLimitsTest, self).setUp()
+        self.ctx = mock.Mock()
+        self.running = []
+        self.max_running = {}
+
+    def _graph(self, **limits):
+        return TaskDependencyGraph(self.ctx, concurrency_limits=limits)
+
+    def _task(self, name, operation='op', host_id='host', duration=0.05):
+        cloudify_context = None
+        if operation:
+            cloudify_context = {
+                'operation': {'name': operation},
+                'executor': 'host_agent',
+                'host_id': host_id
+            }
+        return _Task(self.ctx, name=name, duration=duration,
+                     cloudify_context=cloudify_context,
+                     running=self.running)
+
+    def _execute(self, graph):
+        def record_running(task):
+            for key in ('total', task.name[0]):
+                running = len([t for t in self.running
+                               if key == 'total' or t.name[0] == key])
+                self.max_running[key] = max(self.max_running.get(key, 0),
+                                            running)
+        original = graph._handle_executable_task
+
+        def handle_executable_task(task, *args):
+            original(task, *args)
+            record_running(task)
+        graph._handle_executable_task = handle_executable_task
+        graph.execute()
+
+    def test_total_limit(self):
+        graph = self._graph(total=2)
+        for i in range(6):
+            graph.add_task(self._task('a{0}'.format(i)))
+        self._execute(graph)
+        self.assertEqual(2, self.max_running['total'])
+        self.assertEqual({'total': 0, 'targets': {}, 'operations': {}},
+                         graph.concurrency.in_flight)
+
+    def test_per_operation_limit(self):
+        graph = self._graph(per_operation={'create': 1})
+        for i in range(3):
+            graph.add_task(self._task('a{0}'.format(i), operation='create'))
+            graph.add_task(self._task('b{0}'.format(i), operation='start'))
+        self._execute(graph)
+        self.assertEqual(1, self.max_running['a'])
+        self.assertEqual(3, self.max_running['b'])
+
+    def test_per_target_limit(self):
+        graph = self._graph(per_target=2)
+        for i in range(4):
+            graph.add_task(self._task('a{0}'.format(i), host_id='host_a'))
+            graph.add_task(self._task('b{0}'.format(i), host_id='host_b'))
+        self._execute(graph)
+        self.assertEqual(2, self.max_running['a'])
+        self.assertEqual(2, self.max_running['b'])
+        self.assertEqual(4, self.max_running['total'])
+
+    def test_non_operation_tasks_are_not_limited(self):
+        graph = self._graph(total=1)
+        graph.add_task(self._task('a', duration=0.2))
+        for i in range(3):
+            graph.add_task(self._task('b{0}'.format(i), operation=None))
+        self._execute(graph)
+        self.assertEqual(4, self.max_running['total'])
+
+    def test_in_flight_counts(self):
+        limits = ConcurrencyLimits(total=3, per_operation={'create': 1})
+        first = self._task('a0', operation='create')
+        second = self._task('a1', operation='create')
+        third = self._task('b0', operation='start', host_id='other')
+        self.assertTrue(limits.acquire(first))
+        self.assertFalse(limits.acquire(second))
+        self.assertTrue(limits.acquire(third))
+        self.assertTrue(limits.acquire(self._task('c', operation=None)))
+        self.assertEqual({'total': 2,
+                          'targets': {'host': 1, 'other': 1},
+                          'operations': {'create': 1, 'start': 1}},
+                         limits.in_flight)
+        self.assertTrue(limits.release(first))
+        self.assertFalse(limits.release(second))
+        self.assertTrue(limits.acquire(second))
+        self.assertEqual({'total': 2,
+                          'targets': {'host': 1, 'other': 1},
+                          'operations': {'create': 1, 'start': 1}},
+                         limits.in_flight)
+
+
+class CriticalPathSchedulingTest(testtools.TestCase):
+
+    def setUp(self):
+        super(CriticalPathSchedulingTest, self).setUp()
+        self.ctx = mock.Mock()
+        self.executions = []
+
+    def _graph(self, **kwargs):
+        kwargs.setdefault('scheduling', tasks_graph.SCHEDULING_CRITICAL_PATH)
+        # tasks executable when execution starts are sent in the order they
+        # were added, which the networkx backend does not keep
+        kwargs.setdefault('graph_backend',
+                          graph_backends.GRAPH_BACKEND_COMPACT)
+        return TaskDependencyGraph(self.ctx, **kwargs)
+
+    def _task(self, name, operation='op', duration=0):
+        return _Task(self.ctx, name=name, duration=duration,
+                     executions=self.executions,
+                     cloudify_context={'operation': {'name': operation}})
+
+    def _chain(self, graph, names, operation='op'):
+        sequence = graph.sequence()
+        chain = [self._task(name, operation) for name in names]
+        sequence.add(*chain)
+        return chain
+
+    def test_priority_counts_downstream_tasks(self):
+        graph = self._graph()
+        chain = self._chain(graph, ['a', 'b', 'c'])
+        single = self._task('d')
+        graph.add_task(single)
+        self.assertEqual([3, 2, 1], [graph._priority(t) for t in chain])
+        self.assertEqual(1, graph._priority(single))
+
+    def test_priority_uses_operation_durations(self):
+        graph = self._graph(operation_durations={'slow': 10, 'fast': 1})
+        short = self._chain(graph, ['a', 'b'], operation='slow')
+        long = self._chain(graph, ['c', 'd', 'e'], operation='fast')
+        self.assertEqual(20, graph._priority(short[0]))
+        self.assertEqual(3, graph._priority(long[0]))
+        # unknown operations are estimated by the average known duration
+        self.assertEqual(5.5, graph._priority(self._task('f', 'unknown')))
+
+    def test_priority_includes_containing_subgraph_dependents(self):
+        graph = self._graph()
+        subgraph = graph.subgraph('subgraph')
+        member = self._task('a')
+        subgraph.add_task(member)
+        dependent = self._task('b')
+        graph.add_task(dependent)
+        graph.add_dependency(dependent, subgraph)
+        self.assertEqual(2, graph._priority(member))
+
+    def test_critical_path_is_sent_first(self):
+        for scheduling, expected in (
+                (tasks_graph.SCHEDULING_FIFO, ['x0', 'x1', 'x2', 'a']),
+                (tasks_graph.SCHEDULING_CRITICAL_PATH,
+                 ['a', 'b', 'x0', 'x1'])):
+            del self.executions[:]
+            graph = self._graph(scheduling=scheduling,
+                                concurrency_limits={'total': 1})
+            for i in range(3):
+                graph.add_task(self._task('x{0}'.format(i)))
+            self._chain(graph, ['a', 'b', 'c'])
+            graph.execute()
+            self.assertEqual(expected,
+                             [name for name, _ in self.executions][:4])
+
+    def test_records_operation_durations(self):
+        graph = self._graph()
+        graph.add_task(self._task('a', operation='create', duration=0.1))
+        graph.execute()
+        self.assertGreaterEqual(
+            graph.operation_durations.as_dict()['create'], 0.1)
+
+    def test_unknown_scheduling(self):
+        self.assertRaises(ValueError, self._graph, scheduling='unknown')
+
+
+class RemoteTaskBatchingTest(testtools.TestCase):
+
+    def setUp(self):
+        super(RemoteTaskBatchingTest, self).setUp()
+        self.ctx = mock.Mock()
+        self.handler = self.ctx.internal.handler
+        self.handler.get_task.side_effect = self._get_task
+        self.handler.publish_tasks.side_effect = self._publish_tasks
+        self.published = []
+        self.subtasks = {}
+        for name in ('verify_worker_alive', 'worker_liveness'):
+            patcher = mock.patch('cloudify.workflows.tasks.{0}'.format(name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _get_task(self, workflow_task, queue=None, target=None):
+        queue = workflow_task.kwargs['queue']
+        if queue is None:
+            raise exceptions.NonRecoverableError('no queue')
+        task = mock.Mock()
+        self.subtasks[workflow_task.id] = task
+        return task, queue, queue
+
+    def _publish_tasks(self, queue_tasks):
+        self.published.append([task_id for task_id, _ in queue_tasks])
+        return [mock.Mock() for _ in queue_tasks]
+
+    def _task(self, queue):
+        cloudify_context = {'task_name': 'task'}
+        return tasks.RemoteWorkflowTask({'queue': queue}, cloudify_context,
+                                        self.ctx)
+
+    def test_send_remote_tasks_by_queue(self):
+        remote_tasks = [self._task(queue) for queue in ('a', 'b', 'a')]
+        tasks.send_remote_tasks(remote_tasks)
+        self.assertEqual([[remote_tasks[0].id, remote_tasks[2].id],
+                          [remote_tasks[1].id]], self.published)
+        for task in remote_tasks:
+            self.assertEqual(tasks.TASK_SENT, task.get_state())
+            self.assertIsInstance(task.async_result,
+                                  tasks.RemoteWorkflowTaskResult)
+        self.assertEqual(3, self.ctx.internal.send_task_event.call_count)
+
+    def test_send_remote_tasks_failed_task(self):
+        failed = self._task(None)
+        sent = self._task('a')
+        tasks.send_remote_tasks([failed, sent])
+        self.assertEqual([[sent.id]], self.published)
+        self.assertEqual(tasks.TASK_FAILED, failed.get_state())
+        self.assertIsInstance(failed.async_result,
+                              tasks.RemoteWorkflowErrorTaskResult)
+
+    def test_not_sent_when_node_states_not_written(self):
+        self.handler.flush_node_states.side_effect = RuntimeError('down')
+        task = self._task('a')
+        tasks.send_remote_tasks([task])
+        self.handler.flush_node_states.assert_called_once_with(
+            raise_errors=True)
+        self.assertEqual([], self.published)
+        self.assertFalse(self.ctx.internal.send_task_event.called)
+        self.assertEqual(tasks.TASK_FAILED, task.get_state())
+        self.assertIsInstance(task.async_result.exception,
+                              exceptions.RecoverableError)
+
+    def test_execute_sends_ready_tasks_together(self):
+        graph = TaskDependencyGraph(
+            self.ctx, graph_backend=graph_backends.GRAPH_BACKEND_COMPACT)
+        first = [self._task('a') for _ in range(3)]
+        last = self._task('a')
+        for task in first:
+            graph.add_task(task)
+        graph.add_task(last)
+        for task in first:
+            graph.add_dependency(last, task)
+
+        def publish_tasks(queue_tasks):
+            results = self._publish_tasks(queue_tasks)
+            for task_id, _ in queue_tasks:
+                graph.get_task(task_id).set_state(tasks.TASK_SUCCEEDED)
+            return results
+        self.handler.publish_tasks.side_effect = publish_tasks
+
+        def get_task(workflow_task, queue=None, target=None):
+            task = self._get_task(workflow_task, queue, target)
+            task[0].apply_async.side_effect = \
+                lambda task_id: workflow_task.set_state(tasks.TASK_SUCCEEDED)
+            return task
+        self.handler.get_task.side_effect = get_task
+        with mock.patch.object(tasks.RemoteWorkflowTask,
+                               'handle_task_terminated',
+                               return_value=tasks.HandlerResult.cont()):
+            graph.execute()
+        self.assertEqual([[task.id for task in first]], self.published)
+        # a single ready task is sent on its own
+        self.subtasks[last.id].apply_async.assert_called_once_with(
+            task_id=last.id)
+
+
+class NetworkxTaskDependencyGraphExecuteTest(TaskDependencyGraphExecuteTest):
+
+    graph_backend = graph_backends.GRAPH_BACKEND_NETWORKX
+
+
+class CompactGraphTest(testtools.TestCase):
+
+    def setUp(self):
+        super(CompactGraphTest, self).setUp()
+        self.graph = graph_backends.CompactGraph()
+        for node_id in 'abcd':
+            self.graph.add_node(node_id, node_id.upper())
+
+    def test_nodes(self):
+        self.assertEqual(4, len(self.graph))
+        self.assertIn('a', self.graph)
+        self.assertEqual('A', self.graph.get('a'))
+        self.assertIsNone(self.graph.get('e'))
+        self.assertEqual(['A', 'B', 'C', 'D'], list(self.graph.nodes_iter()))
+
+    def test_edges(self):
+        self.graph.add_edge('a', 'b')
+        self.graph.add_edge('a', 'c')
+        self.graph.add_edge('d', 'b')
+        self.assertEqual(2, self.graph.out_degree('a'))
+        self.assertEqual(0, self.graph.out_degree('b'))
+        self.assertEqual(['a', 'd'], sorted(self.graph.predecessors('b')))
+        self.assertEqual([('a', 'b'), ('a', 'c'), ('d', 'b')],
+                         sorted(self.graph.edges_iter()))
+
+    def test_remove_node(self):
+        self.graph.add_edge('a', 'b')
+        self.graph.add_edge('b', 'c')
+        self.graph.remove_node('b')
+        self.assertNotIn('b', self.graph)
+        self.assertEqual(3, len(self.graph))
+        self.assertEqual(0, self.graph.out_degree('a'))
+        self.assertEqual([], self.graph.predecessors('c'))
+        # the removed node index is reused
+        self.graph.add_node('e', 'E')
+        self.graph.add_edge('e', 'a')
+        self.assertEqual(['e'], self.graph.predecessors('a'))
+        self.assertEqual(4, len(self.graph))
+
+    def test_default_backend_is_networkx_digraph(self):
+        import networkx as nx
+        ctx = mock.Mock()
+        graph = TaskDependencyGraph(ctx)
+        self.assertIsInstance(graph.graph, nx.DiGraph)
+        first, second = _Task(ctx), _Task(ctx)
+        graph.add_task(first)
+        graph.add_task(second)
+        graph.add_dependency(second, first)
+        self.assertIs(first, graph.graph.node[first.id]['task'])
+        self.assertEqual([(second.id, first.id)], graph.graph.edges())
+        compact = TaskDependencyGraph(
+            ctx, graph_backend=graph_backends.GRAPH_BACKEND_COMPACT)
+        self.assertIsInstance(compact.graph, graph_backends.CompactGraph)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, graph_backends.create_graph, 'unknown')
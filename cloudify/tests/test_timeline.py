@@ -0,0 +1,116 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+import testtools
+
+from cloudify.workflows import tasks
+from cloudify.workflows.tasks_graph import TaskDependencyGraph
+from cloudify.tests.test_tasks_graph import _Task
+
+
+class TimelineTest(testtools.TestCase):
+
+    def setUp(self):
+        super(TimelineTest, self).setUp()
+        self.ctx = mock.Mock()
+        self.graph = TaskDependencyGraph(self.ctx, record_timeline=True)
+
+    def _task(self, name, duration):
+        return _Task(self.ctx, name=name, duration=duration,
+                     cloudify_context={'operation': {'name': name[0]}})
+
+    def _execute(self):
+        chain = [self._task('a0', 0.05),
+                 self._task('b0', 0.1),
+                 self._task('a1', 0.05)]
+        self.graph.sequence().add(*chain)
+        self.graph.add_task(self._task('c0', 0.02))
+        self.graph.add_task(self._task('c1', 0.02))
+        self.graph.execute()
+        return chain
+
+    def test_state_changes(self):
+        task = self._task('a', 0)
+        task.record_state_changes()
+        task.set_state(tasks.TASK_SENT)
+        task.set_state(tasks.TASK_SUCCEEDED)
+        states = [state for state, _ in task.state_changes]
+        self.assertEqual([tasks.TASK_PENDING, tasks.TASK_SENT,
+                          tasks.TASK_SUCCEEDED], states)
+        timestamps = [timestamp for _, timestamp in task.state_changes]
+        self.assertEqual(sorted(timestamps), timestamps)
+
+    def test_report(self):
+        chain = self._execute()
+        report = self.graph.timeline.report()
+        self.assertEqual(5, report['tasks'])
+        self.assertGreaterEqual(report['duration'], 0.2)
+        self.assertEqual(2, report['operations']['a']['count'])
+        self.assertGreaterEqual(report['operations']['b']['p50'], 0.1)
+        self.assertGreaterEqual(report['phases']['waiting'], 0.15)
+        self.assertGreaterEqual(report['phases']['running'], 0.24)
+        self.assertEqual([task.id for task in chain],
+                         [r['id'] for r in report['critical_path']])
+
+    def test_report_retry_delays(self):
+        task = self._task('a', 0)
+        retried = _Task(self.ctx, name='a', duration=0,
+                        cloudify_context={'operation': {'name': 'a'}})
+        retried.retry_delay = 2
+        for t in (task, retried):
+            t.record_state_changes()
+            t.set_state(tasks.TASK_SUCCEEDED)
+            self.graph.timeline.task_terminated(t)
+        retries = self.graph.timeline.report()['retries']
+        self.assertEqual(1, retries['count'])
+        self.assertEqual(2, retries['max'])
+        self.assertEqual(2, retries['total'])
+
+    def test_chrome_trace(self):
+        self._execute()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'trace.json')
+        self.graph.write_timeline(path)
+        with open(path) as f:
+            trace = json.load(f)
+        events = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual(5, len(events))
+        for event in events:
+            self.assertGreaterEqual(event['ts'], 0)
+            self.assertGreater(event['dur'], 0)
+        # tasks running at the same time are on different threads
+        first_tasks = [e for e in events if e['name'] in ('a', 'c')
+                       and e['ts'] < 10000]
+        self.assertEqual(3, len(set(e['tid'] for e in first_tasks)))
+
+    def test_report_logged_when_recording(self):
+        self._execute()
+        self.assertTrue(any(
+            'execution report' in call[0][0]
+            for call in self.ctx.logger.debug.call_args_list))
+
+    def test_report_not_built_when_not_recording(self):
+        self.graph = TaskDependencyGraph(self.ctx, record_timeline=False)
+        with mock.patch.object(self.graph.timeline, 'report') as report:
+            self._execute()
+        self.assertFalse(report.called)
+        self.assertEqual({}, self.graph.timeline.tasks)
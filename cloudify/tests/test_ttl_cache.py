@@ -0,0 +1,97 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import threading
+
+import mock
+import testtools
+
+from cloudify.ttl_cache import TTLCache
+
+
+class TTLCacheTest(testtools.TestCase):
+
+    def setUp(self):
+        super(TTLCacheTest, self).setUp()
+        self.now = 0
+        patcher = mock.patch('cloudify.ttl_cache.monotonic',
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.loads = []
+
+    def _load(self, value='value'):
+        def load():
+            self.loads.append(value)
+            return {'key': value}
+        return load
+
+    def test_ttl(self):
+        cache = TTLCache(ttl=10)
+        self.assertEqual({'key': 'a'}, cache.get('k', self._load('a')))
+        self.now = 5
+        self.assertEqual({'key': 'a'}, cache.get('k', self._load('b')))
+        self.now = 10
+        self.assertEqual({'key': 'c'}, cache.get('k', self._load('c')))
+        self.assertEqual(['a', 'c'], self.loads)
+        self.assertEqual({'hits': 1, 'misses': 2, 'invalidations': 0,
+                          'size': 1}, cache.stats())
+
+    def test_copies(self):
+        cache = TTLCache(ttl=10)
+        cache.get('k', self._load())['key'] = 'changed'
+        self.assertEqual({'key': 'value'}, cache.get('k', self._load()))
+
+    def test_invalidate(self):
+        cache = TTLCache(ttl=10)
+        cache.get('k1', self._load())
+        cache.get('k2', self._load())
+        cache.invalidate('k1')
+        self.assertEqual(1, len(cache))
+        cache.invalidate()
+        self.assertEqual(0, len(cache))
+        cache.get('k2', self._load())
+        self.assertEqual(3, len(self.loads))
+        self.assertEqual(2, cache.stats()['invalidations'])
+
+    def test_errors_not_cached(self):
+        cache = TTLCache(ttl=10)
+        load = mock.Mock(side_effect=[RuntimeError('down'), 'value'])
+        self.assertRaises(RuntimeError, cache.get, 'k', load)
+        self.assertEqual('value', cache.get('k', load))
+
+    def test_single_load(self):
+        cache = TTLCache(ttl=10)
+        loading = threading.Event()
+        release = threading.Event()
+
+        def load():
+            loading.set()
+            release.wait(5)
+            self.loads.append(None)
+            return 'value'
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.get('k', load)))
+            for _ in range(3)]
+        threads[0].start()
+        loading.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(['value'] * 3, results)
+        self.assertEqual(1, len(self.loads))
@@ -14,8 +14,10 @@
 #    * limitations under the License.
 
 import logging
+import threading
 import unittest
 
+from cloudify import utils
 from cloudify.utils import setup_logger
 from cloudify.utils import LocalCommandRunner
 from cloudify.exceptions import CommandExecutionException
@@ -49,3 +51,24 @@ class LocalCommandRunnerTest(unittest.TestCase):
         response = self.runner.run('env',
                                    execution_env={'TEST_KEY': 'TEST_VALUE'})
         self.assertTrue('TEST_KEY=TEST_VALUE' in response.std_out)
+
+
+class MonotonicTest(unittest.TestCase):
+
+    def test_concurrent_calls_never_go_backwards(self):
+        monotonic = utils._clock_gettime_monotonic() or utils.monotonic
+        went_backwards = []
+
+        def read():
+            last = monotonic()
+            for _ in range(20000):
+                now = monotonic()
+                if now < last:
+                    went_backwards.append((last, now))
+                last = now
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], went_backwards)
@@ -0,0 +1,124 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import threading
+import time
+
+import mock
+import testtools
+
+from cloudify import exceptions
+from cloudify.workflows import tasks
+from cloudify.workflows.worker_liveness import WorkerLivenessCache
+
+
+class WorkerLivenessCacheTest(testtools.TestCase):
+
+    def setUp(self):
+        super(WorkerLivenessCacheTest, self).setUp()
+        self.inspected = []
+        self.now = 0
+        patcher = mock.patch('cloudify.workflows.worker_liveness.monotonic',
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _inspect(self, targets):
+        self.inspected.append(sorted(targets))
+        return dict((target, set([tasks.DISPATCH_TASK]))
+                    for target in targets if target != 'dead')
+
+    def _cache(self, inspect=None, **kwargs):
+        return WorkerLivenessCache(inspect or self._inspect, **kwargs)
+
+    def test_ttl(self):
+        cache = self._cache(ttl=10, negative_ttl=1)
+        self.assertEqual(set([tasks.DISPATCH_TASK]), cache.get('a'))
+        self.assertIsNone(cache.get('dead'))
+        self.now = 5
+        cache.get('a')
+        cache.get('dead')
+        self.now = 11
+        cache.get('a')
+        self.assertEqual([['a'], ['dead'], ['dead'], ['a']], self.inspected)
+
+    def test_maxsize(self):
+        cache = self._cache(maxsize=2)
+        cache.get('a')
+        cache.get('b')
+        # a is now the most recently used one
+        cache.get('a')
+        cache.get('c')
+        self.assertEqual(2, len(cache))
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual([['a'], ['b'], ['c'], ['b']], self.inspected)
+
+    def test_get_many_inspects_missing_targets_together(self):
+        cache = self._cache()
+        cache.get('a')
+        results = cache.get_many(['a', 'b', 'c', 'dead', 'b'])
+        self.assertEqual(['a', 'b', 'c', 'dead'], sorted(results))
+        self.assertIsNone(results['dead'])
+        self.assertEqual([['a'], ['b', 'c', 'dead']], self.inspected)
+
+    def test_single_flight(self):
+        inspecting = threading.Event()
+        release = threading.Event()
+
+        def inspect(targets):
+            inspecting.set()
+            release.wait(5)
+            return self._inspect(targets)
+        cache = self._cache(inspect)
+        results = []
+
+        def get(target):
+            results.append(cache.get(target))
+        threads = [threading.Thread(target=get, args=('a',))]
+        threads[0].start()
+        inspecting.wait(5)
+        # a lookup of the target being inspected and lookups of other
+        # targets made meanwhile wait for the running inspection
+        threads += [threading.Thread(target=get, args=(target,))
+                    for target in ('a', 'b', 'c')]
+        for thread in threads[1:]:
+            thread.start()
+        deadline = time.time() + 5
+        while len(cache._pending) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(4, len(results))
+        self.assertEqual([['a'], ['b', 'c']], self.inspected)
+
+    def test_inspect_error(self):
+        inspect = mock.Mock(side_effect=[RuntimeError('broker'),
+                                         {'a': set()}])
+        cache = self._cache(inspect)
+        self.assertRaises(RuntimeError, cache.get, 'a')
+        # errors are not cached
+        self.assertEqual(set(), cache.get('a'))
+
+    def test_verify_worker_alive(self):
+        self.assertRaises(exceptions.RecoverableError,
+                          tasks.verify_worker_alive, 'task', 'a',
+                          lambda: None)
+        self.assertRaises(exceptions.NonRecoverableError,
+                          tasks.verify_worker_alive, 'task', 'a',
+                          lambda: set())
+        tasks.verify_worker_alive('task', 'a',
+                                  lambda: set([tasks.DISPATCH_TASK]))
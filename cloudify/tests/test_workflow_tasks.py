@@ -0,0 +1,96 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import warnings
+
+import mock
+import testtools
+
+from cloudify.workflows import tasks
+from cloudify.workflows.tasks_graph import TaskDependencyGraph
+
+
+def _local_task():
+    pass
+
+
+class WorkflowTaskTest(testtools.TestCase):
+
+    def setUp(self):
+        super(WorkflowTaskTest, self).setUp()
+        self.ctx = mock.Mock()
+
+    def _task(self):
+        return tasks.LocalWorkflowTask(_local_task, self.ctx)
+
+    def test_no_kwargs_immutable(self):
+        task = self._task()
+        self.assertEqual({}, task.kwargs)
+        self.assertRaises(TypeError, task.kwargs.__setitem__, 'a', 1)
+        self.assertRaises(TypeError, task.kwargs.update, a=1)
+        self.assertRaises(TypeError, task.kwargs.setdefault, 'a', 1)
+        self.assertEqual({}, self._task().kwargs)
+        kwargs = {'a': 1}
+        self.assertIs(kwargs,
+                      tasks.LocalWorkflowTask(_local_task, self.ctx,
+                                              kwargs=kwargs).kwargs)
+
+    def test_state_changes_not_recorded_by_default(self):
+        task = self._task()
+        task.set_state(tasks.TASK_SENT)
+        self.assertEqual([], task.state_changes)
+        self.assertIsNone(task._state_changes)
+
+    def test_state_changes_recorded_by_graph(self):
+        graph = TaskDependencyGraph(self.ctx, record_timeline=True)
+        task = self._task()
+        graph.add_task(task)
+        task.set_state(tasks.TASK_SENT)
+        self.assertEqual([tasks.TASK_PENDING, tasks.TASK_SENT],
+                         [state for state, _ in task.state_changes])
+        self.assertIsNone(
+            self._add_to(TaskDependencyGraph(self.ctx,
+                                             record_timeline=False)))
+
+    def _add_to(self, graph):
+        task = self._task()
+        graph.add_task(task)
+        return task._state_changes
+
+    def test_record_timeline_env(self):
+        with mock.patch.dict('os.environ', {'WORKFLOW_TIMELINE': 'true'}):
+            self.assertIsNotNone(
+                self._add_to(TaskDependencyGraph(self.ctx)))
+        with mock.patch.dict('os.environ', {}, clear=True):
+            self.assertIsNone(self._add_to(TaskDependencyGraph(self.ctx)))
+
+    def test_terminated_deprecated(self):
+        task = self._task()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            terminated = task.terminated
+        self.assertEqual(DeprecationWarning, caught[0].category)
+        self.assertTrue(terminated.empty())
+        task.set_state(tasks.TASK_SUCCEEDED)
+        self.assertTrue(terminated.get(timeout=1))
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.assertTrue(task.terminated.get(timeout=1))
+
+    def test_cache_deprecated(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual({}, tasks.RemoteWorkflowTask.cache)
+        self.assertEqual(DeprecationWarning, caught[0].category)
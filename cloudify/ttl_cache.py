@@ -0,0 +1,97 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+import copy
+import threading
+
+from cloudify.utils import monotonic
+
+
+class TTLCache(object):
+    """
+    Thread safe cache of values that expire a while after being loaded.
+
+    Values are loaded by a single thread at a time, threads looking up a
+    value being loaded wait for it instead of loading it as well. Callers
+    get a deep copy of the cached value, so that changing it does not change
+    the value returned to others.
+
+    :param ttl: Seconds a loaded value is cached
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        # key -> (value, expires at)
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, load):
+        """
+        :param key: The key of the value
+        :param load: Called without arguments to load the value if it is not
+                     cached (or expired). Errors are raised, not cached.
+        :return: A copy of the value
+        """
+        value = self._get_fresh(key, count=True)
+        if value is _MISSING:
+            with self._load_lock:
+                # loaded by another thread meanwhile
+                value = self._get_fresh(key, count=False)
+                if value is _MISSING:
+                    value = load()
+                    with self._lock:
+                        self._entries[key] = (value, monotonic() + self.ttl)
+        return copy.deepcopy(value)
+
+    def invalidate(self, key=None):
+        """Drop the cached value of the key, all cached values by default"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+            self.invalidations += 1
+
+    def stats(self):
+        """
+        :return: A dict of the number of hits, misses and invalidations
+                 since the cache was created and the number of cached values
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    'size': len(self._entries)}
+
+    def _get_fresh(self, key, count):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > monotonic():
+                if count:
+                    self.hits += 1
+                return entry[0]
+            if count:
+                self.misses += 1
+            return _MISSING
+
+
+_MISSING = object()
@@ -13,6 +13,7 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+import ctypes
 import logging
 import os
 import random
@@ -22,6 +23,7 @@ import string
 import subprocess
 import sys
 import tempfile
+import time
 import traceback
 import StringIO
 
@@ -293,6 +295,48 @@ def exception_to_error_cause(exception, tb):
     }
 
 
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime_monotonic():
+    # loaded by name rather than with ctypes.util.find_library, which runs
+    # ldconfig on every import of this module. clock_gettime moved to libc
+    # in recent glibc versions, where the symbols of the process have it
+    clock_gettime = None
+    for library in ('librt.so.1', None):
+        try:
+            clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+            break
+        except (OSError, AttributeError):
+            continue
+    if clock_gettime is None:
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    clock_monotonic = 1
+
+    def monotonic():
+        # a timespec per call, the GIL is released while clock_gettime
+        # writes it
+        spec = _timespec()
+        if clock_gettime(clock_monotonic, ctypes.byref(spec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    try:
+        monotonic()
+    except OSError:
+        return None
+    return monotonic
+
+
+# seconds from an arbitrary point, unaffected by system clock changes.
+# falls back to time.time where no monotonic clock is available
+monotonic = (getattr(time, 'monotonic', None) or
+             _clock_gettime_monotonic() or
+             time.time)
+
+
 class LocalCommandRunner(object):
 
     def __init__(self, logger=None, host='localhost'):
@@ -0,0 +1,239 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Delivery of cancel requests to the workers running workflow executions.
+
+The worker running a remote workflow reads the status of the execution from
+the manager every 5 seconds to find out whether it was requested to cancel
+it.
+
+When enabled (by setting the CLOUDIFY_CANCELLATION_CHANNEL environment
+variable to true, for managers publishing cancel requests), the worker also
+subscribes to the cancellation channel, to which the status of an execution
+(cancelling or force_cancelling) is published when it is requested to be
+cancelled: on the AMQP broker, to the cancellation exchange with the
+execution id as the routing key. Each subscription uses its own AMQP
+connection and thread. The status is then read at an interval growing with
+the age of the execution, up to 5 seconds and, once a request was received
+over the channel, up to a minute, in case a later request was missed (see
+poll_interval).
+"""
+
+import json
+import logging
+import os
+import threading
+import Queue
+
+from cloudify import amqp_client
+from cloudify import constants
+
+logger = logging.getLogger(__name__)
+
+EXCHANGE_NAME = 'cloudify-execution-cancellation'
+
+# seconds between reads of the execution status. when subscribed to the
+# cancellation channel, they start at the minimum and grow with the age of
+# the execution up to the maximum
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 5
+# maximum once cancel requests were received over the cancellation channel,
+# the status is only read in case a request was missed
+MAX_PUSHED_POLL_INTERVAL = 60
+POLL_INTERVAL_AGE_RATIO = 0.1
+
+# seconds to wait for a subscription to be ready, which delays the start of
+# the workflow
+SUBSCRIBE_TIMEOUT = 5
+# seconds between checks of a closed subscription by its consumer thread
+CONSUME_INTERVAL = 1
+
+
+def poll_interval(age, subscribed, pushed=False):
+    """
+    :param age: Seconds since the execution started
+    :param subscribed: Whether subscribed to the cancel requests of the
+                       execution
+    :param pushed: Whether cancel requests of the execution were received
+                   over the cancellation channel
+    :return: Seconds to wait before reading the execution status
+    """
+    if not subscribed:
+        return MAX_POLL_INTERVAL
+    max_interval = MAX_PUSHED_POLL_INTERVAL if pushed else MAX_POLL_INTERVAL
+    return min(max(age * POLL_INTERVAL_AGE_RATIO, MIN_POLL_INTERVAL),
+               max_interval)
+
+
+class CancellationChannel(object):
+    """Delivers the status of executions requested to be cancelled"""
+
+    def subscribe(self, execution_id, callback):
+        """
+        :param execution_id: The execution to receive cancel requests of
+        :param callback: Called with the execution status on a request
+        :return: A subscription, closed to stop receiving requests
+        """
+        raise NotImplementedError('Implemented by subclasses')
+
+    def publish(self, execution_id, status):
+        raise NotImplementedError('Implemented by subclasses')
+
+
+class Subscription(object):
+
+    def __init__(self, close):
+        self._close = close
+        self.closed = False
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._close()
+
+
+class LocalCancellationChannel(CancellationChannel):
+    """Delivers the requests published in this process, used by tests"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # execution id -> callbacks
+        self._subscribers = {}
+
+    def subscribe(self, execution_id, callback):
+        with self._lock:
+            self._subscribers.setdefault(execution_id, []).append(callback)
+
+        def close():
+            with self._lock:
+                callbacks = self._subscribers.get(execution_id, [])
+                if callback in callbacks:
+                    callbacks.remove(callback)
+                if not callbacks:
+                    self._subscribers.pop(execution_id, None)
+        return Subscription(close)
+
+    def publish(self, execution_id, status):
+        with self._lock:
+            callbacks = list(self._subscribers.get(execution_id, []))
+        for callback in callbacks:
+            callback(status)
+
+
+class AMQPCancellationChannel(CancellationChannel):
+    """
+    Delivers the requests published to the cancellation exchange. Each
+    subscription consumes from its own exclusive queue, bound with the
+    execution id, in its own thread and AMQP connection.
+    """
+
+    def subscribe(self, execution_id, callback):
+        closed = threading.Event()
+        ready = Queue.Queue(1)
+        thread = threading.Thread(
+            target=self._consume,
+            args=(execution_id, callback, closed, ready),
+            name='Cancellation-Consumer')
+        thread.daemon = True
+        thread.start()
+        try:
+            error = ready.get(timeout=SUBSCRIBE_TIMEOUT)
+        except Queue.Empty:
+            error = RuntimeError('Timed out subscribing to the cancel '
+                                 'requests of execution {0}'
+                                 .format(execution_id))
+        if error is not None:
+            closed.set()
+            raise error
+        return Subscription(closed.set)
+
+    def publish(self, execution_id, status):
+        client = amqp_client.create_client()
+        try:
+            self._declare_exchange(client.channel)
+            client.channel.basic_publish(
+                exchange=EXCHANGE_NAME,
+                routing_key=execution_id,
+                body=json.dumps({'execution_id': execution_id,
+                                 'status': status}))
+        finally:
+            client.close()
+
+    def _consume(self, execution_id, callback, closed, ready):
+        try:
+            client = amqp_client.create_client()
+        except Exception as e:
+            ready.put(e)
+            return
+        try:
+            channel = client.channel
+            self._declare_exchange(channel)
+            queue = channel.queue_declare(exclusive=True,
+                                          auto_delete=True).method.queue
+            channel.queue_bind(queue=queue,
+                               exchange=EXCHANGE_NAME,
+                               routing_key=execution_id)
+
+            def on_message(channel, method, properties, body):
+                try:
+                    status = json.loads(body)['status']
+                except (ValueError, KeyError, TypeError):
+                    logger.warning('Ignoring malformed cancel request: {0}'
+                                   .format(body))
+                    return
+                callback(status)
+            channel.basic_consume(on_message, queue=queue, no_ack=True)
+        except Exception as e:
+            client.close()
+            ready.put(e)
+            return
+        ready.put(None)
+        try:
+            while not closed.is_set():
+                client.connection.sleep(CONSUME_INTERVAL)
+        except Exception as e:
+            # the status of the execution is still read as a fallback
+            logger.warning('Stopped receiving the cancel requests of '
+                           'execution {0}: {1}'.format(execution_id, e))
+        finally:
+            client.close()
+
+    @staticmethod
+    def _declare_exchange(channel):
+        channel.exchange_declare(exchange=EXCHANGE_NAME,
+                                 exchange_type='direct',
+                                 durable=True)
+
+
+_channel = None
+
+
+def get_channel():
+    """
+    :return: The channel set with set_channel, by default the AMQP channel if
+             enabled by the CLOUDIFY_CANCELLATION_CHANNEL environment
+             variable and None otherwise
+    """
+    global _channel
+    if _channel is None and os.environ.get(
+            constants.CANCELLATION_CHANNEL_KEY, '').lower() == 'true':
+        _channel = AMQPCancellationChannel()
+    return _channel
+
+
+def set_channel(channel):
+    global _channel
+    _channel = channel
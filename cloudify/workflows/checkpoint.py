@@ -0,0 +1,190 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Append-only checkpoint log of a task graph execution.
+
+The log holds one JSON record per line:
+
+    {"type": "task", "id": ..., "key": ..., "name": ..., "subgraph": ...}
+    {"type": "dependency", "src": ..., "dst": ...}
+    {"type": "state", "id": ..., "state": ...}
+
+Task ids are generated anew every time a workflow builds its graph, so each
+task is also logged with a key derived from what the task does and the order
+in which it was added to the graph. Tasks can't be serialized (local tasks
+wrap arbitrary callables), so an interrupted execution is resumed by running
+the workflow again: the rebuilt graph is matched by key against the log and
+tasks that already succeeded are not executed again. The terminated state
+of a task is only logged once its handlers accepted it, so a task whose
+success handler asked for a retry is executed again on resume.
+"""
+
+import os
+import json
+import time
+
+RECORD_TASK = 'task'
+RECORD_DEPENDENCY = 'dependency'
+RECORD_STATE = 'state'
+
+DEFAULT_SYNC_INTERVAL = 1
+DEFAULT_SYNC_BATCH_SIZE = 100
+
+
+def task_signature(task):
+    """
+    :return: A string describing what the task does, identical for the
+             same task of a graph built again by the same workflow
+    """
+    cloudify_context = task.cloudify_context or {}
+    return '{0}:{1}:{2}:{3}:{4}'.format(
+        type(task).__name__,
+        task.name,
+        task.info,
+        cloudify_context.get('node_id'),
+        cloudify_context.get('operation', {}).get('name'))
+
+
+class CheckpointLog(object):
+    """
+    Appends records to a checkpoint log file.
+
+    Records are written to the file as they are added, but only forced to
+    disk (fsync) once `sync_batch_size` records are pending or
+    `sync_interval` seconds passed since the last sync. Records that were
+    not synced before a crash only cause the tasks they describe to run
+    again on resume.
+
+    :param path: The log file path
+    :param sync_interval: Max seconds between syncs of pending records
+    :param sync_batch_size: Max number of pending records
+    """
+
+    def __init__(self, path,
+                 sync_interval=DEFAULT_SYNC_INTERVAL,
+                 sync_batch_size=DEFAULT_SYNC_BATCH_SIZE):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.sync_batch_size = sync_batch_size
+        self._file = open(path, 'a')
+        self._pending = 0
+        self._last_sync = time.time()
+
+    def task(self, task, key):
+        self._write({'type': RECORD_TASK,
+                     'id': task.id,
+                     'key': key,
+                     'name': task.name,
+                     'subgraph': task.is_subgraph})
+
+    def dependency(self, src_task_id, dst_task_id):
+        self._write({'type': RECORD_DEPENDENCY,
+                     'src': src_task_id,
+                     'dst': dst_task_id})
+
+    def state(self, task):
+        self._write({'type': RECORD_STATE,
+                     'id': task.id,
+                     'state': task.get_state()})
+
+    def _write(self, record):
+        self._file.write(json.dumps(record))
+        self._file.write('\n')
+        self._pending += 1
+        if self._pending >= self.sync_batch_size:
+            self.sync()
+        else:
+            self.sync_if_due()
+
+    def sync_if_due(self):
+        if self._pending and \
+                time.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.sync()
+        self._file.close()
+
+
+class GraphCheckpoint(object):
+    """
+    The graph structure and last known task states read from a checkpoint
+    log.
+
+    :param tasks: A dict mapping task ids to their task records, each
+                  holding the last logged 'state' of the task (or None)
+    :param dependencies: A list of (src task id, dst task id) tuples
+    """
+
+    def __init__(self, tasks, dependencies):
+        self.tasks = tasks
+        self.dependencies = dependencies
+        # a retried task is logged with the key of the task it replaces,
+        # the state of the latest of them wins
+        self._states = {}
+        for record in tasks.values():
+            if record['state'] is None:
+                continue
+            latest = self._states.get(record['key'])
+            if latest is None or latest[0] < record['sequence']:
+                self._states[record['key']] = (record['sequence'],
+                                               record['state'])
+
+    def state(self, key):
+        """
+        :return: The last logged state of the task with this key, None if
+                 no state was logged for it
+        """
+        sequence_and_state = self._states.get(key)
+        return sequence_and_state[1] if sequence_and_state else None
+
+
+def load(path):
+    """
+    Read a checkpoint log
+
+    :param path: The log file path
+    :return: A GraphCheckpoint
+    """
+    tasks = {}
+    dependencies = []
+    with open(path) as f:
+        for sequence, line in enumerate(f):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a crash while writing may leave a partial last record
+                continue
+            record_type = record.get('type')
+            if record_type == RECORD_TASK:
+                record['state'] = None
+                record['sequence'] = sequence
+                tasks[record['id']] = record
+            elif record_type == RECORD_DEPENDENCY:
+                dependencies.append((record['src'], record['dst']))
+            elif record_type == RECORD_STATE and record['id'] in tasks:
+                task_record = tasks[record['id']]
+                task_record['state'] = record['state']
+                task_record['sequence'] = sequence
+    return GraphCheckpoint(tasks, dependencies)
@@ -0,0 +1,201 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Copy-on-write containers for operation kwargs.
+
+Every operation task used to deep copy its kwargs, which for large operation
+inputs (rendered cloud-init payloads, big property maps) dominated the time
+it takes to build a task graph. A CopyOnWriteDict only copies the top level
+of the dict it wraps. Nested dicts and lists stay shared with the original
+until they are read through the wrapper, at which point that level (and
+only that level) is copied and the copy replaces the shared value. Any
+value reached through the wrapper can therefore be mutated without
+affecting the original, while subtrees that are never touched are never
+copied.
+
+The wrappers subclass dict and list, so they serialize to JSON and are
+accepted wherever plain containers are. Deep copying and pickling them
+produces plain containers.
+
+Reads that bypass the dict methods are shallow: ``**`` unpacking a
+CopyOnWriteDict, ``dict(cow)`` and ``dict.update(other, cow)`` copy only its
+top level, and nested values that were not read through the wrapper yet
+remain shared with the original. Kwargs are therefore handed over to
+operations with copy_on_write_values, which wraps every value first.
+"""
+
+import copy
+import collections
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def copy_on_write(value):
+    """
+    :return: A copy-on-write copy of plain dicts and lists, other values
+             as they are
+    """
+    value_type = type(value)
+    if value_type is dict or value_type is CopyOnWriteDict:
+        return CopyOnWriteDict(value)
+    if value_type is list or value_type is CopyOnWriteList:
+        return CopyOnWriteList(value)
+    return value
+
+
+def copy_on_write_values(kwargs):
+    """
+    :return: A plain dict holding copy-on-write copies of the kwargs values,
+             to be passed on as ``**kwargs`` (unpacking the kwargs
+             themselves would pass their nested values as they are)
+    """
+    return dict((key, copy_on_write(value))
+                for key, value in dict.iteritems(kwargs))
+
+
+class CopyOnWriteDict(dict):
+    """
+    A dict sharing its nested values until they are read through its
+    methods. ``**`` unpacking and ``dict()`` are shallow, see
+    copy_on_write_values.
+    """
+
+    __slots__ = ('_owned', )
+
+    def __init__(self, *args, **kwargs):
+        super(CopyOnWriteDict, self).__init__(*args, **kwargs)
+        # keys whose nested containers were already copied (or set) here
+        self._owned = set()
+
+    def _own(self, key, value):
+        if key in self._owned:
+            return value
+        copied = copy_on_write(value)
+        if copied is not value:
+            dict.__setitem__(self, key, copied)
+            self._owned.add(key)
+        return copied
+
+    def __getitem__(self, key):
+        return self._own(key, dict.__getitem__(self, key))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._owned.add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._owned.discard(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = next(dict.__iter__(self))
+        return key, self.pop(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self._owned.clear()
+
+    def iteritems(self):
+        for key in dict.keys(self):
+            yield key, self[key]
+
+    def itervalues(self):
+        for key in dict.keys(self):
+            yield self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def viewitems(self):
+        return collections.ItemsView(self)
+
+    def viewvalues(self):
+        return collections.ValuesView(self)
+
+    def copy(self):
+        return CopyOnWriteDict(self)
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return dict, (dict(self), )
+
+
+class CopyOnWriteList(list):
+    """
+    A list whose dict and list items are copy-on-write copies, so that
+    only the top level of each item is copied up front
+    """
+
+    def __init__(self, iterable=()):
+        super(CopyOnWriteList, self).__init__(
+            copy_on_write(item) for item in iterable)
+
+    def __copy__(self):
+        return CopyOnWriteList(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(list(self), memo)
+
+    def __reduce__(self):
+        return list, (list(self), )
+
+
+if yaml is not None:
+    # operations commonly dump their inputs (e.g. cloud-init user data)
+    for _dumper in (yaml.Dumper, yaml.SafeDumper):
+        yaml.add_representer(
+            CopyOnWriteDict,
+            yaml.representer.SafeRepresenter.represent_dict,
+            Dumper=_dumper)
+        yaml.add_representer(
+            CopyOnWriteList,
+            yaml.representer.SafeRepresenter.represent_list,
+            Dumper=_dumper)
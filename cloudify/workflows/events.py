@@ -28,6 +28,9 @@ class Monitor(object):
                             events task id.
         """
         self.tasks_graph = tasks_graph
+        # graphs of other workflow contexts whose events are handled by this
+        # monitor as well (see add_tasks_graph)
+        self._shared_tasks_graphs = []
         self._receiver = None
         self._should_stop = False
 
@@ -56,9 +59,29 @@ class Monitor(object):
     def task_retried(self, event):
         pass
 
+    def add_tasks_graph(self, tasks_graph):
+        """
+        Handle the events of the tasks of another task graph as well, so that
+        a single monitor serves several workflow contexts.
+        """
+        self._shared_tasks_graphs.append(tasks_graph)
+
+    def remove_tasks_graph(self, tasks_graph):
+        if tasks_graph in self._shared_tasks_graphs:
+            self._shared_tasks_graphs.remove(tasks_graph)
+
+    def _get_task(self, task_id):
+        task = self.tasks_graph.get_task(task_id)
+        if task is None:
+            for tasks_graph in list(self._shared_tasks_graphs):
+                task = tasks_graph.get_task(task_id)
+                if task is not None:
+                    break
+        return task
+
     def _handle(self, state, event, send_event):
         task_id = event['uuid']
-        task = self.tasks_graph.get_task(task_id)
+        task = self._get_task(task_id)
         if task is not None:
             if send_event:
                 send_task_event(state, task, send_task_event_func_remote,
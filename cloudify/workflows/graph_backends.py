@@ -0,0 +1,193 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Directed graph implementations used by the TaskDependencyGraph to store
+tasks and the dependencies between them.
+
+An edge (src, dst) means src depends on dst, so a node's successors are its
+remaining dependencies and its predecessors are the nodes depending on it.
+
+The networkx backend is the default, so that TaskDependencyGraph.graph stays
+a networkx.DiGraph. The compact backend builds and executes large graphs
+faster and with less memory, and is selected with the 'task_graph_backend'
+workflow context key.
+"""
+
+GRAPH_BACKEND_COMPACT = 'compact'
+GRAPH_BACKEND_NETWORKX = 'networkx'
+DEFAULT_GRAPH_BACKEND = GRAPH_BACKEND_NETWORKX
+
+
+class _Node(object):
+
+    __slots__ = ('id', 'task', 'succ', 'pred')
+
+    def __init__(self, node_id, task):
+        self.id = node_id
+        self.task = task
+        # sets of node indexes, only allocated once the node has an edge
+        self.succ = None
+        self.pred = None
+
+
+class CompactGraph(object):
+    """
+    A directed graph keeping its nodes in a list and edges as sets of
+    integer node indexes. Indexes of removed nodes are reused.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._nodes = []
+        self._free = []
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, node_id):
+        return node_id in self._index
+
+    def has_node(self, node_id):
+        return node_id in self._index
+
+    def add_node(self, node_id, task):
+        index = self._index.get(node_id)
+        if index is not None:
+            self._nodes[index].task = task
+            return
+        node = _Node(node_id, task)
+        if self._free:
+            index = self._free.pop()
+            self._nodes[index] = node
+        else:
+            index = len(self._nodes)
+            self._nodes.append(node)
+        self._index[node_id] = index
+
+    def get(self, node_id):
+        index = self._index.get(node_id)
+        return self._nodes[index].task if index is not None else None
+
+    def remove_node(self, node_id):
+        index = self._index.pop(node_id)
+        node = self._nodes[index]
+        nodes = self._nodes
+        for succ in node.succ or ():
+            nodes[succ].pred.discard(index)
+        for pred in node.pred or ():
+            nodes[pred].succ.discard(index)
+        nodes[index] = None
+        self._free.append(index)
+
+    def add_edge(self, src_id, dst_id):
+        src_index = self._index[src_id]
+        dst_index = self._index[dst_id]
+        src = self._nodes[src_index]
+        dst = self._nodes[dst_index]
+        if src.succ is None:
+            src.succ = set()
+        if dst.pred is None:
+            dst.pred = set()
+        src.succ.add(dst_index)
+        dst.pred.add(src_index)
+
+    def out_degree(self, node_id):
+        index = self._index.get(node_id)
+        if index is None:
+            return 0
+        succ = self._nodes[index].succ
+        return len(succ) if succ else 0
+
+    def predecessors(self, node_id):
+        node = self._nodes[self._index[node_id]]
+        return [self._nodes[pred].id for pred in node.pred or ()]
+
+    def nodes_iter(self):
+        return (node.task for node in self._nodes if node is not None)
+
+    def edges_iter(self):
+        nodes = self._nodes
+        for node in nodes:
+            if node is None or not node.succ:
+                continue
+            for succ in node.succ:
+                yield node.id, nodes[succ].id
+
+
+class NetworkxGraph(object):
+    """
+    A directed graph backed by a networkx.DiGraph, available as `digraph`.
+    Tasks are stored in the 'task' attribute of their node.
+    """
+
+    def __init__(self):
+        # networkx is only imported when this backend is selected
+        import networkx as nx
+        self.digraph = nx.DiGraph()
+
+    def __len__(self):
+        return len(self.digraph.node)
+
+    def __contains__(self, node_id):
+        return node_id in self.digraph
+
+    def has_node(self, node_id):
+        return self.digraph.has_node(node_id)
+
+    def add_node(self, node_id, task):
+        self.digraph.add_node(node_id, task=task)
+
+    def get(self, node_id):
+        data = self.digraph.node.get(node_id)
+        return data['task'] if data is not None else None
+
+    def remove_node(self, node_id):
+        self.digraph.remove_node(node_id)
+
+    def add_edge(self, src_id, dst_id):
+        self.digraph.add_edge(src_id, dst_id)
+
+    def out_degree(self, node_id):
+        return len(self.digraph.succ.get(node_id, {}))
+
+    def predecessors(self, node_id):
+        return self.digraph.predecessors(node_id)
+
+    def nodes_iter(self):
+        return (data['task'] for _, data in self.digraph.nodes_iter(data=True))
+
+    def edges_iter(self):
+        return self.digraph.edges_iter()
+
+
+GRAPH_BACKENDS = {
+    GRAPH_BACKEND_COMPACT: CompactGraph,
+    GRAPH_BACKEND_NETWORKX: NetworkxGraph
+}
+
+
+def create_graph(backend=None):
+    """
+    :param backend: The graph backend name (one of GRAPH_BACKENDS), defaults
+                    to DEFAULT_GRAPH_BACKEND
+    :return: A new, empty, graph instance
+    """
+    backend = backend or DEFAULT_GRAPH_BACKEND
+    if backend not in GRAPH_BACKENDS:
+        raise ValueError('Unknown task graph backend: {0}. Available '
+                         'backends are: {1}'.format(backend,
+                                                    GRAPH_BACKENDS.keys()))
+    return GRAPH_BACKENDS[backend]()
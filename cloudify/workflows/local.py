@@ -29,7 +29,8 @@ from cloudify_rest_client.node_instances import NodeInstance
 
 from cloudify import dispatch
 from cloudify.workflows.workflow_context import (
-    DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE)
+    DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE,
+    DEFAULT_LOCAL_TASK_PROCESS_POOL_SIZE)
 
 try:
     from dsl_parser.constants import HOST_TYPE
@@ -105,7 +106,11 @@ class _Environment(object):
                 task_retries=-1,
                 task_retry_interval=30,
                 subgraph_retries=0,
-                task_thread_pool_size=DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE):
+                subgraph_retry_interval=0,
+                task_thread_pool_size=DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE,
+                task_process_pool_size=DEFAULT_LOCAL_TASK_PROCESS_POOL_SIZE,
+                task_concurrency_limits=None,
+                task_scheduling=None):
         workflows = self.plan['workflows']
         workflow_name = workflow
         if workflow_name not in workflows:
@@ -127,7 +132,11 @@ class _Environment(object):
             'task_retries': task_retries,
             'task_retry_interval': task_retry_interval,
             'subgraph_retries': subgraph_retries,
+            'subgraph_retry_interval': subgraph_retry_interval,
             'local_task_thread_pool_size': task_thread_pool_size,
+            'local_task_process_pool_size': task_process_pool_size,
+            'task_concurrency_limits': task_concurrency_limits,
+            'task_scheduling': task_scheduling,
             'task_name': workflow['operation']
         }
 
@@ -0,0 +1,265 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Process pool for local workflow tasks.
+
+Local tasks run on the threads of the local tasks processing, so CPU bound
+operations serialize on the GIL. With a process pool, local tasks whose
+callable can be imported by name (e.g. dispatch.dispatch running the
+operations of local workflows) and whose kwargs can be pickled run in worker
+processes instead, while the calling thread waits for their result. Other
+tasks (closures such as set_state tasks) keep running on the thread.
+
+The storage of local workflows lives in the workflow process, so operations
+running in worker processes access it through a StorageProxy that calls back
+into the workflow process.
+"""
+
+import importlib
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+import traceback
+from multiprocessing.connection import Client, Listener
+
+from cloudify import exceptions
+
+# methods of the storage operations may call through a StorageProxy
+STORAGE_METHODS = ('get_node', 'get_nodes', 'get_node_instance',
+                   'get_node_instances', 'update_node_instance',
+                   'get_resource', 'download_resource',
+                   'get_provider_context', 'get_workdir',
+                   'evaluate_functions')
+
+
+class StorageServer(object):
+    """Serves the calls of storage proxies in worker processes"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.authkey = os.urandom(16)
+        self._listener = Listener(('127.0.0.1', 0), authkey=self.authkey)
+        self.address = self._listener.address
+        self._closed = False
+        self._thread = threading.Thread(target=self._accept,
+                                        name='Storage-Server')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            # wake up the accepting thread
+            Client(self.address, authkey=self.authkey).close()
+        except Exception:
+            pass
+        self._thread.join(5)
+        self._listener.close()
+
+    def proxy(self):
+        return StorageProxy(self.address, self.authkey)
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                connection = self._listener.accept()
+            except Exception:
+                continue
+            if self._closed:
+                connection.close()
+                return
+            thread = threading.Thread(target=self._serve,
+                                      args=(connection, ),
+                                      name='Storage-Server-Connection')
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        try:
+            while True:
+                method, args, kwargs = connection.recv()
+                try:
+                    if method not in STORAGE_METHODS:
+                        raise AttributeError(
+                            'Storage method not supported in worker '
+                            'processes: {0}'.format(method))
+                    if method == 'evaluate_functions':
+                        target = self.storage.env
+                    else:
+                        target = self.storage
+                    response = ('result', getattr(target, method)(*args,
+                                                                  **kwargs))
+                except Exception as e:
+                    response = ('error', e)
+                connection.send(response)
+        except (EOFError, IOError):
+            pass
+        finally:
+            connection.close()
+
+
+class StorageProxy(object):
+    """
+    A picklable stand-in for the storage of a local workflow, used by
+    operations running in worker processes
+    """
+
+    # connections of this process, per server address
+    _connections = {}
+    _lock = threading.Lock()
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+
+    @property
+    def env(self):
+        # LocalEndpoint evaluates functions through storage.env
+        return self
+
+    def _call(self, method, *args, **kwargs):
+        with self._lock:
+            connection = self._connections.get(self.address)
+            if connection is None:
+                connection = Client(self.address, authkey=self.authkey)
+                self._connections[self.address] = connection
+            connection.send((method, args, kwargs))
+            response_type, payload = connection.recv()
+        if response_type == 'error':
+            raise payload
+        return payload
+
+    def __getattr__(self, name):
+        if name not in STORAGE_METHODS:
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            return self._call(name, *args, **kwargs)
+        return method
+
+
+def task_reference(local_task):
+    """
+    :return: (module name, attribute name) the local task can be imported
+             by in a worker process, None if it cannot
+    """
+    module_name = getattr(local_task, '__module__', None)
+    name = getattr(local_task, '__name__', None)
+    module = sys.modules.get(module_name)
+    if module is None or name is None:
+        return None
+    if getattr(module, name, None) is not local_task:
+        return None
+    return module_name, name
+
+
+def _run_local_task(module_name, name, kwargs):
+    """Runs in the worker processes"""
+    try:
+        local_task = getattr(importlib.import_module(module_name), name)
+        result = local_task(**kwargs)
+        pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        return 'result', result
+    except BaseException as e:
+        return 'error', _picklable_error(e, traceback.format_exc())
+
+
+def _picklable_error(error, trace):
+    """
+    :return: The error (or a cloudify error describing it if it cannot be
+             unpickled) with the worker traceback as a cause
+    """
+    causes = getattr(error, 'causes', None)
+    if isinstance(causes, list):
+        causes.append({'message': str(error),
+                       'type': type(error).__name__,
+                       'traceback': trace})
+    try:
+        pickle.loads(pickle.dumps(error, pickle.HIGHEST_PROTOCOL))
+        return error
+    except Exception:
+        known_type = (exceptions.NonRecoverableError
+                      if isinstance(error, exceptions.NonRecoverableError)
+                      else exceptions.RecoverableError)
+        return known_type(
+            '{0}: {1}'.format(type(error).__name__, error),
+            causes=[{'message': str(error),
+                     'type': type(error).__name__,
+                     'traceback': trace}])
+
+
+class LocalTaskProcessPool(object):
+    """
+    :param processes: Number of worker processes
+    :param storage: The storage of the local workflow (optional)
+    """
+
+    def __init__(self, processes, storage=None):
+        self.processes = processes
+        self._storage = storage
+        self._storage_server = None
+        self._pool = None
+
+    def start(self):
+        # workers are forked before the storage server thread starts
+        self._pool = multiprocessing.Pool(self.processes)
+        if self._storage is not None:
+            self._storage_server = StorageServer(self._storage)
+            self._storage_server.start()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        if self._storage_server is not None:
+            self._storage_server.close()
+            self._storage_server = None
+
+    def run(self, local_task, kwargs):
+        """
+        Run the local task in a worker process if it can be, in the calling
+        thread otherwise
+
+        :return: The local task result
+        """
+        reference = task_reference(local_task)
+        if reference is None or self._pool is None:
+            return local_task(**kwargs)
+        try:
+            result_type, payload = self._pool.apply(
+                _run_local_task, reference + (self._proxied(kwargs), ))
+        except (pickle.PicklingError, TypeError):
+            # kwargs that cannot be sent to a worker process
+            return local_task(**kwargs)
+        if result_type == 'error':
+            raise payload
+        return payload
+
+    def _proxied(self, kwargs):
+        cloudify_context = kwargs.get('__cloudify_context')
+        if (self._storage_server is None or
+                not isinstance(cloudify_context, dict) or
+                'storage' not in cloudify_context):
+            return kwargs
+        cloudify_context = dict(cloudify_context,
+                                storage=self._storage_server.proxy())
+        return dict(kwargs, __cloudify_context=cloudify_context)
@@ -0,0 +1,128 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Backoff policies for task retries.
+
+A task retry interval is either a number of seconds (a fixed interval) or a
+dict describing a backoff policy, e.g.::
+
+    {'type': 'exponential', 'interval': 5, 'factor': 2, 'max_interval': 300}
+
+Policies are accepted wherever a retry interval is set by workflow code or
+configuration: the ``task_retry_interval`` and ``subgraph_retry_interval``
+settings (of the workflow context or of the ``workflows`` section of the
+bootstrap context) and the ``retry_interval`` of tasks created by workflows
+(e.g. with ``execute_task`` or the default subgraph task config of a task
+graph). The ``retry_interval`` of an operation in a blueprint must still be
+a number, as validated by the DSL parser.
+
+Supported types:
+
+- fixed: ``interval`` seconds between retries
+- exponential: ``interval * factor ** (retry - 1)`` seconds, optionally
+  with full jitter (a random delay between 0 and that value)
+- decorrelated_jitter: a random delay between ``interval`` and three times
+  the previous delay, spreading retries of tasks that failed together
+
+Every policy may be capped with ``max_interval``.
+"""
+
+import random
+
+RETRY_FIXED = 'fixed'
+RETRY_EXPONENTIAL = 'exponential'
+RETRY_DECORRELATED_JITTER = 'decorrelated_jitter'
+
+
+class RetryPolicy(object):
+
+    def __init__(self, interval, max_interval=None):
+        self.interval = interval
+        self.max_interval = max_interval
+
+    def delay(self, retry_number, previous_delay=None):
+        """
+        :param retry_number: The retry about to be scheduled (starting at 1)
+        :param previous_delay: The delay before the previous retry (None
+                               for the first retry)
+        :return: Seconds to wait before the retry
+        """
+        delay = self._delay(retry_number, previous_delay)
+        if self.max_interval is not None:
+            delay = min(delay, self.max_interval)
+        return delay
+
+    def _delay(self, retry_number, previous_delay):
+        raise NotImplementedError('Implemented by subclasses')
+
+
+class FixedRetryPolicy(RetryPolicy):
+
+    def _delay(self, retry_number, previous_delay):
+        return self.interval
+
+
+class ExponentialRetryPolicy(RetryPolicy):
+
+    def __init__(self, interval, factor=2, max_interval=None, jitter=False):
+        super(ExponentialRetryPolicy, self).__init__(interval, max_interval)
+        self.factor = factor
+        self.jitter = jitter
+
+    def _delay(self, retry_number, previous_delay):
+        delay = self.interval * self.factor ** max(0, retry_number - 1)
+        if self.max_interval is not None:
+            delay = min(delay, self.max_interval)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+class DecorrelatedJitterRetryPolicy(RetryPolicy):
+
+    def _delay(self, retry_number, previous_delay):
+        previous_delay = max(previous_delay or 0, self.interval)
+        return random.uniform(self.interval, previous_delay * 3)
+
+
+POLICIES = {
+    RETRY_FIXED: FixedRetryPolicy,
+    RETRY_EXPONENTIAL: ExponentialRetryPolicy,
+    RETRY_DECORRELATED_JITTER: DecorrelatedJitterRetryPolicy
+}
+
+
+def create_retry_policy(retry_interval):
+    """
+    :param retry_interval: A number of seconds, a dict describing a backoff
+                           policy or a RetryPolicy instance
+    :return: A RetryPolicy instance
+    """
+    if isinstance(retry_interval, RetryPolicy):
+        return retry_interval
+    if not isinstance(retry_interval, dict):
+        return FixedRetryPolicy(retry_interval)
+    arguments = dict(retry_interval)
+    policy_type = arguments.pop('type', RETRY_FIXED)
+    if policy_type not in POLICIES:
+        raise ValueError(
+            'Unknown retry policy: {0} (expected one of: {1})'.format(
+                policy_type, ', '.join(sorted(POLICIES))))
+    try:
+        return POLICIES[policy_type](**arguments)
+    except TypeError as e:
+        raise ValueError('Invalid {0} retry policy {1}: {2}'.format(
+            policy_type, retry_interval, e))
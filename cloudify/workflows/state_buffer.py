@@ -0,0 +1,139 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Write-behind buffer of node instance states.
+
+Workflows set the state of every node instance several times while
+installing or uninstalling it, and each of these used to be written to the
+manager right away. The buffer keeps the latest state set for each node
+instance and writes the pending states every few seconds, whenever a remote
+operation is about to be sent (so that operations and their observers never
+see a state older than the one set before the operation) and when the
+workflow ends. States set in between two flushes for the same node instance
+are coalesced: only the latest one is written.
+
+States of a node instance are always written in the order they were set,
+a failed write is retried at the next flush unless a newer state was set in
+the meantime. States being written are still returned by get until their
+write is done, so that readers never fall back to the state stored on the
+manager while a newer one is being written.
+"""
+
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+# seconds between background flushes
+DEFAULT_FLUSH_INTERVAL = 2
+
+
+class NodeStateBuffer(object):
+    """
+    :param write: Called with a node instance id and a state to persist it
+    :param interval: Seconds between background flushes
+    :param logger: Logger for write errors of background flushes
+    """
+
+    def __init__(self, write, interval=DEFAULT_FLUSH_INTERVAL, logger=None):
+        self._write = write
+        self.interval = interval
+        self.logger = logger
+        self._lock = threading.Lock()
+        # held while writing, so that flushes do not reorder writes
+        self._flush_lock = threading.Lock()
+        # node instance id -> state, in the order they were first set
+        self._pending = OrderedDict()
+        # node instance id -> state, of the states being written
+        self._writing = {}
+        self._closed = threading.Event()
+        self._thread = None
+
+    def set(self, node_instance_id, state):
+        with self._lock:
+            self._pending[node_instance_id] = state
+            if self._thread is None and self.interval:
+                self._thread = threading.Thread(target=self._flush_loop,
+                                                name='Node-State-Flush')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def get(self, node_instance_id):
+        """
+        :return: The pending state of the node instance, None if there is no
+                 state waiting to be written or being written
+        """
+        with self._lock:
+            state = self._pending.get(node_instance_id)
+            if state is None:
+                state = self._writing.get(node_instance_id)
+            return state
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """
+        Write all pending states.
+
+        :raise: The first write error, after trying to write all states
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = OrderedDict()
+                self._writing = dict(pending)
+            error = None
+            for node_instance_id, state in pending.items():
+                try:
+                    self._write(node_instance_id, state)
+                except Exception as e:
+                    with self._lock:
+                        # unless superseded by a newer state, retried at the
+                        # next flush
+                        if node_instance_id not in self._pending:
+                            self._pending[node_instance_id] = state
+                        del self._writing[node_instance_id]
+                    error = error or e
+                else:
+                    with self._lock:
+                        del self._writing[node_instance_id]
+            if error is not None:
+                raise error
+
+    def try_flush(self):
+        """Write all pending states, logging errors instead of raising"""
+        try:
+            self.flush()
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.warning(
+                    'Failed writing node instance states (will be retried): '
+                    '{0}'.format(e))
+
+    def close(self):
+        """Stop flushing in the background. Pending states are kept."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.interval):
+            if self._pending:
+                self.try_flush()
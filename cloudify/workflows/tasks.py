@@ -18,15 +18,25 @@ import sys
 import time
 import uuid
 import Queue
+import warnings
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 
 from cloudify import utils
 from cloudify import exceptions
 from cloudify.workflows import api
+from cloudify.workflows.retry_policies import create_retry_policy
+from cloudify.workflows.worker_liveness import WorkerLivenessCache
 
 INFINITE_TOTAL_RETRIES = -1
 DEFAULT_TOTAL_RETRIES = INFINITE_TOTAL_RETRIES
 DEFAULT_RETRY_INTERVAL = 30
 DEFAULT_SUBGRAPH_TOTAL_RETRIES = 0
+DEFAULT_SUBGRAPH_RETRY_INTERVAL = 0
 
 DEFAULT_SEND_TASK_EVENTS = True
 
@@ -44,15 +54,62 @@ DISPATCH_TASK = 'cloudify.dispatch.dispatch'
 
 INSPECT_TIMEOUT = 30
 
+# upper bound (in seconds) of a single blocking wait on task results when no
+# timeout is given. waits are woken up by task terminations and cancel
+# requests, this only keeps the waiting thread interruptible
+MAX_WAIT_SLICE = 60
+
 
 def retry_failure_handler(task):
     """Basic on_success/on_failure handler that always returns retry"""
     return HandlerResult.retry()
 
 
+# guards the lazy creation of termination events
+_termination_event_lock = threading.Lock()
+# guards the done callbacks of tasks and their termination, so that each
+# callback is called exactly once
+_done_callbacks_lock = threading.Lock()
+
+
+class _ImmutableDict(dict):
+    """A dict that cannot be modified"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('{0} is immutable'.format(type(self).__name__))
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+# default local task kwargs, shared by all tasks
+_NO_KWARGS = _ImmutableDict()
+
+
+class _DeprecatedClassAttribute(object):
+    """A class attribute that warns when it is accessed"""
+
+    def __init__(self, value, message):
+        self.value = value
+        self.message = message
+
+    def __get__(self, instance, owner):
+        warnings.warn(self.message, DeprecationWarning, stacklevel=2)
+        return self.value
+
+
 class WorkflowTask(object):
     """A base class for workflow tasks"""
 
+    # large graphs hold many thousands of tasks
+    __slots__ = ('id', '_state', '_state_changes', 'async_result',
+                 'on_success', 'on_failure', 'info', 'error',
+                 'total_retries', 'retry_interval', 'is_terminated',
+                 '_termination_event', 'workflow_context',
+                 'send_task_events', 'containing_subgraph',
+                 'on_state_change', '_done_callbacks', 'current_retries',
+                 'execute_after', 'retry_delay')
+
     def __init__(self,
                  workflow_context,
                  task_id=None,
@@ -81,11 +138,16 @@ class WorkflowTask(object):
                            move on.
         :param total_retries: Maximum retry attempt for this task, in case
                               the handlers return a retry attempt.
-        :param retry_interval: Number of seconds to wait between retries
+        :param retry_interval: Number of seconds to wait between retries, or
+                               a dict describing a backoff policy (see
+                               cloudify.workflows.retry_policies)
         :param workflow_context: the CloudifyWorkflowContext instance
         """
         self.id = task_id or str(uuid.uuid4())
         self._state = TASK_PENDING
+        # (state, monotonic timestamp) of every state this task was in,
+        # only recorded once record_state_changes() was called
+        self._state_changes = None
         self.async_result = None
         self.on_success = on_success
         self.on_failure = on_failure
@@ -93,17 +155,25 @@ class WorkflowTask(object):
         self.error = None
         self.total_retries = total_retries
         self.retry_interval = retry_interval
-        self.terminated = Queue.Queue(maxsize=1)
         self.is_terminated = False
+        # only created once someone waits for this task to terminate
+        self._termination_event = None
         self.workflow_context = workflow_context
         self.send_task_events = send_task_events
         self.containing_subgraph = None
+        # called with this task whenever its state changes. set by the
+        # task graph this task is added to, so it can wake up its executor
+        self.on_state_change = None
+        self._done_callbacks = None
 
         self.current_retries = 0
         # timestamp for which the task should not be executed
         # by the task graph before reached, overridden by the task
         # graph during retries
         self.execute_after = time.time()
+        # seconds waited before this retry of the task (None if it is not
+        # a retry)
+        self.retry_delay = None
 
     def dump(self):
         return {
@@ -153,15 +223,102 @@ class WorkflowTask(object):
                          TASK_RESCHEDULED, TASK_SUCCEEDED, TASK_FAILED]:
             raise RuntimeError('Illegal state set on task: {0} '
                                '[task={1}]'.format(state, str(self)))
+        if self._state_changes is not None:
+            self._state_changes.append((state, utils.monotonic()))
         self._state = state
+        done_callbacks = None
         if state in TERMINATED_STATES:
-            self.is_terminated = True
-            self.terminated.put_nowait(True)
+            with _done_callbacks_lock:
+                self.is_terminated = True
+                done_callbacks = self._done_callbacks
+                self._done_callbacks = None
+            termination_event = self._termination_event
+            if termination_event is not None:
+                termination_event.set()
+        if self.on_state_change:
+            self.on_state_change(self)
+        if done_callbacks:
+            for callback in done_callbacks:
+                self._call_done_callback(callback)
+
+    def record_state_changes(self):
+        """
+        Record the time of every state change of this task from now on
+        (starting with its current state), see state_changes
+        """
+        if self._state_changes is None:
+            self._state_changes = [(self._state, utils.monotonic())]
+
+    @property
+    def state_changes(self):
+        """
+        :return: A list of (state, monotonic timestamp) of every state this
+                 task was in since record_state_changes() was called
+        """
+        return list(self._state_changes or ())
+
+    @property
+    def terminated(self):
+        """
+        A queue a single True is put in once this task terminates.
+
+        NOTE: This is deprecated, use wait_for_terminated() or
+        add_done_callback() instead.
+        """
+        warnings.warn('terminated is deprecated, use wait_for_terminated or '
+                      'add_done_callback instead', DeprecationWarning,
+                      stacklevel=2)
+        terminated = Queue.Queue(maxsize=1)
+        self.add_done_callback(lambda task: terminated.put_nowait(True))
+        return terminated
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback` with this task once it terminates (right away if it
+        already terminated). Callbacks are called once, in the thread
+        terminating the task.
+
+        :param callback: The callback
+        """
+        with _done_callbacks_lock:
+            if not self.is_terminated:
+                if self._done_callbacks is None:
+                    self._done_callbacks = []
+                self._done_callbacks.append(callback)
+                return
+        self._call_done_callback(callback)
+
+    def remove_done_callback(self, callback):
+        with _done_callbacks_lock:
+            if self._done_callbacks and callback in self._done_callbacks:
+                self._done_callbacks.remove(callback)
+
+    def _call_done_callback(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            self.workflow_context.logger.exception(
+                'Task done callback failed [task={0}]'.format(self))
 
     def wait_for_terminated(self, timeout=None):
+        """
+        Block until this task terminates
+
+        :param timeout: Max seconds to wait, None to wait until the task
+                        terminates
+        :raises Queue.Empty: if the timeout expired
+        """
         if self.is_terminated:
             return
-        self.terminated.get(timeout=timeout)
+        with _termination_event_lock:
+            if self._termination_event is None:
+                self._termination_event = threading.Event()
+            termination_event = self._termination_event
+        # the task may have terminated before the event was created
+        if self.is_terminated:
+            return
+        if not termination_event.wait(timeout) and not self.is_terminated:
+            raise Queue.Empty()
 
     def handle_task_terminated(self):
         if self.get_state() in (TASK_FAILED, TASK_RESCHEDULED):
@@ -173,12 +330,24 @@ class WorkflowTask(object):
             if any([self.total_retries == INFINITE_TOTAL_RETRIES,
                     self.current_retries < self.total_retries,
                     handler_result.ignore_total_retries]):
-                if handler_result.retry_after is None:
-                    handler_result.retry_after = self.retry_interval
                 if handler_result.retried_task is None:
-                    new_task = self.duplicate_for_retry(
-                        time.time() + handler_result.retry_after)
+                    execute_after = None
+                    if handler_result.retry_after is not None:
+                        execute_after = (time.time() +
+                                         handler_result.retry_after)
+                    new_task = self.duplicate_for_retry(execute_after)
                     handler_result.retried_task = new_task
+                    if handler_result.retry_after is None:
+                        handler_result.retry_after = new_task.retry_delay
+                else:
+                    # the handler created the retried task itself
+                    if handler_result.retry_after is None:
+                        handler_result.retry_after = self.next_retry_delay()
+                    new_task = handler_result.retried_task
+                    new_task.retry_delay = handler_result.retry_after
+                    new_task.execute_after = max(
+                        new_task.execute_after,
+                        time.time() + handler_result.retry_after)
             else:
                 handler_result.action = HandlerResult.HANDLER_FAIL
 
@@ -256,12 +425,30 @@ class WorkflowTask(object):
         suffix = self.info if self.info is not None else ''
         return '{0}({1})'.format(self.name, suffix)
 
-    def duplicate_for_retry(self, execute_after):
+    def next_retry_delay(self):
+        """
+        :return: Seconds to wait before the next retry of this task,
+                 according to its retry interval (policy)
         """
+        policy = create_retry_policy(self.retry_interval)
+        return policy.delay(self.current_retries + 1, self.retry_delay)
+
+    def duplicate_for_retry(self, execute_after=None):
+        """
+        :param execute_after: Timestamp the new instance should not be
+                              executed before (computed by the retry
+                              interval policy if not provided)
         :return: A new instance of this task with a new task id
         """
+        now = time.time()
+        if execute_after is None:
+            retry_delay = self.next_retry_delay()
+            execute_after = now + retry_delay
+        else:
+            retry_delay = max(0, execute_after - now)
         dup = self._duplicate()
         dup.execute_after = execute_after
+        dup.retry_delay = retry_delay
         dup.current_retries = self.current_retries + 1
         if dup.cloudify_context and 'operation' in dup.cloudify_context:
             op_ctx = dup.cloudify_context['operation']
@@ -291,8 +478,13 @@ class WorkflowTask(object):
 class RemoteWorkflowTask(WorkflowTask):
     """A WorkflowTask wrapping a celery based task"""
 
-    # cache for registered tasks queries to celery workers
-    cache = {}
+    __slots__ = ('_task_target', '_task_queue', '_kwargs',
+                 '_cloudify_context')
+
+    # no longer used, workers are looked up in worker_liveness instead
+    cache = _DeprecatedClassAttribute(
+        {}, 'RemoteWorkflowTask.cache is deprecated and no longer used, '
+            'use tasks.worker_liveness instead')
 
     def __init__(self,
                  kwargs,
@@ -355,20 +547,63 @@ class RemoteWorkflowTask(WorkflowTask):
         :return: a RemoteWorkflowTaskResult instance wrapping the
                  celery async result
         """
+        task = self._get_task()
+        if task is not None and self._prepare():
+            self._published(task.apply_async(task_id=self.id))
+        return self.async_result
+
+    def _get_task(self):
+        """
+        :return: The underlying celery task, None if the task failed (in
+                 which case its async_result wraps the error)
+        """
         try:
             task, self._task_queue, self._task_target = \
                 self.workflow_context.internal.handler.get_task(
                     self, queue=self._task_queue, target=self._task_target)
+            return task
+        except (exceptions.NonRecoverableError,
+                exceptions.RecoverableError) as e:
+            self._failed(e)
+            return None
+
+    def _prepare(self):
+        """
+        Verify the worker is alive and send the sending event.
+
+        :return: Whether the task can be published
+        """
+        try:
             self._verify_worker_alive()
+            self._flush_node_states()
             self.workflow_context.internal.send_task_event(TASK_SENDING, self)
             self.set_state(TASK_SENT)
-            async_result = task.apply_async(task_id=self.id)
-            self.async_result = RemoteWorkflowTaskResult(self, async_result)
+            return True
         except (exceptions.NonRecoverableError,
                 exceptions.RecoverableError) as e:
-            self.set_state(TASK_FAILED)
-            self.async_result = RemoteWorkflowErrorTaskResult(self, e)
-        return self.async_result
+            self._failed(e)
+            return False
+
+    def _flush_node_states(self):
+        # node instance states set before this task became executable are
+        # written before it is sent, it is not sent if they were not
+        try:
+            self.workflow_context.internal.handler.flush_node_states(
+                raise_errors=True)
+        except Exception as e:
+            raise exceptions.RecoverableError(
+                'Failed writing node instance states: {0}'.format(e))
+
+    def _failed(self, error):
+        self.set_state(TASK_FAILED)
+        self.async_result = RemoteWorkflowErrorTaskResult(self, error)
+
+    def _published(self, async_result):
+        self.async_result = RemoteWorkflowTaskResult(self, async_result)
+
+    def handle_task_terminated(self):
+        self.workflow_context.internal.handler.remote_task_terminated(self)
+        return super(RemoteWorkflowTask, self).handle_task_terminated()
 
     def is_local(self):
         return False
@@ -416,25 +651,48 @@ class RemoteWorkflowTask(WorkflowTask):
     def _verify_worker_alive(self):
         verify_worker_alive(self.name,
                             self.target,
-                            self._get_registered)
-
-    def _get_registered(self):
-        # import here because this only applies in remote execution
-        # environments
-        from cloudify_agent.app import app
-
-        worker_name = 'celery@{0}'.format(self.target)
-        inspect = app.control.inspect(destination=[worker_name],
-                                      timeout=INSPECT_TIMEOUT)
-        registered = inspect.registered()
-        if registered is None or worker_name not in registered:
-            return None
-        return set(registered[worker_name])
+                            lambda: worker_liveness.get(self.target))
+
+
+def send_remote_tasks(workflow_tasks):
+    """
+    Send remote tasks that became executable together.
+
+    The workers of all tasks are inspected in a single broadcast (if they
+    are not cached already), then the tasks are grouped by queue and each
+    group is published in one batch over a shared broker channel.
+
+    :param workflow_tasks: RemoteWorkflowTask instances
+    """
+    if len(workflow_tasks) == 1:
+        workflow_tasks[0].apply_async()
+        return
+    celery_tasks = []
+    for workflow_task in workflow_tasks:
+        celery_task = workflow_task._get_task()
+        if celery_task is not None:
+            celery_tasks.append((workflow_task, celery_task))
+    worker_liveness.get_many(
+        [workflow_task.target for workflow_task, _ in celery_tasks])
+    queues = OrderedDict()
+    for workflow_task, celery_task in celery_tasks:
+        if workflow_task._prepare():
+            queues.setdefault(workflow_task.queue, []).append(
+                (workflow_task, celery_task))
+    for queue_tasks in queues.values():
+        handler = queue_tasks[0][0].workflow_context.internal.handler
+        async_results = handler.publish_tasks(
+            [(t.id, queued) for t, queued in queue_tasks])
+        for (workflow_task, _), async_result in zip(queue_tasks,
+                                                    async_results):
+            workflow_task._published(async_result)
 
 
 class LocalWorkflowTask(WorkflowTask):
     """A WorkflowTask wrapping a local callable"""
 
+    __slots__ = ('local_task', 'node', 'kwargs', '_name')
+
     def __init__(self,
                  local_task,
                  workflow_context,
@@ -484,7 +742,7 @@ class LocalWorkflowTask(WorkflowTask):
             send_task_events=send_task_events)
         self.local_task = local_task
         self.node = node
-        self.kwargs = kwargs or {}
+        self.kwargs = kwargs or _NO_KWARGS
         self._name = name or local_task.__name__
 
     def dump(self):
@@ -502,9 +760,11 @@ class LocalWorkflowTask(WorkflowTask):
 
         def local_task_wrapper():
             try:
+                self.set_state(TASK_STARTED)
                 self.workflow_context.internal.send_task_event(TASK_STARTED,
                                                                self)
-                result = self.local_task(**self.kwargs)
+                result = self.workflow_context.internal.run_local_task(
+                    self.local_task, self.kwargs)
                 self.workflow_context.internal.send_task_event(
                     TASK_SUCCEEDED, self, event={'result': str(result)})
                 self.async_result._holder.result = result
@@ -552,11 +812,16 @@ class LocalWorkflowTask(WorkflowTask):
 
 
 # NOP tasks class
+def _nop():
+    pass
+
+
 class NOPLocalWorkflowTask(LocalWorkflowTask):
 
+    __slots__ = ()
+
     def __init__(self, workflow_context):
-        super(NOPLocalWorkflowTask, self).__init__(lambda: None,
-                                                   workflow_context)
+        super(NOPLocalWorkflowTask, self).__init__(_nop, workflow_context)
 
     @property
     def name(self):
@@ -606,20 +871,41 @@ class WorkflowTaskResult(object):
             raise api.ExecutionCancelled()
 
     def _wait_for_task_terminated(self):
-        while True:
-            self._check_execution_cancelled()
-            try:
-                self.task.wait_for_terminated(timeout=1)
-                break
-            except Queue.Empty:
-                continue
+        self.wait()
 
     def _sleep(self, seconds):
-        while seconds > 0:
-            self._check_execution_cancelled()
-            sleep_time = 1 if seconds > 1 else seconds
-            time.sleep(sleep_time)
-            seconds -= sleep_time
+        if seconds:
+            _wait_for([], seconds, return_when_any=False)
+        self._check_execution_cancelled()
+
+    def done(self):
+        """
+        :return: Did the task attempt currently tracked by this result
+                 terminate
+        """
+        return self.task.is_terminated
+
+    def wait(self, timeout=None):
+        """
+        Block until the task attempt currently tracked by this result
+        terminates. Retries are only executed by `get`.
+
+        :param timeout: Max seconds to wait, None to wait until the task
+                        terminates
+        :return: True if the task terminated, False if the timeout expired
+        :raises api.ExecutionCancelled: if the execution is cancelled while
+                                        waiting
+        """
+        return bool(_wait_for([self], timeout, return_when_any=False))
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback` with this result once the task attempt it currently
+        tracks terminates (right away if it already terminated).
+
+        :param callback: The callback
+        """
+        self.task.add_done_callback(lambda task: callback(self))
 
     def get(self, retry_on_failure=True):
         """
@@ -702,6 +988,75 @@ class LocalWorkflowTaskResult(WorkflowTaskResult):
             return self._holder.result
 
 
+def _wait_for(results, timeout, return_when_any):
+    """
+    Block until all (or any) of the results are done, the execution is
+    cancelled or the timeout expires. Task terminations and cancel requests
+    wake the waiting thread right away.
+
+    :return: The results that are done
+    :raises api.ExecutionCancelled: if the execution is cancelled
+    """
+    wake_up = threading.Event()
+
+    def callback(*_):
+        wake_up.set()
+    api.add_cancel_listener(callback)
+    for result in results:
+        result.task.add_done_callback(callback)
+    try:
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wake_up.clear()
+            WorkflowTaskResult._check_execution_cancelled()
+            done = [result for result in results if result.done()]
+            if results and (len(done) == len(results) or
+                            (return_when_any and done)):
+                return done
+            if deadline is None:
+                # a timed wait keeps the thread interruptible (e.g. by a
+                # keyboard interrupt in local workflows)
+                remaining = MAX_WAIT_SLICE
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return done
+            wake_up.wait(remaining)
+    finally:
+        api.remove_cancel_listener(callback)
+        for result in results:
+            result.task.remove_done_callback(callback)
+
+
+def gather(results, retry_on_failure=True):
+    """
+    Get the results of several tasks
+
+    :param results: WorkflowTaskResult instances
+    :param retry_on_failure: see WorkflowTaskResult.get
+    :return: A list of the task results, in the order of `results`
+    """
+    results = list(results)
+    _wait_for(results, None, return_when_any=False)
+    return [result.get(retry_on_failure=retry_on_failure)
+            for result in results]
+
+
+def wait_any(results, timeout=None):
+    """
+    Block until any of the task results is done
+
+    :param results: WorkflowTaskResult instances
+    :param timeout: Max seconds to wait, None to wait until a task
+                    terminates
+    :return: The results that are done (an empty list if the timeout
+             expired)
+    :raises api.ExecutionCancelled: if the execution is cancelled while
+                                    waiting
+    """
+    return _wait_for(list(results), timeout, return_when_any=True)
+
+
 class StubAsyncResult(object):
     """Stub async result that always returns None"""
     result = None
@@ -748,12 +1103,7 @@ class HandlerResult(object):
 
 def verify_worker_alive(name, target, get_registered):
 
-    cache = RemoteWorkflowTask.cache
-    registered = cache.get(target)
-    if not registered:
-        registered = get_registered()
-        cache[target] = registered
-
+    registered = get_registered()
     if registered is None:
         raise exceptions.RecoverableError(
             'Timed out querying worker celery@{0} for its registered '
@@ -765,3 +1115,27 @@ def verify_worker_alive(name, target, get_registered):
             'Registered tasks are: {2}. (This probably means the agent '
             'configuration is invalid) [{3}]'.format(
                 DISPATCH_TASK, target, registered, name))
+
+
+def _inspect_registered(targets):
+    """
+    :return: The tasks registered by each of the target workers that
+             replied within INSPECT_TIMEOUT
+    """
+    # import here because this only applies in remote execution
+    # environments
+    from cloudify_agent.app import app
+
+    worker_names = dict(('celery@{0}'.format(target), target)
+                        for target in targets)
+    # the broadcast returns as soon as all destinations replied
+    inspect = app.control.inspect(destination=list(worker_names),
+                                  timeout=INSPECT_TIMEOUT)
+    registered = inspect.registered() or {}
+    return dict((worker_names[worker_name], set(worker_tasks))
+                for worker_name, worker_tasks in registered.items()
+                if worker_name in worker_names)
+
+
+# registered tasks of the celery workers remote tasks are sent to
+worker_liveness = WorkerLivenessCache(_inspect_registered)
@@ -17,11 +17,40 @@
 import os
 import json
 import time
+import errno
+import heapq
+import logging
+import Queue
+import itertools
 
-import networkx as nx
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 
 from cloudify.workflows import api
 from cloudify.workflows import tasks
+from cloudify.workflows import checkpoint
+from cloudify.workflows.timeline import Timeline
+from cloudify.workflows.graph_backends import NetworkxGraph, create_graph
+
+# Upper bound (in seconds) on how long execute() blocks waiting for a task
+# state change. Task state changes, due retries and cancel requests wake the
+# executor immediately, this only bounds how late a WORKFLOW_TASK_DUMP request
+# (or a cancel flag set without notifying listeners) is noticed.
+MAX_STATE_CHANGE_WAIT = 1
+
+# executable tasks are sent in the order they became executable
+SCHEDULING_FIFO = 'fifo'
+# executable tasks with the longest remaining path of tasks depending on
+# them are sent first. only makes a difference when concurrency is limited
+SCHEDULING_CRITICAL_PATH = 'critical_path'
+
+# a TaskSequence adding a fork-join after another fork-join connects them
+# through a barrier task (|A| + |B| dependencies) instead of making every
+# task of one depend on every task of the other (|A| * |B| dependencies)
+# once the latter exceeds this number
+FORKJOIN_BARRIER_THRESHOLD = 16
 
 
 class TaskDependencyGraph(object):
@@ -29,21 +58,119 @@ class TaskDependencyGraph(object):
     A task graph builder
 
     :param workflow_context: A WorkflowContext instance (used for logging)
+    :param default_subgraph_task_config: Default configuration for subgraph
+                                         tasks created by this graph
+    :param graph_backend: The graph implementation storing tasks and their
+                          dependencies (see cloudify.workflows.graph_backends),
+                          defaults to the networkx backend
+    :param concurrency_limits: A dict with optional 'total', 'per_target'
+                               and 'per_operation' keys bounding the number
+                               of operation tasks in flight
+                               (see ConcurrencyLimits)
+    :param scheduling: The order in which executable tasks are sent, one of
+                       SCHEDULING_FIFO (default) or SCHEDULING_CRITICAL_PATH
+    :param operation_durations: A dict of known operation durations (in
+                                seconds) used to estimate critical paths.
+                                Durations of operations executed by this
+                                graph are recorded as well
+    :param checkpoint_path: Path of a checkpoint log (see
+                            cloudify.workflows.checkpoint) the graph
+                            structure and task states are appended to while
+                            executing. If the log exists when execution
+                            starts, tasks that already succeeded according to
+                            it are not executed again
+    :param record_timeline: Record when the tasks of the graph change their
+                            state, to report where the time of an execution
+                            went (see timeline.Timeline). Defaults to True if
+                            the WORKFLOW_TIMELINE environment variable is
+                            'true' or WORKFLOW_TIMELINE_TRACE is set
     """
 
     def __init__(self, workflow_context,
-                 default_subgraph_task_config=None):
+                 default_subgraph_task_config=None,
+                 graph_backend=None,
+                 concurrency_limits=None,
+                 scheduling=None,
+                 operation_durations=None,
+                 checkpoint_path=None,
+                 record_timeline=None):
         self.ctx = workflow_context
-        self.graph = nx.DiGraph()
+        self._graph = create_graph(graph_backend)
+        self.concurrency = ConcurrencyLimits(**(concurrency_limits or {}))
+        scheduling = scheduling or SCHEDULING_FIFO
+        if scheduling not in (SCHEDULING_FIFO, SCHEDULING_CRITICAL_PATH):
+            raise ValueError('Unknown task scheduling: {0}'.format(
+                scheduling))
+        self.scheduling = scheduling
+        self.operation_durations = OperationDurations(operation_durations)
+        self.checkpoint_path = checkpoint_path
+        # task id -> checkpoint key (see _checkpoint_key)
+        self._checkpoint_keys = {}
+        self._checkpoint_signatures = {}
+        self._checkpoint_log = None
+        if record_timeline is None:
+            record_timeline = (
+                os.environ.get('WORKFLOW_TIMELINE', '').lower() == 'true' or
+                bool(os.environ.get('WORKFLOW_TIMELINE_TRACE')))
+        self.record_timeline = record_timeline
+        # records of tasks terminated during the last execution, see
+        # timeline.Timeline.report
+        self.timeline = Timeline()
+        # task id -> id of the task whose termination made it executable
+        self._released_by = {}
         default_subgraph_task_config = default_subgraph_task_config or {}
         self._default_subgraph_task_config = default_subgraph_task_config
+        # tasks whose state changed while execute() is running. the executor
+        # blocks on this queue instead of polling the graph
+        self._state_changes = Queue.Queue()
+        self._executing = False
+        # scheduler state, only maintained while execute() is running.
+        # a task's remaining dependencies are its out edges in self._graph, so
+        # only tasks whose out degree may have dropped to zero (and newly
+        # added tasks) are checked for being executable, instead of every
+        # task in the graph on every pass.
+        self._candidates = []
+        # min heap of (execute_after, sequence, task) of tasks waiting for
+        # their execution timestamp (i.e. retries)
+        self._delayed = []
+        self._delayed_sequence = itertools.count()
+        self._terminated = OrderedDict()
+        # executable tasks held back by the concurrency limits, in the order
+        # they became executable. re-checked once a slot is released.
+        self._throttled = []
+        self._slots_released = False
+        # task id -> (operation, send time) of operation tasks in flight
+        self._sent = {}
+        # task id -> estimated length of the path of tasks depending on it
+        # (critical path scheduling only)
+        self._priorities = {}
+
+    @property
+    def graph(self):
+        """
+        The graph of the tasks and their dependencies. A networkx.DiGraph of
+        task ids with each task in the 'task' attribute of its node with the
+        networkx backend (the default), the CompactGraph otherwise
+        """
+        if isinstance(self._graph, NetworkxGraph):
+            return self._graph.digraph
+        return self._graph
 
     def add_task(self, task):
         """Add a WorkflowTask to this graph
 
         :param task: The task
         """
-        self.graph.add_node(task.id, task=task)
+        task.on_state_change = self._task_state_changed
+        if self.record_timeline:
+            task.record_state_changes()
+        self._graph.add_node(task.id, task)
+        if self.checkpoint_path:
+            key = self._checkpoint_key(task)
+            if self._checkpoint_log:
+                self._checkpoint_log.task(task, key)
+        if self._executing:
+            self._add_candidate(task)
 
     def get_task(self, task_id):
         """Get a task instance that was inserted to this graph by its id
@@ -52,8 +179,7 @@ class TaskDependencyGraph(object):
         :return: a WorkflowTask instance for the requested task if found.
                  None, otherwise.
         """
-        data = self.graph.node.get(task_id)
-        return data['task'] if data is not None else None
+        return self._graph.get(task_id)
 
     def remove_task(self, task):
         """Remove the provided task from the graph
@@ -63,8 +189,10 @@ class TaskDependencyGraph(object):
         if task.is_subgraph:
             for subgraph_task in task.tasks.values():
                 self.remove_task(subgraph_task)
-        if task.id in self.graph:
-            self.graph.remove_node(task.id)
+        if task.id in self._graph:
+            dependents = self._graph.predecessors(task.id)
+            self._graph.remove_node(task.id)
+            self._dependencies_removed(dependents)
 
     # src depends on dst
     def add_dependency(self, src_task, dst_task):
@@ -77,13 +205,18 @@ class TaskDependencyGraph(object):
         :param src_task: The source task
         :param dst_task: The target task
         """
-        if not self.graph.has_node(src_task.id):
+        if not self._graph.has_node(src_task.id):
             raise RuntimeError('source task {0} is not in graph (task id: '
                                '{1})'.format(src_task, src_task.id))
-        if not self.graph.has_node(dst_task.id):
+        if not self._graph.has_node(dst_task.id):
             raise RuntimeError('destination task {0} is not in graph (task '
                                'id: {1})'.format(dst_task, dst_task.id))
-        self.graph.add_edge(src_task.id, dst_task.id)
+        self._add_edge(src_task.id, dst_task.id)
+
+    def _add_edge(self, src_task_id, dst_task_id):
+        self._graph.add_edge(src_task_id, dst_task_id)
+        if self._checkpoint_log:
+            self._checkpoint_log.dependency(src_task_id, dst_task_id)
 
     def sequence(self):
         """
@@ -117,36 +250,228 @@ class TaskDependencyGraph(object):
         still being executed.
         """
 
-        while True:
-
-            if self._is_execution_cancelled():
-                raise api.ExecutionCancelled()
-
-            self._check_dump_request()
-
-            # handle all terminated tasks
-            # it is important this happens before handling
-            # executable tasks so we get to make tasks executable
-            # and then execute them in this iteration (otherwise, it would
-            # be the next one)
-            for task in self._terminated_tasks():
-                self._handle_terminated_task(task)
+        self._executing = True
+        api.add_cancel_listener(self._wake_up)
+        try:
+            # tasks were added (and may have changed their state) before
+            # execution started, so a single full pass seeds the scheduler
+            self._candidates = []
+            self._delayed = []
+            self._terminated = OrderedDict()
+            self._throttled = []
+            self._slots_released = False
+            self._sent = {}
+            self._priorities = {}
+            self.concurrency.reset()
+            self.timeline.reset()
+            self._released_by = {}
+            self._open_checkpoint()
+            for task in list(self.tasks_iter()):
+                if task.get_state() in tasks.TERMINATED_STATES:
+                    self._terminated[task.id] = task
+                else:
+                    self._candidates.append(task)
+
+            while True:
+
+                if self._is_execution_cancelled():
+                    raise api.ExecutionCancelled()
+
+                self._check_dump_request()
+
+                # handle all terminated tasks
+                # it is important this happens before handling
+                # executable tasks so we get to make tasks executable
+                # and then execute them in this iteration (otherwise, it
+                # would be the next one)
+                for task in self._terminated_tasks():
+                    self._handle_terminated_task(task)
+
+                # handle all executable tasks, remote tasks are sent
+                # together once all of them were handled
+                remote_tasks = []
+                for task in self._executable_tasks():
+                    self._handle_executable_task(task, remote_tasks)
+                if remote_tasks:
+                    tasks.send_remote_tasks(remote_tasks)
+
+                # no more tasks to process, time to move on
+                if len(self._graph) == 0:
+                    self._write_timeline()
+                    return
+                # wait for something to happen and do it all over again
+                elif not (self._candidates or self._slots_released):
+                    self._wait_for_state_change()
+        finally:
+            api.remove_cancel_listener(self._wake_up)
+            self._executing = False
+            self._candidates = []
+            self._delayed = []
+            self._terminated = OrderedDict()
+            self._throttled = []
+            self._sent = {}
+            self._priorities = {}
+            self._released_by = {}
+            self.timeline.stop()
+            if self._checkpoint_log:
+                self._checkpoint_log.close()
+                self._checkpoint_log = None
+
+    def _checkpoint_key(self, task):
+        """
+        :return: The key the task is logged with: its signature and the
+                 number of tasks with the same signature added before it.
+                 A retried task keeps the key of the task it replaces.
+        """
+        key = self._checkpoint_keys.get(task.id)
+        if key is None:
+            signature = checkpoint.task_signature(task)
+            ordinal = self._checkpoint_signatures.get(signature, 0)
+            self._checkpoint_signatures[signature] = ordinal + 1
+            key = '{0}#{1}'.format(signature, ordinal)
+            self._checkpoint_keys[task.id] = key
+        return key
+
+    def remove_checkpoint(self):
+        """
+        Remove the checkpoint log, once the workflow execution it was
+        written for succeeded and there is nothing left to resume
+        """
+        if not self.checkpoint_path:
+            return
+        try:
+            os.remove(self.checkpoint_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _open_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        if os.path.exists(self.checkpoint_path):
+            self._skip_succeeded_tasks(checkpoint.load(self.checkpoint_path))
+        log = checkpoint.CheckpointLog(self.checkpoint_path)
+        for task in self.tasks_iter():
+            log.task(task, self._checkpoint_key(task))
+            if task.get_state() != tasks.TASK_PENDING:
+                log.state(task)
+        for src_task_id, dst_task_id in self._graph.edges_iter():
+            log.dependency(src_task_id, dst_task_id)
+        self._checkpoint_log = log
+
+    def _skip_succeeded_tasks(self, graph_checkpoint):
+        """
+        Mark pending tasks that succeeded according to a checkpoint as
+        succeeded, without executing them.
 
-            # handle all executable tasks
-            for task in self._executable_tasks():
-                self._handle_executable_task(task)
+        Their success handlers are not called: results of the previous
+        execution are not kept, and a task only succeeds for good once its
+        success handler accepted the result. Subgraphs are not marked, they
+        succeed once the tasks they contain terminate.
+        """
+        skipped = 0
+        for task in list(self.tasks_iter()):
+            if task.is_subgraph or task.get_state() != tasks.TASK_PENDING:
+                continue
+            key = self._checkpoint_key(task)
+            if graph_checkpoint.state(key) != tasks.TASK_SUCCEEDED:
+                continue
+            task.on_success = None
+            task.async_result = tasks.StubAsyncResult()
+            task.set_state(tasks.TASK_SUCCEEDED)
+            skipped += 1
+        if skipped:
+            self.ctx.logger.info(
+                'Resuming from checkpoint {0}: skipping {1} tasks that '
+                'already succeeded'.format(self.checkpoint_path, skipped))
+
+    def _task_state_changed(self, task):
+        if self._executing:
+            self._state_changes.put(task)
+
+    def _wake_up(self):
+        self._state_changes.put(None)
+
+    def _wait_for_state_change(self):
+        """
+        Block until a task changes its state, a cancel request arrives or
+        the next retried task is due, whichever comes first.
+        """
+        timeout = MAX_STATE_CHANGE_WAIT
+        next_execute_after = self._next_execute_after()
+        if next_execute_after is not None:
+            timeout = max(0, min(timeout, next_execute_after - time.time()))
+        if self._checkpoint_log:
+            self._checkpoint_log.sync_if_due()
+        try:
+            task = self._state_changes.get(timeout=timeout)
+        except Queue.Empty:
+            return
+        self._record_state_change(task)
+        self._drain_state_changes()
 
-            # no more tasks to process, time to move on
-            if len(self.graph.node) == 0:
+    def _drain_state_changes(self):
+        while True:
+            try:
+                task = self._state_changes.get_nowait()
+            except Queue.Empty:
                 return
-            # sleep some and do it all over again
-            else:
-                time.sleep(0.1)
+            self._record_state_change(task)
+
+    def _record_state_change(self, task):
+        if task is not None and task.get_state() in tasks.TERMINATED_STATES:
+            self._terminated[task.id] = task
+            if self.concurrency.release(task):
+                self._slots_released = True
+            sent = self._sent.pop(task.id, None)
+            if sent and task.get_state() == tasks.TASK_SUCCEEDED:
+                operation, sent_at = sent
+                self.operation_durations.record(operation,
+                                                time.time() - sent_at)
+
+    def _delay(self, task):
+        heapq.heappush(self._delayed, (task.execute_after,
+                                       next(self._delayed_sequence),
+                                       task))
+
+    def _next_execute_after(self):
+        """
+        :return: The earliest execution timestamp of a pending task that is
+                 not yet due, or None if there is no such task
+        """
+        if not self._delayed:
+            return None
+        return self._delayed[0][0]
 
     @staticmethod
     def _is_execution_cancelled():
         return api.has_cancel_request()
 
+    def _add_candidate(self, task):
+        """
+        Mark a task as possibly executable. Subgraph tasks without
+        dependencies also mark their (transitively) contained tasks, as
+        those may have been waiting on the subgraph dependencies only.
+        """
+        self._candidates.append(task)
+        if task.is_subgraph and not self._graph.out_degree(task.id):
+            for subgraph_task in task.tasks.values():
+                if not self._graph.out_degree(subgraph_task.id):
+                    self._add_candidate(subgraph_task)
+
+    def _dependencies_removed(self, dependents, released_by=None):
+        """
+        :param dependents: ids of tasks that just lost a dependency
+        :param released_by: id of the terminated task they depended on
+        """
+        if not self._executing:
+            return
+        for task_id in dependents:
+            if not self._graph.out_degree(task_id):
+                if released_by is not None:
+                    self._released_by[task_id] = released_by
+                self._add_candidate(self.get_task(task_id))
+
     def _executable_tasks(self):
         """
         A task is executable if it is in pending state
@@ -154,32 +479,79 @@ class TaskDependencyGraph(object):
         already terminated) and its execution timestamp is smaller then the
         current timestamp
 
-        :return: An iterator for executable tasks
+        Only tasks that might have become executable since the last call
+        are checked: tasks added to the graph, dependents of removed tasks
+        and delayed tasks that are now due.
+
+        Executable tasks exceeding the concurrency limits stay pending until
+        an in flight task terminates.
+
+        :return: A list of executable tasks
         """
         now = time.time()
-        return (task for task in self.tasks_iter()
-                if task.get_state() == tasks.TASK_PENDING and
-                task.execute_after <= now and
-                not (task.containing_subgraph and
+        candidates = self._candidates
+        self._candidates = []
+        if self._slots_released:
+            # tasks held back the longest go first
+            candidates = self._throttled + candidates
+            self._throttled = []
+            self._slots_released = False
+        while self._delayed and self._delayed[0][0] <= now:
+            candidates.append(heapq.heappop(self._delayed)[2])
+        if self.scheduling == SCHEDULING_CRITICAL_PATH:
+            candidates.sort(key=self._priority, reverse=True)
+
+        executable = []
+        seen = set()
+        for task in candidates:
+            if task.id in seen or task.id not in self._graph:
+                continue
+            seen.add(task.id)
+            if self.concurrency.saturated and \
+                    self.concurrency.applies_to(task):
+                # no need to check it now, it is checked again when a
+                # slot is released
+                self._throttled.append(task)
+                continue
+            if (task.get_state() != tasks.TASK_PENDING or
+                    (task.containing_subgraph and
                      task.containing_subgraph.get_state() ==
-                     tasks.TASK_FAILED) and
-                not self._task_has_dependencies(task))
+                     tasks.TASK_FAILED) or
+                    self._task_has_dependencies(task)):
+                continue
+            if task.execute_after > now:
+                self._delay(task)
+                continue
+            if not self.concurrency.acquire(task):
+                self._throttled.append(task)
+                continue
+            executable.append(task)
+        return executable
 
     def _terminated_tasks(self):
         """
         A task is terminated if it is in 'succeeded' or 'failed' state
 
+        Terminated tasks are collected from task state changes rather than
+        by scanning the graph.
+
         :return: An iterator for terminated tasks
         """
-        return (task for task in self.tasks_iter()
-                if task.get_state() in tasks.TERMINATED_STATES)
+        self._drain_state_changes()
+        while self._terminated:
+            _, task = self._terminated.popitem(last=False)
+            if self.get_task(task.id) is task:
+                yield task
+            # handling a terminated task may terminate others (e.g. the
+            # subgraph containing it)
+            self._drain_state_changes()
 
     def _task_has_dependencies(self, task):
         """
         :param task: The task
         :return: Does this task have any dependencies
         """
-        return (len(self.graph.succ.get(task.id, {})) > 0 or
+        return (self._graph.out_degree(task.id) > 0 or
                 (task.containing_subgraph and self._task_has_dependencies(
                     task.containing_subgraph)))
 
@@ -187,17 +559,91 @@ class TaskDependencyGraph(object):
         """
         An iterator on tasks added to the graph
         """
-        return (data['task'] for _, data in self.graph.nodes_iter(data=True))
+        return self._graph.nodes_iter()
 
-    def _handle_executable_task(self, task):
-        """Handle executable task"""
+    def _priority(self, task):
+        """
+        :return: The estimated duration of the longest path of tasks that
+                 depend (directly or transitively) on the task, the task
+                 itself included
+        """
+        priorities = self._priorities
+        if task.id in priorities:
+            return priorities[task.id]
+        # iterative post order traversal, graphs may be deeper than the
+        # recursion limit
+        visiting = set()
+        stack = [task]
+        while stack:
+            current = stack[-1]
+            if current.id in priorities:
+                stack.pop()
+                continue
+            downstream = self._downstream_tasks(current)
+            if current.id not in visiting:
+                visiting.add(current.id)
+                stack.extend(t for t in downstream
+                             if t.id not in priorities and
+                             t.id not in visiting)
+                continue
+            stack.pop()
+            operation = _task_operation(current)
+            weight = (self.operation_durations.estimate(operation)
+                      if operation is not None else 0)
+            priorities[current.id] = weight + max(
+                [priorities.get(t.id, 0) for t in downstream] or [0])
+        return priorities[task.id]
+
+    def _downstream_tasks(self, task):
+        """
+        :return: Tasks depending on the task: its dependents and the
+                 subgraph containing it
+        """
+        if task.id not in self._graph:
+            return []
+        downstream = [self.get_task(task_id)
+                      for task_id in self._graph.predecessors(task.id)]
+        subgraph = task.containing_subgraph
+        if subgraph is not None and subgraph.id in self._graph:
+            downstream.append(subgraph)
+        return downstream
+
+    def _handle_executable_task(self, task, remote_tasks=None):
+        """
+        Handle executable task
+
+        :param remote_tasks: If given, remote tasks are added to it to be
+                             sent in a batch instead of right away
+        """
+        if isinstance(task, _BarrierTask):
+            # nothing to execute, its dependents may run right away
+            task.set_state(tasks.TASK_SUCCEEDED)
+            self._handle_terminated_task(task)
+            return
+        operation = _task_operation(task)
+        if operation is not None:
+            self._sent[task.id] = (operation, time.time())
         task.set_state(tasks.TASK_SENDING)
-        task.apply_async()
+        if self._checkpoint_log:
+            self._checkpoint_log.state(task)
+        if (remote_tasks is not None and
+                isinstance(task, tasks.RemoteWorkflowTask)):
+            remote_tasks.append(task)
+        else:
+            task.apply_async()
 
     def _handle_terminated_task(self, task):
         """Handle terminated task"""
 
+        released_by = self._released_by.pop(task.id, None)
+        if self.record_timeline:
+            self.timeline.task_terminated(task, released_by)
         handler_result = task.handle_task_terminated()
+        if (self._checkpoint_log and
+                handler_result.action != tasks.HandlerResult.HANDLER_RETRY):
+            # logged once handled: a task that succeeded but whose success
+            # handler asked for a retry has not succeeded for good
+            self._checkpoint_log.state(task)
         if handler_result.action == tasks.HandlerResult.HANDLER_FAIL:
             if isinstance(task, SubgraphTask) and task.failed_task:
                 task = task.failed_task
@@ -206,17 +652,42 @@ class TaskDependencyGraph(object):
                 message = '{0} -> {1}'.format(message, task.error)
             raise RuntimeError(message)
 
-        dependents = self.graph.predecessors(task.id)
-        removed_edges = [(dependent, task.id)
-                         for dependent in dependents]
-        self.graph.remove_edges_from(removed_edges)
-        self.graph.remove_node(task.id)
+        dependents = self._graph.predecessors(task.id)
+        self._graph.remove_node(task.id)
+        self._priorities.pop(task.id, None)
+        key = self._checkpoint_keys.pop(task.id, None)
         if handler_result.action == tasks.HandlerResult.HANDLER_RETRY:
             new_task = handler_result.retried_task
+            if key is not None:
+                self._checkpoint_keys[new_task.id] = key
+            self._released_by[new_task.id] = task.id
             self.add_task(new_task)
-            added_edges = [(dependent, new_task.id)
-                           for dependent in dependents]
-            self.graph.add_edges_from(added_edges)
+            for dependent in dependents:
+                self._add_edge(dependent, new_task.id)
+        self._dependencies_removed(dependents, released_by=task.id)
+
+    def write_timeline(self, path):
+        """
+        Write the timeline of the last execution as a Chrome trace (open
+        with chrome://tracing or https://ui.perfetto.dev)
+
+        :param path: The trace file path
+        """
+        with open(path, 'w') as f:
+            f.write(json.dumps(self.timeline.chrome_trace()))
+
+    def _write_timeline(self):
+        # the report is only built for graphs recording a timeline, as
+        # workflow loggers usually have debug logging enabled
+        if not self.record_timeline:
+            return
+        if self.ctx.logger.isEnabledFor(logging.DEBUG):
+            self.ctx.logger.debug('Task graph execution report: {0}'.format(
+                json.dumps(self.timeline.report())))
+        timeline_trace = os.environ.get('WORKFLOW_TIMELINE_TRACE')
+        if timeline_trace:
+            self.write_timeline('{0}.{1}'.format(timeline_trace,
+                                                 time.time()))
 
     def _check_dump_request(self):
         task_dump = os.environ.get('WORKFLOW_TASK_DUMP')
@@ -227,7 +698,7 @@ class TaskDependencyGraph(object):
         with open(task_dump_path, 'w') as f:
             f.write(json.dumps({
                 'tasks': [task.dump() for task in self.tasks_iter()],
-                'edges': [[s, t] for s, t in self.graph.edges_iter()]}))
+                'edges': [[s, t] for s, t in self._graph.edges_iter()]}))
 
 
 class forkjoin(object):
@@ -247,10 +718,14 @@ class TaskSequence(object):
     graph
 
     :param graph: The TaskDependencyGraph instance
+    :param barrier_threshold: Number of dependencies between consecutive
+                              fork-joins above which they are connected
+                              through a barrier task
     """
 
-    def __init__(self, graph):
+    def __init__(self, graph, barrier_threshold=FORKJOIN_BARRIER_THRESHOLD):
         self.graph = graph
+        self.barrier_threshold = barrier_threshold
         self.last_fork_join_tasks = None
 
     def add(self, *tasks):
@@ -273,17 +748,67 @@ class TaskSequence(object):
                 fork_join_tasks = fork_join_tasks.tasks
             else:
                 fork_join_tasks = [fork_join_tasks]
+            last_fork_join_tasks = self.last_fork_join_tasks
+            if last_fork_join_tasks is not None and self._use_barrier(
+                    last_fork_join_tasks, fork_join_tasks):
+                barrier = _BarrierTask(fork_join_tasks[0].workflow_context)
+                self.graph.add_task(barrier)
+                for last_fork_join_task in last_fork_join_tasks:
+                    self.graph.add_dependency(barrier, last_fork_join_task)
+                last_fork_join_tasks = [barrier]
             for task in fork_join_tasks:
                 self.graph.add_task(task)
-                if self.last_fork_join_tasks is not None:
-                    for last_fork_join_task in self.last_fork_join_tasks:
+                if last_fork_join_tasks is not None:
+                    for last_fork_join_task in last_fork_join_tasks:
                         self.graph.add_dependency(task, last_fork_join_task)
             if fork_join_tasks:
                 self.last_fork_join_tasks = fork_join_tasks
 
+    def _use_barrier(self, last_fork_join_tasks, fork_join_tasks):
+        last_size = len(last_fork_join_tasks)
+        size = len(fork_join_tasks)
+        return (last_size > 1 and size > 1 and
+                last_size * size > self.barrier_threshold)
+
+
+class _BarrierTask(tasks.WorkflowTask):
+    """
+    A task joining the tasks it depends on for the tasks depending on it.
+    It is resolved by the graph executor itself, nothing is sent.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, workflow_context):
+        super(_BarrierTask, self).__init__(workflow_context,
+                                           info='barrier',
+                                           total_retries=0,
+                                           send_task_events=False)
+
+    @property
+    def cloudify_context(self):
+        return None
+
+    @property
+    def name(self):
+        return 'barrier'
+
+    def is_local(self):
+        return True
+
+    def is_nop(self):
+        return True
+
+    def apply_async(self):
+        self.set_state(tasks.TASK_SUCCEEDED)
+        self.async_result = tasks.StubAsyncResult()
+        return self.async_result
+
 
 class SubgraphTask(tasks.WorkflowTask):
 
+    __slots__ = ('graph', '_name', 'tasks', 'failed_task')
+
     def __init__(self,
                  name,
                  graph,
@@ -291,7 +816,7 @@ class SubgraphTask(tasks.WorkflowTask):
                  on_success=None,
                  on_failure=None,
                  total_retries=tasks.DEFAULT_SUBGRAPH_TOTAL_RETRIES,
-                 retry_interval=tasks.DEFAULT_RETRY_INTERVAL,
+                 retry_interval=tasks.DEFAULT_SUBGRAPH_RETRY_INTERVAL,
                  send_task_events=tasks.DEFAULT_SEND_TASK_EVENTS):
         super(SubgraphTask, self).__init__(
             graph.ctx,
@@ -370,3 +895,199 @@ class SubgraphTask(tasks.WorkflowTask):
             new_task.containing_subgraph = self
         if not self.tasks and self.get_state() not in tasks.TERMINATED_STATES:
             self.set_state(tasks.TASK_SUCCEEDED)
+
+
+def _task_operation(task):
+    """
+    :return: The operation name of an operation task (or its task name for
+             operation tasks not bound to a node operation), None for any
+             other task
+    """
+    if task.is_subgraph or task.is_nop():
+        return None
+    cloudify_context = task.cloudify_context
+    if not cloudify_context:
+        return None
+    return cloudify_context.get('operation', {}).get(
+        'name', cloudify_context.get('task_name'))
+
+
+class OperationDurations(object):
+    """
+    Historical durations of operations, used to estimate how long the tasks
+    depending on a task will take.
+
+    :param durations: A dict mapping operation names to their known
+                      duration (in seconds)
+    :param smoothing: Weight of a newly recorded duration in the moving
+                      average kept for each operation
+    """
+
+    def __init__(self, durations=None, smoothing=0.3):
+        self._durations = dict(durations or {})
+        self._smoothing = smoothing
+
+    def record(self, operation, duration):
+        previous = self._durations.get(operation)
+        if previous is not None:
+            duration = (self._smoothing * duration +
+                        (1 - self._smoothing) * previous)
+        self._durations[operation] = duration
+
+    def estimate(self, operation):
+        """
+        :return: The known duration of the operation, the average duration
+                 of known operations if it has none or 1 if no duration is
+                 known at all (i.e. tasks are simply counted)
+        """
+        duration = self._durations.get(operation)
+        if duration is not None:
+            return duration
+        if self._durations:
+            return float(sum(self._durations.values())) / len(self._durations)
+        return 1
+
+    def as_dict(self):
+        return dict(self._durations)
+
+
+class ConcurrencyLimits(object):
+    """
+    Bounds the number of operation tasks in flight (sent for execution and
+    not yet terminated) while a TaskDependencyGraph executes.
+
+    Only operation tasks (tasks with a cloudify context) are limited. Local
+    bookkeeping tasks (setting node instance state, sending events) and
+    subgraph tasks are never held back.
+
+    :param total: Maximum number of operation tasks in flight in the graph
+    :param per_target: Maximum number of operation tasks in flight per task
+                       target. Either a number applied to every target or a
+                       dict mapping targets to their limit. The target of a
+                       task is its task_target when known, otherwise the host
+                       node instance id for host_agent operations and the
+                       executor name for any other operation.
+    :param per_operation: Maximum number of operation tasks in flight per
+                          operation name. Either a number applied to every
+                          operation or a dict mapping operation names to
+                          their limit.
+
+    A limit of None means unlimited.
+    """
+
+    def __init__(self, total=None, per_target=None, per_operation=None):
+        self.total = total
+        self.per_target = per_target
+        self.per_operation = per_operation
+        self._total_in_flight = 0
+        self._targets_in_flight = {}
+        self._operations_in_flight = {}
+        # task id -> (target, operation) of tasks holding a slot
+        self._tasks = {}
+
+    @property
+    def enabled(self):
+        return any(limit is not None for limit in (self.total,
+                                                   self.per_target,
+                                                   self.per_operation))
+
+    @property
+    def saturated(self):
+        """Is the graph wide limit reached"""
+        return self.total is not None and self._total_in_flight >= self.total
+
+    @property
+    def limits(self):
+        return {
+            'total': self.total,
+            'per_target': self.per_target,
+            'per_operation': self.per_operation
+        }
+
+    @property
+    def in_flight(self):
+        return {
+            'total': self._total_in_flight,
+            'targets': dict(self._targets_in_flight),
+            'operations': dict(self._operations_in_flight)
+        }
+
+    def applies_to(self, task):
+        """Is the task subject to these limits"""
+        return self._task_keys(task) is not None
+
+    def acquire(self, task):
+        """
+        Take a slot for the task if one is available
+
+        :param task: The task about to be sent for execution
+        :return: False if the task should be held back, True otherwise
+        """
+        if not self.enabled:
+            return True
+        keys = self._task_keys(task)
+        if keys is None:
+            return True
+        target, operation = keys
+        if (self.saturated or
+                self._exhausted(self.per_target, target,
+                                self._targets_in_flight) or
+                self._exhausted(self.per_operation, operation,
+                                self._operations_in_flight)):
+            return False
+        self._tasks[task.id] = keys
+        self._total_in_flight += 1
+        self._increment(self._targets_in_flight, target, 1)
+        self._increment(self._operations_in_flight, operation, 1)
+        return True
+
+    def release(self, task):
+        """
+        Free the slot held by a terminated task
+
+        :return: True if the task held a slot
+        """
+        keys = self._tasks.pop(task.id, None)
+        if keys is None:
+            return False
+        target, operation = keys
+        self._total_in_flight -= 1
+        self._increment(self._targets_in_flight, target, -1)
+        self._increment(self._operations_in_flight, operation, -1)
+        return True
+
+    def reset(self):
+        self._total_in_flight = 0
+        self._targets_in_flight = {}
+        self._operations_in_flight = {}
+        self._tasks = {}
+
+    @staticmethod
+    def _task_keys(task):
+        operation = _task_operation(task)
+        if operation is None:
+            return None
+        cloudify_context = task.cloudify_context
+        target = getattr(task, 'target', None)
+        if target is None:
+            if cloudify_context.get('executor') == 'host_agent':
+                target = cloudify_context.get('host_id')
+            else:
+                target = cloudify_context.get('executor')
+        return target, operation
+
+    @staticmethod
+    def _exhausted(limits, key, in_flight):
+        if isinstance(limits, dict):
+            limit = limits.get(key)
+        else:
+            limit = limits
+        return limit is not None and in_flight.get(key, 0) >= limit
+
+    @staticmethod
+    def _increment(in_flight, key, delta):
+        count = in_flight.get(key, 0) + delta
+        if count:
+            in_flight[key] = count
+        else:
+            in_flight.pop(key, None)
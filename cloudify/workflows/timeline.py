@@ -0,0 +1,257 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Execution timeline of the tasks of a task graph.
+
+Graphs created with record_timeline make their tasks record a monotonic
+timestamp for every state change. The graph adds a record to its timeline once
+a task terminates, which is then used to report where the time of an execution
+went and to export it as a Chrome trace (chrome://tracing,
+https://ui.perfetto.dev).
+"""
+
+from cloudify.utils import monotonic
+from cloudify.workflows import tasks as tasks_api
+
+
+class TaskRecord(object):
+    """
+    The timeline of a terminated task
+
+    :param task: The task
+    :param released_by: Id of the task whose termination made this task
+                        executable (None if it had no dependencies)
+    """
+
+    def __init__(self, task, released_by=None):
+        cloudify_context = task.cloudify_context or {}
+        self.id = task.id
+        self.name = task.name
+        self.operation = cloudify_context.get('operation', {}).get('name')
+        self.queue = getattr(task, 'queue', None)
+        self.target = getattr(task, 'target', None)
+        self.retry = task.current_retries
+        self.retry_delay = task.retry_delay
+        self.subgraph = task.is_subgraph
+        self.nop = task.is_nop()
+        self.containing_subgraph = (task.containing_subgraph.id
+                                    if task.containing_subgraph else None)
+        self.state_changes = list(task.state_changes)
+        self.released_by = released_by
+
+    def first(self, *states):
+        """
+        :return: The timestamp of the first change to any of the states
+        """
+        for state, timestamp in self.state_changes:
+            if state in states:
+                return timestamp
+        return None
+
+    @property
+    def created(self):
+        return self.state_changes[0][1]
+
+    @property
+    def sending(self):
+        return self.first(tasks_api.TASK_SENDING, tasks_api.TASK_SENT)
+
+    @property
+    def sent(self):
+        return self.first(tasks_api.TASK_SENT)
+
+    @property
+    def started(self):
+        return self.first(tasks_api.TASK_STARTED)
+
+    @property
+    def terminated(self):
+        return self.first(*tasks_api.TERMINATED_STATES)
+
+    @property
+    def state(self):
+        return self.state_changes[-1][0]
+
+
+class Timeline(object):
+    """Records of the tasks terminated while a task graph executes"""
+
+    def __init__(self):
+        self.start = None
+        self.end = None
+        self.tasks = {}
+
+    def reset(self):
+        self.start = monotonic()
+        self.end = None
+        self.tasks = {}
+
+    def stop(self):
+        self.end = monotonic()
+
+    def task_terminated(self, task, released_by=None):
+        self.tasks[task.id] = TaskRecord(task, released_by)
+
+    def _operation_records(self):
+        return [record for record in self.tasks.values()
+                if not (record.subgraph or record.nop) and
+                record.terminated is not None]
+
+    def report(self):
+        """
+        :return: A dict with the execution duration, the time operation
+                 tasks spent waiting for their dependencies, being sent,
+                 queued and running, latency percentiles per operation,
+                 the delays retries waited for and the realized critical
+                 path
+        """
+        end = self.end if self.end is not None else monotonic()
+        records = self._operation_records()
+        phases = dict(waiting=0, sending=0, queued=0, running=0)
+        latencies = {}
+        retry_delays = []
+        for record in records:
+            if record.retry_delay is not None:
+                retry_delays.append(record.retry_delay)
+            for phase, duration in self._phases(record).items():
+                phases[phase] += duration
+            latency = record.terminated - (record.sending or record.created)
+            latencies.setdefault(record.operation or record.name,
+                                 []).append(latency)
+        return {
+            'duration': end - self.start if self.start is not None else 0,
+            'tasks': len(records),
+            'phases': phases,
+            'operations': dict(
+                (operation, _percentiles(durations))
+                for operation, durations in latencies.items()),
+            'retries': dict(_percentiles(retry_delays),
+                            total=sum(retry_delays)),
+            'critical_path': [
+                {'id': record.id,
+                 'name': record.name,
+                 'operation': record.operation,
+                 'target': record.target,
+                 'retry': record.retry,
+                 'state': record.state,
+                 'phases': self._phases(record)}
+                for record in self.critical_path()]
+        }
+
+    def _phases(self, record):
+        """
+        :return: Seconds the task spent waiting for its dependencies (or its
+                 retry interval), being sent, queued for a worker and running
+        """
+        ready = max(record.created, self.start or record.created)
+        sending = record.sending or record.terminated
+        sent = record.sent or sending
+        started = record.started or sent
+        return {
+            'waiting': max(0, sending - ready),
+            'sending': max(0, sent - sending),
+            'queued': max(0, started - sent),
+            'running': max(0, record.terminated - started)
+        }
+
+    def critical_path(self):
+        """
+        :return: The records of the chain of tasks that ended last, each
+                 one made executable by the termination of the previous one
+        """
+        records = self._operation_records()
+        if not records:
+            return []
+        record = max(records, key=lambda r: r.terminated)
+        path = []
+        seen = set()
+        while record is not None and record.id not in seen:
+            seen.add(record.id)
+            if not (record.subgraph or record.nop or
+                    record.terminated is None):
+                path.append(record)
+            # tasks without dependencies of their own inside a subgraph
+            # were waiting for the subgraph dependencies
+            record = self.tasks.get(record.released_by or
+                                    record.containing_subgraph)
+        path.reverse()
+        return path
+
+    def chrome_trace(self):
+        """
+        :return: The timeline in the Chrome trace event format. Each target
+                 is a process, overlapping tasks of a target are spread on
+                 different threads of that process.
+        """
+        origin = self.start
+        records = sorted(self._operation_records(),
+                         key=lambda r: r.sending or r.created)
+        if origin is None:
+            origin = min([r.created for r in records] or [0])
+        events = []
+        processes = {}
+        # per process, the end timestamp of the last task on each lane
+        lanes = {}
+        for record in records:
+            process = record.target or record.queue or 'local'
+            if process not in processes:
+                processes[process] = len(processes) + 1
+                lanes[process] = []
+                events.append({'name': 'process_name', 'ph': 'M',
+                               'pid': processes[process],
+                               'args': {'name': process}})
+            begin = record.sending or record.created
+            process_lanes = lanes[process]
+            for lane, lane_end in enumerate(process_lanes):
+                if lane_end <= begin:
+                    break
+            else:
+                lane = len(process_lanes)
+                process_lanes.append(None)
+            process_lanes[lane] = record.terminated
+            args = dict(self._phases(record), id=record.id,
+                        retry=record.retry, state=record.state)
+            if record.operation:
+                args['operation'] = record.operation
+            events.append({
+                'name': record.operation or record.name,
+                'cat': 'task',
+                'ph': 'X',
+                'ts': int((begin - origin) * 1e6),
+                'dur': int((record.terminated - begin) * 1e6),
+                'pid': processes[process],
+                'tid': lane + 1,
+                'args': args
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def _percentiles(durations):
+    durations = sorted(durations)
+    if not durations:
+        return {'count': 0}
+
+    def percentile(p):
+        # nearest rank
+        index = max(0, int(round(p / 100.0 * len(durations))) - 1)
+        return durations[min(index, len(durations) - 1)]
+    return {
+        'count': len(durations),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': durations[-1]
+    }
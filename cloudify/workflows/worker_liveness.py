@@ -0,0 +1,162 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+"""
+Cache of the tasks registered by celery workers.
+
+Remote tasks are only sent once their worker is known to be alive and to
+have the dispatch task registered. Looking that up means inspecting the
+worker, which blocks until it replies (or a timeout expires), so results
+are cached for a while. Lookups of targets without a fresh entry are
+single-flight: one thread inspects all targets that are missing at that
+time in a single broadcast while other threads wait for its result.
+"""
+
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from cloudify.utils import monotonic
+
+# seconds the registered tasks of a worker are cached
+DEFAULT_TTL = 300
+# seconds a worker that did not reply is cached, so that tasks retried
+# shortly after do not all wait for the inspect timeout again
+DEFAULT_NEGATIVE_TTL = 10
+DEFAULT_MAXSIZE = 1000
+
+
+class _Lookup(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.registered = None
+        self.error = None
+
+
+class WorkerLivenessCache(object):
+    """
+    :param inspect: Called with a list of targets, returns a dict of the
+                    registered tasks of the targets that replied
+    :param ttl: Seconds the registered tasks of a worker are cached
+    :param negative_ttl: Seconds a worker that did not reply is cached
+    :param maxsize: Maximum number of cached workers, the least recently
+                    used ones are evicted first
+    """
+
+    def __init__(self, inspect,
+                 ttl=DEFAULT_TTL,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 maxsize=DEFAULT_MAXSIZE):
+        self._inspect = inspect
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        # target -> (registered, expires at), least recently used first
+        self._entries = OrderedDict()
+        # targets waiting to be inspected and their lookups
+        self._pending = OrderedDict()
+        # targets being inspected and their lookups
+        self._inflight = {}
+        self._refreshing = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, target):
+        """
+        :return: The tasks registered by the target worker, None if it did
+                 not reply
+        """
+        return self.get_many([target])[target]
+
+    def get_many(self, targets):
+        """
+        Inspect all targets without a fresh entry in a single broadcast.
+
+        :return: A dict of the tasks registered by each target (None for
+                 targets that did not reply)
+        """
+        results = {}
+        lookups = {}
+        leader = False
+        with self._lock:
+            now = monotonic()
+            for target in targets:
+                if target in results or target in lookups:
+                    continue
+                entry = self._entries.pop(target, None)
+                if entry is not None and entry[1] > now:
+                    # re-inserted as the most recently used one
+                    self._entries[target] = entry
+                    results[target] = entry[0]
+                    continue
+                lookup = (self._inflight.get(target) or
+                          self._pending.get(target))
+                if lookup is None:
+                    lookup = self._pending[target] = _Lookup()
+                lookups[target] = lookup
+            if self._pending and not self._refreshing:
+                self._refreshing = leader = True
+        if leader:
+            self._refresh()
+        for target, lookup in lookups.items():
+            lookup.event.wait()
+            if lookup.error is not None:
+                raise lookup.error
+            results[target] = lookup.registered
+        return results
+
+    def _refresh(self):
+        """Inspect the pending targets until there are none left"""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._refreshing = False
+                    return
+                batch = self._pending
+                self._pending = OrderedDict()
+                self._inflight.update(batch)
+            error = None
+            registered = {}
+            try:
+                registered = self._inspect(list(batch))
+            except Exception as e:
+                error = e
+            with self._lock:
+                expires = monotonic()
+                for target, lookup in batch.items():
+                    del self._inflight[target]
+                    if error is not None:
+                        lookup.error = error
+                    else:
+                        lookup.registered = registered.get(target)
+                        self._store(target, lookup.registered, expires)
+                    lookup.event.set()
+
+    def _store(self, target, registered, now):
+        ttl = self.ttl if registered is not None else self.negative_ttl
+        self._entries.pop(target, None)
+        self._entries[target] = (registered, now + ttl)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
@@ -18,6 +18,10 @@ EXECUTION_CANCELLED_RESULT = 'execution_cancelled'
 
 cancel_request = False
 
+# callables invoked (without arguments) when a cancel request arrives, used
+# by blocking waits (e.g. the task graph executor) to wake up immediately
+_cancel_listeners = []
+
 
 def has_cancel_request():
     """
@@ -39,6 +43,36 @@ def has_cancel_request():
     return cancel_request
 
 
+def set_cancel_request():
+    """
+    Mark the workflow execution as requested for cancellation and notify
+    registered cancel listeners.
+    """
+    global cancel_request
+    cancel_request = True
+    for listener in list(_cancel_listeners):
+        listener()
+
+
+def add_cancel_listener(listener):
+    """
+    Register a callable to be invoked when a cancel request arrives.
+
+    :param listener: A callable that takes no arguments
+    """
+    _cancel_listeners.append(listener)
+
+
+def remove_cancel_listener(listener):
+    """
+    Unregister a callable previously registered with add_cancel_listener.
+
+    :param listener: The registered callable
+    """
+    if listener in _cancel_listeners:
+        _cancel_listeners.remove(listener)
+
+
 class ExecutionCancelled(Exception):
     """
     This exception should be raised when a workflow has been cancelled,
@@ -14,6 +14,7 @@
 #    * limitations under the License.
 
 
+import os
 import functools
 import copy
 import uuid
@@ -21,24 +22,30 @@ import threading
 import Queue
 
 from proxy_tools import proxy
+from cloudify_rest_client.exceptions import CloudifyClientError
 
 from cloudify import context
 from cloudify.manager import (get_node_instance,
-                              update_node_instance,
                               update_execution_status,
                               get_bootstrap_context,
                               get_rest_client,
+                              list_paginated,
                               download_resource)
+from cloudify.workflows.copy_on_write import CopyOnWriteDict
+from cloudify.workflows.local_processes import LocalTaskProcessPool
+from cloudify.workflows.state_buffer import NodeStateBuffer
 from cloudify.workflows.tasks import (RemoteWorkflowTask,
                                       LocalWorkflowTask,
                                       NOPLocalWorkflowTask,
                                       DEFAULT_TOTAL_RETRIES,
                                       DEFAULT_RETRY_INTERVAL,
                                       DEFAULT_SEND_TASK_EVENTS,
-                                      DEFAULT_SUBGRAPH_TOTAL_RETRIES)
+                                      DEFAULT_SUBGRAPH_TOTAL_RETRIES,
+                                      DEFAULT_SUBGRAPH_RETRY_INTERVAL)
 from cloudify import utils
 from cloudify import exceptions
 from cloudify.state import current_workflow_ctx
+from cloudify.workflows import api
 from cloudify.workflows import events
 from cloudify.workflows.tasks_graph import TaskDependencyGraph
 from cloudify.amqp_client_utils import AMQPWrappedThread
@@ -58,6 +65,28 @@ except ImportError:
 
 
 DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE = 1
+DEFAULT_LOCAL_TASK_PROCESS_POOL_SIZE = 0
+
+# node instance fields loaded when a workflow starts, runtime properties are
+# left out as most workflows never read them
+NODE_INSTANCE_FIELDS = ['id', 'node_id', 'host_id', 'relationships',
+                        'deployment_id', 'state', 'version', 'scaling_groups']
+
+# operations that install or reconfigure the agent of the host they run on,
+# invalidating the agent queue and name cached for the host
+AGENT_OPERATIONS = frozenset([
+    'cloudify.interfaces.cloudify_agent.create',
+    'cloudify.interfaces.cloudify_agent.configure',
+    'cloudify.interfaces.cloudify_agent.start',
+    'cloudify.interfaces.cloudify_agent.create_amqp',
+    'cloudify.interfaces.worker_installer.install',
+    'cloudify.interfaces.worker_installer.start'
+])
+# number of hosts whose agents are read in a single request
+HOST_AGENTS_PRELOAD_BATCH = 100
+
+# number of deployments a system wide workflow runs in at a time
+DEFAULT_DEPLOYMENTS_CONCURRENCY = 10
 
 
 class CloudifyWorkflowRelationshipInstance(object):
@@ -154,6 +183,7 @@ class CloudifyWorkflowRelationship(object):
         self.node = node
         self._nodes_and_instances = nodes_and_instances
         self._relationship = relationship
+        self._type_hierarchy = None
 
     @property
     def target_id(self):
@@ -180,7 +210,10 @@ class CloudifyWorkflowRelationship(object):
         :param other_relationship: a string like
                cloudify.relationships.contained_in
         """
-        return other_relationship in self._relationship["type_hierarchy"]
+        if self._type_hierarchy is None:
+            self._type_hierarchy = frozenset(
+                self._relationship["type_hierarchy"])
+        return other_relationship in self._type_hierarchy
 
 
 class CloudifyWorkflowNodeInstance(object):
@@ -197,6 +230,7 @@ class CloudifyWorkflowNodeInstance(object):
         self.ctx = ctx
         self._node = node
         self._node_instance = node_instance
+        self._nodes_and_instances = nodes_and_instances
         # Directly contained node instances. Filled in the context's __init__()
         self._contained_instances = []
         self._relationship_instances = OrderedDict(
@@ -300,6 +334,17 @@ class CloudifyWorkflowNodeInstance(object):
     def scaling_groups(self):
         return self._node_instance.get('scaling_groups', [])
 
+    @property
+    def runtime_properties(self):
+        """
+        The node instance runtime properties. When the node instance was
+        loaded without them, they are read on first access.
+        """
+        if self._node_instance.get('runtime_properties') is None:
+            self._node_instance['runtime_properties'] = \
+                self.ctx.internal.handler.get_runtime_properties(self)
+        return self._node_instance['runtime_properties']
+
     @property
     def logger(self):
         """A logger for this workflow node"""
@@ -328,10 +373,7 @@ class CloudifyWorkflowNodeInstance(object):
         Returns a set containing this instance and all nodes that are
         contained directly and transitively within it
         """
-        result = set([self])
-        for child in self.contained_instances:
-            result.update(child.get_contained_subgraph())
-        return result
+        return set(self._nodes_and_instances.get_contained_subgraph(self))
 
 
 class CloudifyWorkflowNode(object):
@@ -351,6 +393,7 @@ class CloudifyWorkflowNode(object):
                 self.ctx, self, nodes_and_instances, relationship))
             for relationship in node.relationships)
         self._node_instances = {}
+        self._type_hierarchy = None
 
     @property
     def id(self):
@@ -367,6 +410,14 @@ class CloudifyWorkflowNode(object):
         """The node type hierarchy"""
         return self._node.type_hierarchy
 
+    def is_derived_from(self, type_name):
+        """
+        :param type_name: a string like cloudify.nodes.Compute
+        """
+        if self._type_hierarchy is None:
+            self._type_hierarchy = frozenset(self.type_hierarchy)
+        return type_name in self._type_hierarchy
+
     @property
     def properties(self):
         """The node properties"""
@@ -418,6 +469,51 @@ class CloudifyWorkflowNode(object):
         return self._relationships.get(target_id)
 
 
+class OperationDescriptor(object):
+    """
+    What _execute_operation needs to know about an operation of a node,
+    compiled once per node and operation
+
+    :param ctx: a CloudifyWorkflowContext instance
+    :param node: the CloudifyWorkflowNode the operation is executed on
+    :param op_struct: the operation, as found in the node (or relationship)
+                      operations
+    """
+
+    __slots__ = ('task_name', 'inputs', 'total_retries', 'retry_interval',
+                 'node_context')
+
+    def __init__(self, ctx, node, op_struct):
+        plugin_name = op_struct['plugin']
+        # could match two plugins with different executors, one is enough
+        # for our purposes (extract package details)
+        plugin = [p for p in node.plugins if p['name'] == plugin_name][0]
+        executor = op_struct['executor']
+        self.task_name = op_struct['operation']
+        self.inputs = op_struct.get('inputs', {})
+        self.total_retries = op_struct['max_retries']
+        if self.total_retries is None:
+            self.total_retries = ctx.internal.get_task_configuration()[
+                'total_retries']
+        self.retry_interval = op_struct['retry_interval']
+        # the node context fragments that are the same for every task
+        self.node_context = {
+            'plugin': {
+                'name': plugin_name,
+                'package_name': plugin.get('package_name'),
+                'package_version': plugin.get('package_version')
+            },
+            'has_intrinsic_functions': op_struct['has_intrinsic_functions'],
+            'executor': executor
+        }
+        # central deployment agents run on the management worker
+        # so we pass the env to the dispatcher so it will be on a per
+        # operation basis
+        if executor == 'central_deployment_agent':
+            agent_context = ctx.bootstrap_context.get('cloudify_agent', {})
+            self.node_context['execution_env'] = agent_context.get('env', {})
+
+
 class _WorkflowContextBase(object):
 
     def __init__(self, ctx, remote_ctx_handler_cls):
@@ -425,13 +521,27 @@ class _WorkflowContextBase(object):
         self._local_task_thread_pool_size = ctx.get(
             'local_task_thread_pool_size',
             DEFAULT_LOCAL_TASK_THREAD_POOL_SIZE)
+        self._local_task_process_pool_size = ctx.get(
+            'local_task_process_pool_size',
+            DEFAULT_LOCAL_TASK_PROCESS_POOL_SIZE)
         self._task_retry_interval = ctx.get('task_retry_interval',
                                             DEFAULT_RETRY_INTERVAL)
         self._task_retries = ctx.get('task_retries',
                                      DEFAULT_TOTAL_RETRIES)
         self._subgraph_retries = ctx.get('subgraph_retries',
                                          DEFAULT_SUBGRAPH_TOTAL_RETRIES)
+        self._subgraph_retry_interval = ctx.get(
+            'subgraph_retry_interval',
+            DEFAULT_SUBGRAPH_RETRY_INTERVAL)
+        self._task_graph_backend = ctx.get('task_graph_backend')
+        self._task_concurrency_limits = ctx.get('task_concurrency_limits')
+        self._task_scheduling = ctx.get('task_scheduling')
+        self._task_operation_durations = ctx.get('task_operation_durations')
+        self._task_checkpoint_dir = ctx.get('task_checkpoint_dir')
         self._logger = None
+        # (node id, operations id, operation) -> (operations, descriptor)
+        self._operation_descriptors = {}
+        self._operation_context = None
 
         if self.local:
             storage = ctx.pop('storage')
@@ -458,6 +568,18 @@ class _WorkflowContextBase(object):
     def bootstrap_context(self):
         return self.internal._bootstrap_context
 
+    @property
+    def task_concurrency(self):
+        """
+        The limits on operation tasks in flight during graph execution and
+        the current in flight counts (total, per target and per operation)
+        """
+        concurrency = self.internal.task_graph.concurrency
+        return {
+            'limits': concurrency.limits,
+            'in_flight': concurrency.in_flight
+        }
+
     @property
     def internal(self):
         return self._internal
@@ -532,75 +654,64 @@ class _WorkflowContextBase(object):
                            allow_kwargs_override=False,
                            send_task_events=DEFAULT_SEND_TASK_EVENTS):
         kwargs = kwargs or {}
-        op_struct = operations.get(operation)
-        if op_struct is None:
-            raise RuntimeError('{0} operation of node instance {1} does '
-                               'not exist'.format(operation,
-                                                  node_instance.id))
-        if not op_struct['operation']:
+        descriptor = self._get_operation_descriptor(operation, node_instance,
+                                                    operations)
+        if descriptor is None:
             return NOPLocalWorkflowTask(self)
-        plugin_name = op_struct['plugin']
-        # could match two plugins with different executors, one is enough
-        # for our purposes (extract package details)
-        plugin = [p for p in node_instance.node.plugins
-                  if p['name'] == plugin_name][0]
-        operation_mapping = op_struct['operation']
-        has_intrinsic_functions = op_struct['has_intrinsic_functions']
-        operation_properties = op_struct.get('inputs', {})
-        operation_executor = op_struct['executor']
-        operation_total_retries = op_struct['max_retries']
-        operation_retry_interval = op_struct['retry_interval']
-        task_name = operation_mapping
-        if operation_total_retries is None:
-            total_retries = self.internal.get_task_configuration()[
-                'total_retries']
-        else:
-            total_retries = operation_total_retries
 
-        node_context = {
+        node_context = dict(descriptor.node_context)
+        node_context.update({
             'node_id': node_instance.id,
             'node_name': node_instance.node_id,
-            'plugin': {
-                'name': plugin_name,
-                'package_name': plugin.get('package_name'),
-                'package_version': plugin.get('package_version')
-            },
             'operation': {
                 'name': operation,
                 'retry_number': 0,
-                'max_retries': total_retries
+                'max_retries': descriptor.total_retries
             },
-            'has_intrinsic_functions': has_intrinsic_functions,
-            'host_id': node_instance._node_instance.host_id,
-            'executor': operation_executor
-        }
-        # central deployment agents run on the management worker
-        # so we pass the env to the dispatcher so it will be on a per
-        # operation basis
-        if operation_executor == 'central_deployment_agent':
-            agent_context = self.bootstrap_context.get('cloudify_agent', {})
-            node_context['execution_env'] = agent_context.get('env', {})
-
+            'host_id': node_instance._node_instance.host_id
+        })
         if related_node_instance is not None:
-            relationships = [rel.target_id
-                             for rel in node_instance.relationships]
             node_context['related'] = {
                 'node_id': related_node_instance.id,
                 'node_name': related_node_instance.node_id,
-                'is_target': related_node_instance.id in relationships
+                'is_target': related_node_instance.id in
+                node_instance._relationship_instances
             }
 
         final_kwargs = self._merge_dicts(merged_from=kwargs,
-                                         merged_into=operation_properties,
+                                         merged_into=descriptor.inputs,
                                          allow_override=allow_kwargs_override)
 
-        return self.execute_task(task_name,
+        return self.execute_task(descriptor.task_name,
                                  local=self.local,
                                  kwargs=final_kwargs,
                                  node_context=node_context,
                                  send_task_events=send_task_events,
-                                 total_retries=total_retries,
-                                 retry_interval=operation_retry_interval)
+                                 total_retries=descriptor.total_retries,
+                                 retry_interval=descriptor.retry_interval)
+
+    def _get_operation_descriptor(self, operation, node_instance, operations):
+        """
+        :return: The OperationDescriptor of the operation of the node (None
+                 for operations with no implementation), compiled on first
+                 use
+        """
+        key = (node_instance.node_id, id(operations), operation)
+        entry = self._operation_descriptors.get(key)
+        # the operations are kept in the entry so that their id is not reused
+        if entry is None or entry[0] is not operations:
+            op_struct = operations.get(operation)
+            if op_struct is None:
+                raise RuntimeError('{0} operation of node instance {1} does '
+                                   'not exist'.format(operation,
+                                                      node_instance.id))
+            descriptor = None
+            if op_struct['operation']:
+                descriptor = OperationDescriptor(self, node_instance.node,
+                                                 op_struct)
+            entry = self._operation_descriptors[key] = (operations,
+                                                        descriptor)
+        return entry[1]
 
     @staticmethod
     def _merge_dicts(merged_from, merged_into, allow_override=False):
@@ -632,17 +743,20 @@ class _WorkflowContextBase(object):
                                 task_id,
                                 task_name,
                                 node_context):
-        node_context = node_context or {}
-        context = {
-            '__cloudify_context': '0.3',
-            'type': 'operation',
-            'task_id': task_id,
-            'task_name': task_name,
-            'execution_id': self.execution_id,
-            'workflow_id': self.workflow_id
-        }
-        context.update(node_context)
-        context.update(self.internal.handler.operation_cloudify_context)
+        if self._operation_context is None:
+            # the same for every task of the execution
+            self._operation_context = {
+                '__cloudify_context': '0.3',
+                'type': 'operation',
+                'execution_id': self.execution_id,
+                'workflow_id': self.workflow_id
+            }
+            self._operation_context.update(
+                self.internal.handler.operation_cloudify_context)
+        context = dict(self._operation_context,
+                       task_id=task_id,
+                       task_name=task_name)
+        context.update(node_context or {})
         return context
 
     def execute_task(self,
@@ -662,9 +776,10 @@ class _WorkflowContextBase(object):
         :param kwargs: optional kwargs to be passed to the task
         :param node_context: Used internally by node.execute_operation
         """
-        # Should deepcopy cause problems here, remove it, but please make
-        # sure that WORKFLOWS_WORKER_PAYLOAD is not global in manager repo
-        kwargs = copy.deepcopy(kwargs) or {}
+        # kwargs (e.g. operation inputs) are shared with the node operation
+        # definitions and with other tasks, nested values are only copied
+        # once they are read through this task's kwargs
+        kwargs = CopyOnWriteDict(kwargs or {})
         task_id = str(uuid.uuid4())
         cloudify_context = self._build_cloudify_context(
             task_id,
@@ -803,6 +918,11 @@ class WorkflowNodesAndInstancesContainer(object):
                         "cloudify.relationships.contained_in"):
                     rel.target_node_instance._add_contained_node_instance(inst)
 
+        # secondary indexes, built on first use
+        self._node_instances_by_type = None
+        self._node_instances_by_host = None
+        self._contained_subgraphs = {}
+
     @property
     def nodes(self):
         return self._nodes.itervalues()
@@ -811,6 +931,68 @@ class WorkflowNodesAndInstancesContainer(object):
     def node_instances(self):
         return self._node_instances.itervalues()
 
+    def get_node_instances_by_node(self, node_id):
+        """
+        :param node_id: The node id
+        :return: a list of the node instances of the node (empty if the node
+                 is not found)
+        """
+        node = self._nodes.get(node_id)
+        return list(node.instances) if node is not None else []
+
+    def get_node_instances_by_type(self, type_name):
+        """
+        :param type_name: A type in the type hierarchy of the nodes
+        :return: a list of the node instances of nodes derived from the type
+        """
+        if self._node_instances_by_type is None:
+            by_type = {}
+            for node in self._nodes.itervalues():
+                instances = list(node.instances)
+                for node_type in set(node.type_hierarchy):
+                    by_type.setdefault(node_type, []).extend(instances)
+            self._node_instances_by_type = by_type
+        return list(self._node_instances_by_type.get(type_name, []))
+
+    def get_node_instances_by_host(self, host_id):
+        """
+        :param host_id: The id of a host node instance
+        :return: a list of the node instances hosted on the host (including
+                 the host itself)
+        """
+        if self._node_instances_by_host is None:
+            by_host = {}
+            for instance in self._node_instances.itervalues():
+                host = instance._node_instance.host_id
+                if host is not None:
+                    by_host.setdefault(host, []).append(instance)
+            self._node_instances_by_host = by_host
+        return list(self._node_instances_by_host.get(host_id, []))
+
+    def get_contained_subgraph(self, node_instance):
+        """
+        :param node_instance: A CloudifyWorkflowNodeInstance instance
+        :return: a frozenset of the node instance and all node instances
+                 contained directly and transitively within it
+        """
+        subgraphs = self._contained_subgraphs
+        if node_instance.id not in subgraphs:
+            # parents come before their children, so the subgraphs of the
+            # children are computed first when iterating in reverse
+            pending = [node_instance]
+            ordered = []
+            while pending:
+                instance = pending.pop()
+                if instance.id not in subgraphs:
+                    ordered.append(instance)
+                    pending.extend(instance.contained_instances)
+            for instance in reversed(ordered):
+                subgraph = set([instance])
+                for child in instance.contained_instances:
+                    subgraph.update(subgraphs[child.id])
+                subgraphs[instance.id] = frozenset(subgraph)
+        return subgraphs[node_instance.id]
+
     def get_node(self, node_id):
         """
         Get a node by its id
@@ -859,13 +1041,24 @@ class CloudifyWorkflowContext(
                 raw_nodes = storage.get_nodes()
                 raw_node_instances = storage.get_node_instances()
             else:
+                # streamed a page at a time, without the runtime
+                # properties of the node instances (read on first access)
                 rest = get_rest_client()
-                raw_nodes = rest.nodes.list(self.deployment.id)
-                raw_node_instances = rest.node_instances.list(
-                    self.deployment.id)
+                raw_nodes = list_paginated(
+                    rest.nodes.list,
+                    deployment_id=self.deployment.id)
+                raw_node_instances = list_paginated(
+                    rest.node_instances.list,
+                    deployment_id=self.deployment.id,
+                    _include=NODE_INSTANCE_FIELDS)
 
             WorkflowNodesAndInstancesContainer.__init__(self, self, raw_nodes,
                                                         raw_node_instances)
+            if not self.local:
+                self.internal.handler.set_deployment_hosts(set(
+                    instance._node_instance.host_id
+                    for instance in self.node_instances
+                    if instance._node_instance.host_id))
 
     def _build_cloudify_context(self, *args):
         context = super(
@@ -890,13 +1083,44 @@ class CloudifySystemWideWorkflowContext(_WorkflowContextBase):
         self._dep_contexts = None
 
     class _ManagedCloudifyWorkflowContext(CloudifyWorkflowContext):
+        """
+        A deployment workflow context, processing its local tasks and
+        monitoring the events of its tasks while entered.
+
+        :param ctx: a cloudify_context workflow dict
+        :param fan_out: a _DeploymentsFanOut whose event monitor and local
+                        task threads are used instead of starting new ones
+        """
+
+        def __init__(self, ctx, fan_out=None):
+            super(CloudifySystemWideWorkflowContext
+                  ._ManagedCloudifyWorkflowContext, self).__init__(ctx)
+            self._fan_out = fan_out
+            if fan_out is not None:
+                self.internal.local_tasks_processor = fan_out.local_tasks
+
         def __enter__(self):
-            self.internal.start_local_tasks_processing()
-            self.internal.start_event_monitor()
+            if self._fan_out is None:
+                self.internal.start_local_tasks_processing()
+                self.internal.start_event_monitor()
+            else:
+                self._fan_out.event_monitor.add_tasks_graph(
+                    self.internal.task_graph)
 
         def __exit__(self, *args, **kwargs):
-            self.internal.stop_local_tasks_processing()
-            self.internal.stop_event_monitor()
+            if self._fan_out is None:
+                self.internal.stop_local_tasks_processing()
+                self.internal.stop_event_monitor()
+            else:
+                self._fan_out.event_monitor.remove_tasks_graph(
+                    self.internal.task_graph)
+            self.internal.handler.close()
+
+    def _deployment_context(self, deployment_id, blueprint_id):
+        dep_ctx = self._context.copy()
+        dep_ctx['deployment_id'] = deployment_id
+        dep_ctx['blueprint_id'] = blueprint_id
+        return dep_ctx
 
     @property
     def deployments_contexts(self):
@@ -905,9 +1129,7 @@ class CloudifySystemWideWorkflowContext(_WorkflowContextBase):
 
             rest = get_rest_client()
             for dep in rest.deployments.list():
-                dep_ctx = self._context.copy()
-                dep_ctx['deployment_id'] = dep.id
-                dep_ctx['blueprint_id'] = dep.blueprint_id
+                dep_ctx = self._deployment_context(dep.id, dep.blueprint_id)
 
                 def lazily_loaded_ctx(dep_ctx):
                     def lazy_ctx():
@@ -921,6 +1143,158 @@ class CloudifySystemWideWorkflowContext(_WorkflowContextBase):
                 self._dep_contexts[dep.id] = lazily_loaded_ctx(dep_ctx)
         return self._dep_contexts
 
+    def run_in_deployments(self, func, deployment_ids=None,
+                           concurrency=DEFAULT_DEPLOYMENTS_CONCURRENCY,
+                           prefetch=None):
+        """
+        Call a function with the workflow context of each deployment, in a
+        bounded number of deployments at a time.
+
+        The deployment contexts (their nodes and node instances) are loaded
+        by a single thread ahead of their use, and all of them share the
+        event monitor of this context and a single pool of local task
+        threads. Each of the ``concurrency`` threads calling the function
+        keeps a single AMQP connection for all the deployments it runs in.
+
+        Deployments not started yet when the execution is requested to be
+        cancelled are not run in, and fail with ExecutionCancelled.
+
+        :param func: called with an entered deployment workflow context, its
+                     return value is the result of the deployment
+        :param deployment_ids: the deployments to run in, all deployments
+                               if not specified
+        :param concurrency: number of deployments run in at a time
+        :param prefetch: number of deployment contexts loaded ahead of their
+                         use, the concurrency if not specified
+        :return: a DeploymentsFanOutResult
+        """
+        rest = get_rest_client()
+        if deployment_ids is None:
+            deployments = [
+                (dep.id, dep.blueprint_id) for dep in list_paginated(
+                    rest.deployments.list, _include=['id', 'blueprint_id'])]
+        else:
+            # blueprint ids are read by the loading thread
+            deployments = [(dep_id, None) for dep_id in deployment_ids]
+        fan_out = _DeploymentsFanOut(self, func, deployments, concurrency,
+                                     prefetch or concurrency)
+        return fan_out.run()
+
+
+class DeploymentsFanOutResult(object):
+    """
+    The outcome of CloudifySystemWideWorkflowContext.run_in_deployments
+
+    :ivar results: deployment id -> the value returned for the deployment
+    :ivar failures: deployment id -> the error raised for the deployment
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.failures = {}
+
+    @property
+    def succeeded(self):
+        return not self.failures
+
+
+class _DeploymentsFanOut(object):
+
+    def __init__(self, workflow_ctx, func, deployments, concurrency,
+                 prefetch):
+        self.workflow_ctx = workflow_ctx
+        self.func = func
+        self.deployments = deployments
+        self.concurrency = max(1, min(concurrency, len(deployments)))
+        self.result = DeploymentsFanOutResult()
+        # (deployment id, context or None, error or None), a None item
+        # stops a worker
+        self._contexts = Queue.Queue(maxsize=max(1, prefetch))
+        self._result_lock = threading.Lock()
+        self.event_monitor = None
+        # as many local task threads as the deployments run in at a time
+        # would have had each
+        self.local_tasks = _SharedLocalTasksProcessing(
+            workflow_ctx,
+            thread_pool_size=(self.concurrency *
+                              workflow_ctx._local_task_thread_pool_size))
+
+    def run(self):
+        if not self.deployments:
+            return self.result
+        internal = self.workflow_ctx.internal
+        own_event_monitor = internal._event_monitor is None
+        if own_event_monitor:
+            internal.start_event_monitor()
+        self.event_monitor = internal._event_monitor
+        self.local_tasks.start()
+        try:
+            loader = threading.Thread(target=self._load_contexts,
+                                      name='Deployments-Loader')
+            loader.daemon = True
+            loader.start()
+            workers = [AMQPWrappedThread(target=self._work,
+                                         name='Deployments-Worker-{0}'
+                                         .format(i + 1))
+                       for i in range(self.concurrency)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            loader.join()
+        finally:
+            self.local_tasks.stop()
+            if own_event_monitor:
+                internal.stop_event_monitor()
+                internal._event_monitor = None
+        return self.result
+
+    def _load_contexts(self):
+        rest = get_rest_client()
+        for deployment_id, blueprint_id in self.deployments:
+            dep_ctx = error = None
+            if api.has_cancel_request():
+                error = api.ExecutionCancelled()
+            else:
+                try:
+                    if blueprint_id is None:
+                        blueprint_id = rest.deployments.get(
+                            deployment_id,
+                            _include=['id', 'blueprint_id']).blueprint_id
+                    ctx = self.workflow_ctx._deployment_context(
+                        deployment_id, blueprint_id)
+                    dep_ctx = self.workflow_ctx \
+                        ._ManagedCloudifyWorkflowContext(ctx, fan_out=self)
+                except Exception as e:
+                    error = e
+            self._contexts.put((deployment_id, dep_ctx, error))
+        for _ in range(self.concurrency):
+            self._contexts.put(None)
+
+    def _work(self):
+        while True:
+            item = self._contexts.get()
+            if item is None:
+                return
+            deployment_id, dep_ctx, error = item
+            if error is None and api.has_cancel_request():
+                error = api.ExecutionCancelled()
+            if error is None:
+                try:
+                    with current_workflow_ctx.push(dep_ctx):
+                        with dep_ctx:
+                            result = self.func(dep_ctx)
+                    with self._result_lock:
+                        self.result.results[deployment_id] = result
+                except Exception as e:
+                    error = e
+            if error is not None:
+                self.workflow_ctx.logger.warning(
+                    'Failed running in deployment {0}: {1}'
+                    .format(deployment_id, error))
+                with self._result_lock:
+                    self.result.failures[deployment_id] = error
+
 
 class CloudifyWorkflowContextInternal(object):
 
@@ -934,7 +1308,11 @@ class CloudifyWorkflowContextInternal(object):
         subgraph_task_config = self.get_subgraph_task_configuration()
         self._task_graph = TaskDependencyGraph(
             workflow_context=workflow_context,
-            default_subgraph_task_config=subgraph_task_config)
+            default_subgraph_task_config=subgraph_task_config,
+            graph_backend=workflow_context._task_graph_backend,
+            concurrency_limits=self.get_concurrency_limits_configuration(),
+            checkpoint_path=self.get_checkpoint_path(),
+            **self.get_task_scheduling_configuration())
 
         # events related
         self._event_monitor = None
@@ -942,9 +1320,13 @@ class CloudifyWorkflowContextInternal(object):
 
         # local task processing
         thread_pool_size = self.workflow_context._local_task_thread_pool_size
+        process_pool_size = \
+            self.workflow_context._local_task_process_pool_size
         self.local_tasks_processor = LocalTasksProcessing(
             self.workflow_context,
-            thread_pool_size=thread_pool_size)
+            thread_pool_size=thread_pool_size,
+            process_pool_size=process_pool_size,
+            storage=getattr(handler, 'storage', None))
 
     def get_task_configuration(self):
         bootstrap_context = self._get_bootstrap_context()
@@ -965,7 +1347,41 @@ class CloudifyWorkflowContextInternal(object):
             'subgraph_retries',
             self.workflow_context._subgraph_retries
         )
-        return dict(total_retries=subgraph_retries)
+        subgraph_retry_interval = workflows.get(
+            'subgraph_retry_interval',
+            self.workflow_context._subgraph_retry_interval)
+        return dict(total_retries=subgraph_retries,
+                    retry_interval=subgraph_retry_interval)
+
+    def get_concurrency_limits_configuration(self):
+        bootstrap_context = self._get_bootstrap_context()
+        workflows = bootstrap_context.get('workflows', {})
+        return workflows.get(
+            'task_concurrency_limits',
+            self.workflow_context._task_concurrency_limits)
+
+    def get_task_scheduling_configuration(self):
+        bootstrap_context = self._get_bootstrap_context()
+        workflows = bootstrap_context.get('workflows', {})
+        scheduling = workflows.get(
+            'task_scheduling',
+            self.workflow_context._task_scheduling)
+        operation_durations = workflows.get(
+            'task_operation_durations',
+            self.workflow_context._task_operation_durations)
+        return dict(scheduling=scheduling,
+                    operation_durations=operation_durations)
+
+    def get_checkpoint_path(self):
+        bootstrap_context = self._get_bootstrap_context()
+        workflows = bootstrap_context.get('workflows', {})
+        checkpoint_dir = workflows.get(
+            'task_checkpoint_dir',
+            self.workflow_context._task_checkpoint_dir)
+        if not checkpoint_dir:
+            return None
+        return os.path.join(checkpoint_dir, '{0}.checkpoint'.format(
+            self.workflow_context.execution_id))
 
     def _get_bootstrap_context(self):
         if self._bootstrap_context is None:
@@ -1019,13 +1435,23 @@ class CloudifyWorkflowContextInternal(object):
     def add_local_task(self, task):
         self.local_tasks_processor.add_task(task)
 
+    def run_local_task(self, local_task, kwargs):
+        return self.local_tasks_processor.run(local_task, kwargs)
+
 
 class LocalTasksProcessing(object):
 
-    def __init__(self, workflow_ctx, thread_pool_size=1):
+    def __init__(self, workflow_ctx, thread_pool_size=1, process_pool_size=0,
+                 storage=None):
         self._local_tasks_queue = Queue.Queue()
         self._local_task_processing_pool = []
         self._is_local_context = workflow_ctx.local
+        # worker processes are only used by local workflows, where the
+        # operations run by local tasks are CPU bound python code
+        self._process_pool = None
+        if process_pool_size and self._is_local_context:
+            self._process_pool = LocalTaskProcessPool(process_pool_size,
+                                                      storage=storage)
         for i in range(thread_pool_size):
             name = 'Task-Processor-{0}'.format(i + 1)
             if self._is_local_context:
@@ -1040,6 +1466,9 @@ class LocalTasksProcessing(object):
         self.stopped = False
 
     def start(self):
+        if self._process_pool:
+            # before starting threads, the pool forks its worker processes
+            self._process_pool.start()
         for thread in self._local_task_processing_pool:
             thread.start()
         if not self._is_local_context:
@@ -1048,10 +1477,21 @@ class LocalTasksProcessing(object):
 
     def stop(self):
         self.stopped = True
+        if self._process_pool:
+            self._process_pool.close()
 
     def add_task(self, task):
         self._local_tasks_queue.put(task)
 
+    def run(self, local_task, kwargs):
+        """
+        Run a local task callable, in a worker process if a process pool
+        is used and the callable can run in one
+        """
+        if self._process_pool:
+            return self._process_pool.run(local_task, kwargs)
+        return local_task(**kwargs)
+
     def _process_local_task(self, workflow_ctx):
         # see CFY-1442
         with current_workflow_ctx.push(workflow_ctx):
@@ -1064,6 +1504,24 @@ class LocalTasksProcessing(object):
                 except:
                     pass
 
+
+class _SharedLocalTasksProcessing(LocalTasksProcessing):
+    """
+    Local task threads shared by the workflow contexts of several
+    deployments, running each task under the workflow context it was added
+    in.
+    """
+
+    def add_task(self, task):
+        workflow_ctx = current_workflow_ctx.get_ctx()
+        parameters = current_workflow_ctx.get_parameters()
+
+        def run_in_context():
+            with current_workflow_ctx.push(workflow_ctx, parameters):
+                task()
+        super(_SharedLocalTasksProcessing, self).add_task(run_in_context)
+
+
 # Local/Remote Handlers
 
 
@@ -1099,6 +1557,15 @@ class CloudifyWorkflowContextHandler(object):
     def get_task(self, workflow_task, queue=None, target=None):
         raise NotImplementedError('Implemented by subclasses')
 
+    def publish_tasks(self, tasks):
+        """
+        Publish tasks returned by get_task, all to the same queue.
+
+        :param tasks: (task id, task) tuples
+        :return: The async results of the tasks
+        """
+        return [task.apply_async(task_id=task_id) for task_id, task in tasks]
+
     @property
     def operation_cloudify_context(self):
         raise NotImplementedError('Implemented by subclasses')
@@ -1111,6 +1578,23 @@ class CloudifyWorkflowContextHandler(object):
     def get_get_state_task(self, workflow_node_instance):
         raise NotImplementedError('Implemented by subclasses')
 
+    def flush_node_states(self, raise_errors=False):
+        """
+        Write the node instance states that were set but not written yet
+
+        :param raise_errors: Raise write errors instead of logging them
+        """
+        pass
+
+    def remote_task_terminated(self, workflow_task):
+        pass
+
+    def close(self):
+        pass
+
+    def get_runtime_properties(self, workflow_node_instance):
+        raise NotImplementedError('Implemented by subclasses')
+
     def send_workflow_event(self, event_type, message=None, args=None,
                             additional_context=None):
         raise NotImplementedError('Implemented by subclasses')
@@ -1135,6 +1619,20 @@ class CloudifyWorkflowContextHandler(object):
 
 class RemoteContextHandler(CloudifyWorkflowContextHandler):
 
+    def __init__(self, workflow_ctx):
+        super(RemoteContextHandler, self).__init__(workflow_ctx)
+        # node instance states are written behind, see get_set_state_task
+        self.node_states = NodeStateBuffer(
+            self._write_node_state,
+            logger=proxy(lambda: self.workflow_ctx.logger))
+        # node instance id -> last known version, None once it may have
+        # changed since
+        self._node_versions = {}
+        # host node instance id -> cloudify_agent runtime property
+        self._host_agents = {}
+        # hosts whose agents are read in bulk on the first agent lookup
+        self._hosts_to_preload = set()
+
     @property
     def bootstrap_context(self):
         return get_bootstrap_context()
@@ -1159,23 +1657,17 @@ class RemoteContextHandler(CloudifyWorkflowContextHandler):
 
     def get_task(self, workflow_task, queue=None, target=None):
 
-        runtime_props = []
-
         def _derive(property_name):
             executor = workflow_task.cloudify_context['executor']
             host_id = workflow_task.cloudify_context['host_id']
             if executor == 'host_agent':
-                if len(runtime_props) == 0:
-                    host_node_instance = get_node_instance(host_id)
-                    cloudify_agent = host_node_instance.runtime_properties.get(
-                        'cloudify_agent', {})
-                    if property_name not in cloudify_agent:
-                        raise exceptions.NonRecoverableError(
-                            'Missing cloudify_agent.{0} runtime information. '
-                            'This most likely means that the Compute node was '
-                            'never started successfully'.format(property_name))
-                    runtime_props.append(cloudify_agent)
-                return runtime_props[0][property_name]
+                cloudify_agent = self._get_host_agent(host_id)
+                if property_name not in cloudify_agent:
+                    raise exceptions.NonRecoverableError(
+                        'Missing cloudify_agent.{0} runtime information. '
+                        'This most likely means that the Compute node was '
+                        'never started successfully'.format(property_name))
+                return cloudify_agent[property_name]
             else:
                 return 'cloudify.management'
 
@@ -1202,6 +1694,79 @@ class RemoteContextHandler(CloudifyWorkflowContextHandler):
                               app=app.app,
                               immutable=True), queue, target
 
+    def _get_host_agent(self, host_id):
+        """
+        :return: The cloudify_agent runtime property of the host, cached for
+                 the rest of the execution once it has a queue and a name
+        """
+        cloudify_agent = self._host_agents.get(host_id)
+        if cloudify_agent is None and host_id in self._hosts_to_preload:
+            hosts = self._hosts_to_preload
+            self._hosts_to_preload = set()
+            self.preload_host_agents(hosts)
+            cloudify_agent = self._host_agents.get(host_id)
+        if cloudify_agent is None:
+            client = get_rest_client()
+            host_node_instance = client.node_instances.get(
+                host_id, _include=['runtime_properties'])
+            cloudify_agent = self._cache_host_agent(
+                host_id, host_node_instance.runtime_properties)
+        return cloudify_agent
+
+    def _cache_host_agent(self, host_id, runtime_properties):
+        cloudify_agent = (runtime_properties or {}).get('cloudify_agent', {})
+        if 'queue' in cloudify_agent and 'name' in cloudify_agent:
+            self._host_agents[host_id] = cloudify_agent
+        return cloudify_agent
+
+    def set_deployment_hosts(self, host_ids):
+        """
+        Have the agents of the hosts read in bulk once the agent of one of
+        them is first looked up, i.e. only by workflows sending tasks to
+        host agents
+        """
+        self._hosts_to_preload = set(host_ids)
+
+    def preload_host_agents(self, host_ids):
+        """
+        Read the agents of the hosts in bulk, instead of one host at a time
+        when their first task is sent
+        """
+        host_ids = [host_id for host_id in host_ids
+                    if host_id not in self._host_agents]
+        client = get_rest_client()
+        for start in range(0, len(host_ids), HOST_AGENTS_PRELOAD_BATCH):
+            batch = host_ids[start:start + HOST_AGENTS_PRELOAD_BATCH]
+            for host in list_paginated(
+                    client.node_instances.list,
+                    id=batch,
+                    _include=['id', 'runtime_properties']):
+                self._cache_host_agent(host.id, host.runtime_properties)
+
+    def remote_task_terminated(self, workflow_task):
+        cloudify_context = workflow_task.cloudify_context
+        operation = cloudify_context.get('operation', {})
+        if operation.get('name') in AGENT_OPERATIONS:
+            # the agent of the host the operation ran on may have changed
+            self._host_agents.pop(cloudify_context.get('node_id'), None)
+        # the operation may have updated the runtime properties of the node
+        # instances it ran on, so their versions are read again before
+        # their next state is written instead of trying the cached ones
+        for node_instance_id in (
+                cloudify_context.get('node_id'),
+                (cloudify_context.get('related') or {}).get('node_id')):
+            if node_instance_id is not None:
+                self._node_versions[node_instance_id] = None
+
+    def publish_tasks(self, tasks):
+        # a single producer (and broker channel) for the whole batch
+        # instead of acquiring one from the pool per task
+        from cloudify_agent import app
+
+        with app.app.producer_or_acquire() as producer:
+            return [task.apply_async(task_id=task_id, producer=producer)
+                    for task_id, task in tasks]
+
     @property
     def operation_cloudify_context(self):
         return {'local': False,
@@ -1215,18 +1780,58 @@ class RemoteContextHandler(CloudifyWorkflowContextHandler):
                            state):
         @task_config(send_task_events=False)
         def set_state_task():
-            node_state = get_node_instance(workflow_node_instance.id)
-            node_state.state = state
-            update_node_instance(node_state)
-            return node_state
+            # written before the next remote operation is sent, or by the
+            # background flush, coalesced with later states of the instance
+            self._node_versions.setdefault(
+                workflow_node_instance.id,
+                workflow_node_instance._node_instance.get('version'))
+            self.node_states.set(workflow_node_instance.id, state)
         return set_state_task
 
     def get_get_state_task(self, workflow_node_instance):
         @task_config(send_task_events=False)
         def get_state_task():
+            state = self.node_states.get(workflow_node_instance.id)
+            if state is not None:
+                return state
             return get_node_instance(workflow_node_instance.id).state
         return get_state_task
 
+    def _write_node_state(self, node_instance_id, state):
+        client = get_rest_client()
+        version = self._node_versions.get(node_instance_id)
+        instance = None
+        if version is not None:
+            try:
+                instance = client.node_instances.update(
+                    node_instance_id, state=state, version=version)
+            except CloudifyClientError as e:
+                # updated by someone else since, e.g. runtime properties
+                if e.status_code != 409:
+                    raise
+        if instance is None:
+            version = client.node_instances.get(
+                node_instance_id, _include=['version']).version
+            instance = client.node_instances.update(
+                node_instance_id, state=state, version=version)
+        self._node_versions[node_instance_id] = instance.version
+
+    def flush_node_states(self, raise_errors=False):
+        if raise_errors:
+            self.node_states.flush()
+        else:
+            self.node_states.try_flush()
+
+    def close(self):
+        self.node_states.close()
+        self.flush_node_states()
+
+    def get_runtime_properties(self, workflow_node_instance):
+        client = get_rest_client()
+        instance = client.node_instances.get(
+            workflow_node_instance.id, _include=['runtime_properties'])
+        return instance.runtime_properties
+
     def download_deployment_resource(self,
                                      blueprint_id,
                                      deployment_id,
@@ -1409,6 +2014,10 @@ class LocalCloudifyWorkflowContextHandler(CloudifyWorkflowContextHandler):
             return instance.state
         return get_state_task
 
+    def get_runtime_properties(self, workflow_node_instance):
+        return self.storage.get_node_instance(
+            workflow_node_instance.id).runtime_properties
+
     def send_workflow_event(self, event_type, message=None, args=None,
                             additional_context=None):
         send_workflow_event(self.workflow_ctx,